@@ -1,10 +1,13 @@
-from io import StringIO
 from typing import Annotated
 
-from fastapi import APIRouter, File, HTTPException, Response, UploadFile
-from tools.energy_analysis_lib import core
+from fastapi import APIRouter, File, Header, HTTPException, Response, UploadFile
+from tools.energy_analysis_lib import core, executor
 from tools.utils import logger
 
+from .errors import saturated_error
+from .formats import negotiate_format, tabular_response
+from .uploads import open_upload
+
 router = APIRouter()
 
 
@@ -14,28 +17,30 @@ def root():
 
 
 @router.get("/time-slots/{analysisId}")
-def get_results_time_slot_energy_by_id(analysisId: str) -> bytes:
+def get_results_time_slot_energy_by_id(
+    analysisId: str, accept: Annotated[str | None, Header()] = None
+) -> bytes:
     """
     Return the time slot energy results to the api.
 
     :param analysisId: The id of the analysis
+    :param accept: Accept header, to get the results in arrow or parquet format
     """
-    logger.info(f"GET /api/energy/time-slots/{analysisId}")
+    logger.info("GET /api/energy/time-slots/%s", analysisId)
+    file_format = negotiate_format(accept)
     try:
-        time_slot_energy_results = core.get_results_time_slot_energy_by_id(analysisId)
+        time_slot_energy_results = core.get_results_time_slot_energy_by_id(
+            analysisId, file_format
+        )
     # TODO: Better exception handling
     except Exception as e:
         logger.error(e)
         logger.error("The time slot energy results do not exist")
         raise FileNotFoundError("The time slot energy results do not exist")
 
-    headers = {
-        "Content-Disposition": 'attachment; filename="results_time_slot_energy.csv"'
-    }
-
     logger.info("Request processed")
-    return Response(
-        content=time_slot_energy_results, headers=headers, media_type="text/csv"
+    return tabular_response(
+        time_slot_energy_results, "results_time_slot_energy", file_format
     )
 
 
@@ -46,7 +51,7 @@ def delete_results_time_slot_energy_by_id(analysisId: str):
 
     :param analysisId: The id of the analysis
     """
-    logger.info(f"DELETE /api/energy/time-slots/{analysisId}")
+    logger.info("DELETE /api/energy/time-slots/%s", analysisId)
 
     message = core.delete_results_time_slot_energy_by_id(analysisId)
     return {"message": message}
@@ -62,11 +67,13 @@ async def process(consumption_file: Annotated[UploadFile, File()]):
     """
     logger.info("POST /api/energy/time-slots")
 
-    consumption_file = await consumption_file.read()
-    consumption_file = StringIO(consumption_file.decode("utf-8"))
+    consumption_file = open_upload(consumption_file)
 
     try:
-        analysisId = core.process_consumption_file(consumption_file)
+        analysisId = await executor.run(core.process_consumption_file, consumption_file)
+    except executor.SaturatedError as e:
+        logger.warning(e)
+        raise saturated_error(e)
     except Exception as e:
         logger.error(e)
         # Return 500 error
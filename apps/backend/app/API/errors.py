@@ -0,0 +1,18 @@
+import math
+
+from fastapi import HTTPException
+from tools.energy_analysis_lib import executor
+
+
+def saturated_error(e: executor.SaturatedError) -> HTTPException:
+    """
+    Return the 429 error of an upload rejected because the pool of analyses is
+    full, with the seconds to wait before retrying.
+
+    :param e: The error of the pool
+    """
+    return HTTPException(
+        status_code=429,
+        detail=str(e),
+        headers={"Retry-After": str(math.ceil(e.retry_after))},
+    )
@@ -0,0 +1,94 @@
+import importlib.util
+from collections.abc import Iterator
+
+from fastapi import HTTPException, Response
+from fastapi.responses import StreamingResponse
+from tools.energy_analysis_lib.constants import MEDIA_TYPES
+
+FILE_EXTENSIONS = {"csv": "csv", "arrow": "arrows", "parquet": "parquet"}
+
+# Other names used by clients for the same formats
+MEDIA_TYPE_ALIASES = {"application/x-parquet": "parquet"}
+
+
+def available_formats() -> dict[str, str]:
+    """
+    Return the formats that can be served: media type -> format.
+    """
+    formats = {media_type: name for name, media_type in MEDIA_TYPES.items()}
+    formats.update(MEDIA_TYPE_ALIASES)
+
+    # arrow and parquet are optional
+    if importlib.util.find_spec("pyarrow") is None:
+        formats = {
+            media_type: name for media_type, name in formats.items() if name == "csv"
+        }
+
+    return formats
+
+
+def negotiate_format(accept: str | None) -> str:
+    """
+    Choose the format of a tabular response from the Accept header. csv is returned
+    when there is no header or it accepts anything.
+
+    :param accept: The Accept header of the request
+    :return: The name of the format: "csv", "arrow" or "parquet"
+    """
+    if not accept:
+        return "csv"
+
+    formats = available_formats()
+
+    # Sort the media types by quality, keeping the order of the header on ties
+    accepted = []
+    for position, item in enumerate(accept.split(",")):
+        media_type, *params = (part.strip() for part in item.split(";"))
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.append((-quality, position, media_type.lower()))
+
+    for _, _, media_type in sorted(accepted):
+        if media_type in formats:
+            return formats[media_type]
+        if media_type in ("*/*", "text/*"):
+            return "csv"
+
+    raise HTTPException(
+        status_code=406,
+        detail=f"Supported formats: {', '.join(sorted(formats))}",
+    )
+
+
+def tabular_response(
+    content: bytes | Iterator[bytes], name: str, file_format: str
+) -> Response:
+    """
+    Return tabular data as a file download. Iterators of chunks, returned for big
+    exports, are streamed.
+
+    :param content: The data, or an iterator of chunks of the data
+    :param name: The name of the file without extension
+    :param file_format: The name of the format
+    """
+    headers = {
+        "Content-Disposition": (
+            f'attachment; filename="{name}.{FILE_EXTENSIONS[file_format]}"'
+        ),
+        "Vary": "Accept",
+    }
+
+    if isinstance(content, bytes):
+        return Response(
+            content=content, media_type=MEDIA_TYPES[file_format], headers=headers
+        )
+    return StreamingResponse(
+        content, media_type=MEDIA_TYPES[file_format], headers=headers
+    )
@@ -1,12 +1,34 @@
+import os
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
 from fastapi import FastAPI
 
 # from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from tools import upstream, warmup
+from tools.energy_analysis_lib import executor, result_cache, retention
 
 from .energy_router import router as energy_router
+from .portfolio_router import router as portfolio_router
+from .request_id import RequestIdMiddleware
 from .solar_router import router as solar_router
+from .summary_router import router as summary_router
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    load_dotenv()
+    retention.start_sweeper()
+    # Heavy libraries are imported lazily, optionally import them in the background
+    if os.environ.get("WARMUP", "0") == "1":
+        warmup.start_warm_up()
+    yield
+    retention.stop_sweeper()
+    executor.shutdown()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = ["localhost"]
 
@@ -17,9 +39,12 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(RequestIdMiddleware)
 
 app.include_router(solar_router, prefix="/api/solar", tags=["solar"])
 app.include_router(energy_router, prefix="/api/energy", tags=["energy"])
+app.include_router(portfolio_router, prefix="/api/portfolio", tags=["portfolio"])
+app.include_router(summary_router, prefix="/api/summary", tags=["summary"])
 
 
 @app.get("/")
@@ -30,3 +55,35 @@ def root():
 @app.get("/api/")
 def api():
     return {"message": "Hello Api!"}
+
+
+@app.get("/api/health")
+def health():
+    return {"status": "ok", "warm": warmup.is_warm()}
+
+
+@app.get("/api/upstream")
+def upstream_state():
+    """
+    Return the state of the circuit breakers, rate limiters and counters of the
+    external apis of this worker.
+    """
+    return {"upstreams": upstream.get_state()}
+
+
+@app.get("/api/cache")
+def cache_stats():
+    """
+    Return the hit and miss statistics and the size of the result cache of this
+    worker.
+    """
+    return result_cache.get_stats()
+
+
+@app.get("/api/executor")
+def executor_stats():
+    """
+    Return the analyses running and queued in the pool of this worker, the rejected
+    uploads and the time the analyses waited in the queue.
+    """
+    return executor.get_stats()
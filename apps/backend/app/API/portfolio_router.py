@@ -0,0 +1,128 @@
+import os
+from typing import Annotated
+
+from fastapi import APIRouter, File, Form, HTTPException, UploadFile
+from fastapi.responses import FileResponse
+from tools.energy_analysis_lib import portfolio
+from tools.energy_analysis_lib.constants import MEDIA_TYPES
+from tools.utils import logger
+
+from .formats import available_formats
+
+router = APIRouter()
+
+
+@router.post("/")
+def process_portfolio(
+    archive: Annotated[UploadFile, File()],
+    location: Annotated[str | None, Form()] = None,
+    peakpower: Annotated[float | None, Form()] = None,
+    mountingplace: Annotated[str | None, Form()] = None,
+    loss: Annotated[float | None, Form()] = None,
+    angle: Annotated[float | None, Form()] = None,
+    aspect: Annotated[float | None, Form()] = None,
+    file_format: Annotated[str, Form()] = "parquet",
+):
+    """
+    Start the analysis of a zip archive with the consumption files of many meters.
+    With the parameters of an installation, every meter gets a solar analysis with
+    it; without them, an energy analysis
+
+    :param archive: zip archive of consumption files
+    :param location: location of the shared installation
+    :param peakpower: peak power of the shared installation
+    :param mountingplace: mounting place of the shared installation
+    :param loss: loss of the shared installation
+    :param angle: angle of the shared installation
+    :param aspect: azimuth of the shared installation
+    :param file_format: format of the results, "parquet" or "csv"
+    :return: id of the job
+    """
+    logger.info("Processing request")
+
+    solar_parameters = {
+        "location": location,
+        "peakpower": peakpower,
+        "mountingplace": mountingplace,
+        "loss": loss,
+        "angle": angle,
+        "aspect": aspect,
+    }
+    missing = [name for name, value in solar_parameters.items() if value is None]
+    if len(missing) == len(solar_parameters):
+        solar_parameters = None
+    elif missing:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Missing installation parameters: {', '.join(missing)}",
+        )
+
+    if file_format not in ("parquet", "csv") or (
+        file_format not in available_formats().values()
+    ):
+        raise HTTPException(
+            status_code=400, detail=f"Unsupported results format: {file_format}"
+        )
+
+    try:
+        jobId = portfolio.start_job(archive.file, solar_parameters, file_format)
+    except ValueError as e:
+        logger.error(e)
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(e)
+        # Return 500 error
+        raise HTTPException(status_code=500, detail=str(e))
+
+    logger.info("Request processed")
+    return {"jobId": jobId}
+
+
+@router.get("/{jobId}")
+def get_portfolio(jobId: str):
+    """
+    Get the progress of a portfolio job, and the totals of the portfolio when it is
+    done
+
+    :param jobId: id of the job
+    :return: state of the job in json format
+    """
+    logger.info("Processing request")
+
+    try:
+        job = portfolio.get_job(jobId)
+    except FileNotFoundError as e:
+        logger.error(e)
+        raise HTTPException(status_code=404, detail=str(e))
+
+    logger.info("Request processed")
+    return job
+
+
+@router.get("/{jobId}/results")
+def get_portfolio_results(jobId: str):
+    """
+    Get the results of every meter of a finished portfolio job, with the totals in
+    the last row
+
+    :param jobId: id of the job
+    :return: results in parquet or csv format
+    """
+    logger.info("Processing request")
+
+    try:
+        path = portfolio.get_job_results(jobId)
+    except FileNotFoundError as e:
+        logger.error(e)
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        logger.error(e)
+        raise HTTPException(status_code=409, detail=str(e))
+
+    file_format = os.path.splitext(path)[1][1:]
+    logger.info("Request processed")
+    return FileResponse(
+        path,
+        media_type=MEDIA_TYPES[file_format],
+        filename=f"portfolio_{jobId}.{file_format}",
+    )
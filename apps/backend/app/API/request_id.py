@@ -0,0 +1,35 @@
+import uuid
+
+from tools.utils import log_context
+
+HEADER = b"x-request-id"
+
+
+class RequestIdMiddleware:
+    """
+    Give every request an id, taken from the X-Request-ID header or a new one. The
+    id is added to the log records of the request and returned in the response
+    header, so a request can be found in the logs of every stage.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        requestId = dict(scope["headers"]).get(HEADER, b"").decode("latin-1")[:64]
+        requestId = requestId or uuid.uuid4().hex
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = [
+                    *message["headers"],
+                    (HEADER, requestId.encode("latin-1")),
+                ]
+            await send(message)
+
+        with log_context(requestId=requestId):
+            await self.app(scope, receive, send_with_id)
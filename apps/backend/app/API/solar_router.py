@@ -1,13 +1,51 @@
+import math
 import zipfile
-from io import BytesIO, StringIO
+from io import BytesIO
 from typing import Annotated
 
-from fastapi import APIRouter, File, Form, HTTPException, Response, UploadFile
-from tools.energy_analysis_lib import core
+from fastapi import (
+    APIRouter,
+    Body,
+    File,
+    Form,
+    Header,
+    HTTPException,
+    Query,
+    Response,
+    UploadFile,
+)
+from tools import upstream
+from tools.energy_analysis_lib import core, executor
 from tools.utils import logger
 
+from .errors import saturated_error
+from .formats import negotiate_format, tabular_response
+from .uploads import open_upload
+
 router = APIRouter()
 
+DEFAULT_BATTERY_CAPACITIES = [0, 2.5, 5, 7.5, 10]
+MAX_BATTERY_CAPACITIES = 100
+MAX_GEOCODE_LOCATIONS = 1000
+
+
+def upstream_error(e: upstream.UpstreamError) -> HTTPException:
+    """
+    Return the http error of a failed request to an external api: 503 if the api is
+    unavailable, 400 if it rejected the parameters and 502 otherwise.
+
+    :param e: The error of the external api
+    """
+    if isinstance(e, upstream.UpstreamUnavailableError):
+        return HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
+    if e.status_code is not None and 400 <= e.status_code < 500:
+        return HTTPException(status_code=400, detail=str(e))
+    return HTTPException(status_code=502, detail=str(e))
+
 
 @router.get("/")
 def root():
@@ -23,6 +61,8 @@ async def process(
     loss: Annotated[float, Form()],
     angle: Annotated[float, Form()],
     aspect: Annotated[float, Form()],
+    render_plots: Annotated[bool, Form()] = False,
+    multi_year: Annotated[bool, Form()] = False,
 ):
     """
     Process the consumption file and the form data. If some exception is raised,
@@ -35,17 +75,36 @@ async def process(
     :param loss: loss of the installation
     :param angle: angle of the installation
     :param aspect: azimuth of the installation
+    :param render_plots: render the png plots now instead of on their first request
+    :param multi_year: also get the production of every year, for the production
+        statistics
     :return: None
     """
     logger.info("Processing request")
 
-    consumption_file = await consumption_file.read()
-    consumption_file = StringIO(consumption_file.decode("utf-8"))
+    consumption_file = open_upload(consumption_file)
 
     try:
-        analysisId = core.solar_calculation(
-            consumption_file, location, peakpower, mountingplace, loss, angle, aspect
+        # The analysis runs in the pool, the event loop keeps answering the rest of
+        # the requests
+        analysisId = await executor.run(
+            core.solar_calculation,
+            consumption_file,
+            location,
+            peakpower,
+            mountingplace,
+            loss,
+            angle,
+            aspect,
+            render_plots=render_plots,
+            multi_year=multi_year,
         )
+    except executor.SaturatedError as e:
+        logger.warning(e)
+        raise saturated_error(e)
+    except upstream.UpstreamError as e:
+        logger.error(e)
+        raise upstream_error(e)
     except Exception as e:
         logger.exception(e)
         # Return 500 error
@@ -56,49 +115,51 @@ async def process(
 
 
 @router.get("/monthly_production/{analysisId}")
-def monthly_production(analysisId: str):
+def monthly_production(analysisId: str, accept: Annotated[str | None, Header()] = None):
     """
     Get the monthly production of the analysisId
 
     :param analysisId: id of the analysis
-    :return: monthly production in csv format
+    :param accept: Accept header, to get the data in arrow or parquet format
+    :return: monthly production in csv format by default
     """
     logger.info("Processing request")
 
+    file_format = negotiate_format(accept)
     try:
-        production = core.get_monthly_production(analysisId)
+        production = core.get_monthly_production(analysisId, file_format)
     except Exception as e:
         logger.error(e)
         # Return 500 error
         raise HTTPException(status_code=500, detail=str(e))
 
-    headers = {"Content-Disposition": 'attachment; filename="monthly_production.csv"'}
-
     logger.info("Request processed")
-    return Response(content=production, media_type="text/csv", headers=headers)
+    return tabular_response(production, "monthly_production", file_format)
 
 
 @router.get("/monthly_consumption/{analysisId}")
-def monthly_consumption(analysisId: str):
+def monthly_consumption(
+    analysisId: str, accept: Annotated[str | None, Header()] = None
+):
     """
     Get the monthly consumption of the analysisId
 
     :param analysisId: id of the analysis
-    :return: monthly consumption in csv format
+    :param accept: Accept header, to get the data in arrow or parquet format
+    :return: monthly consumption in csv format by default
     """
     logger.info("Processing request")
 
+    file_format = negotiate_format(accept)
     try:
-        consumption = core.get_monthly_consumption(analysisId)
+        consumption = core.get_monthly_consumption(analysisId, file_format)
     except Exception as e:
         logger.error(e)
         # Return 500 error
         raise HTTPException(status_code=500, detail=str(e))
 
-    headers = {"Content-Disposition": 'attachment; filename="monthly_consumption.csv"'}
-
     logger.info("Request processed")
-    return Response(content=consumption, media_type="text/csv", headers=headers)
+    return tabular_response(consumption, "monthly_consumption", file_format)
 
 
 @router.get("/monthly_consumption_production_plot/{analysisId}")
@@ -127,6 +188,51 @@ def monthly_consumption_production_plot(analysisId: str):
     return Response(content=plot, media_type="image/png", headers=headers)
 
 
+@router.get("/monthly_consumption_production_data/{analysisId}")
+def monthly_consumption_production_data(analysisId: str):
+    """
+    Get the data of the monthly consumption and production plot of the analysisId
+
+    :param analysisId: id of the analysis
+    :return: columns 'Month', 'Energy_consumption' and 'Energy_production' in json
+        format
+    """
+    logger.info("Processing request")
+
+    try:
+        data = core.get_monthly_consumption_production_data(analysisId)
+    except Exception as e:
+        logger.error(e)
+        # Return 500 error
+        raise HTTPException(status_code=500, detail=str(e))
+
+    logger.info("Request processed")
+    return data
+
+
+@router.get("/results_monthly_data/{analysisId}")
+def results_monthly_data(analysisId: str):
+    """
+    Get the data of the monthly plots of the analysisId: the average hourly
+    consumption and production of each month
+
+    :param analysisId: id of the analysis
+    :return: columns 'Month', 'Hour', 'Energy_consumption' and 'Energy_production'
+        in json format
+    """
+    logger.info("Processing request")
+
+    try:
+        data = core.get_monthly_profiles_data(analysisId)
+    except Exception as e:
+        logger.error(e)
+        # Return 500 error
+        raise HTTPException(status_code=500, detail=str(e))
+
+    logger.info("Request processed")
+    return data
+
+
 @router.get("/results_monthly_plots/{analysisId}")
 def results_monthly_plots(analysisId: str):
     """
@@ -183,29 +289,307 @@ def self_percent_ratios(analysisId: str):
     return ratios
 
 
+@router.get("/production_statistics/{analysisId}")
+def production_statistics(analysisId: str):
+    """
+    Get the mean, P50 and P90 of the production, self consumption and surplus of
+    the analysisId across the years of its multi-year production
+
+    :param analysisId: id of the analysis
+    :return: production statistics in json format
+    """
+    logger.info("Processing request")
+
+    try:
+        statistics = core.get_production_statistics(analysisId)
+    except FileNotFoundError as e:
+        logger.error(e)
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error(e)
+        # Return 500 error
+        raise HTTPException(status_code=500, detail=str(e))
+
+    logger.info("Request processed")
+    return statistics
+
+
+@router.get("/profiles/{analysisId}")
+def profiles(
+    analysisId: str,
+    months: Annotated[list[int] | None, Query()] = None,
+    day_types: Annotated[list[str] | None, Query()] = None,
+    group_by: str | None = None,
+):
+    """
+    Get the average daily profiles of consumption, production, self consumption and
+    surplus of a group of days of the analysisId, e.g. the weekends of summer
+
+    :param analysisId: id of the analysis
+    :param months: months of the days, every month if not given
+    :param day_types: "weekday", "weekend" or "holiday", every type if not given
+    :param group_by: "month", "day_type" or "season" for one profile of each, a
+        single profile if not given
+    :return: profiles in json format
+    """
+    logger.info("Processing request")
+
+    try:
+        results = core.get_profiles(analysisId, months, day_types, group_by)
+    except ValueError as e:
+        logger.error(e)
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileNotFoundError as e:
+        logger.error(e)
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error(e)
+        # Return 500 error
+        raise HTTPException(status_code=500, detail=str(e))
+
+    logger.info("Request processed")
+    return results
+
+
 @router.get("/results_time_slot_solar/{analysisId}")
-def results_time_slot_solar(analysisId: str):
+def results_time_slot_solar(
+    analysisId: str, accept: Annotated[str | None, Header()] = None
+):
     """
     Get the time slot solar of the analysisId
 
     :param analysisId: id of the analysis
-    :return: time slot solar in csv format
+    :param accept: Accept header, to get the data in arrow or parquet format
+    :return: time slot solar in csv format by default
     """
     logger.info("Processing request")
 
+    file_format = negotiate_format(accept)
     try:
-        solar = core.get_results_time_slot_solar(analysisId)
+        solar = core.get_results_time_slot_solar(analysisId, file_format)
     except Exception as e:
         logger.error(e)
         # Return 500 error
         raise HTTPException(status_code=500, detail=str(e))
 
-    headers = {
-        "Content-Disposition": 'attachment; filename="results_time_slot_solar.csv"'
-    }
+    logger.info("Request processed")
+    return tabular_response(solar, "results_time_slot_solar", file_format)
+
+
+@router.get("/hourly_data/{analysisId}")
+def hourly_data(analysisId: str, accept: Annotated[str | None, Header()] = None):
+    """
+    Get the hourly consumption and production of the analysisId. Big exports are
+    streamed
+
+    :param analysisId: id of the analysis
+    :param accept: Accept header, to get the data in arrow or parquet format
+    :return: hourly consumption and production in csv format by default
+    """
+    logger.info("Processing request")
+
+    file_format = negotiate_format(accept)
+    try:
+        hourly = core.get_hourly_data(analysisId, file_format)
+    except Exception as e:
+        logger.error(e)
+        # Return 500 error
+        raise HTTPException(status_code=500, detail=str(e))
+
+    logger.info("Request processed")
+    return tabular_response(hourly, "hourly_data", file_format)
+
+
+@router.get("/battery/{analysisId}")
+def battery(
+    analysisId: str,
+    capacities: Annotated[list[float] | None, Query()] = None,
+    charge_power: float | None = None,
+    discharge_power: float | None = None,
+    efficiency: float = 0.9,
+    min_soc: float = 0.1,
+):
+    """
+    Simulate a battery for each capacity of the analysisId
+
+    :param analysisId: id of the analysis
+    :param capacities: battery capacities in kWh
+    :param charge_power: max charge power in kW, half the capacity by default
+    :param discharge_power: max discharge power in kW, half the capacity by default
+    :param efficiency: round trip efficiency
+    :param min_soc: minimum state of charge as a fraction of the capacity
+    :return: results for each capacity in json format
+    """
+    logger.info("Processing request")
+
+    if capacities is None:
+        capacities = DEFAULT_BATTERY_CAPACITIES
+
+    if len(capacities) > MAX_BATTERY_CAPACITIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_BATTERY_CAPACITIES} capacities can be simulated",
+        )
+
+    try:
+        results = core.get_battery_results(
+            analysisId,
+            capacities,
+            charge_power=charge_power,
+            discharge_power=discharge_power,
+            efficiency=efficiency,
+            min_soc=min_soc,
+        )
+    except ValueError as e:
+        logger.error(e)
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(e)
+        # Return 500 error
+        raise HTTPException(status_code=500, detail=str(e))
+
+    logger.info("Request processed")
+    return results
+
+
+@router.get("/load_shifting/{analysisId}")
+def load_shifting(
+    analysisId: str,
+    budget: float,
+    max_power: float,
+    start_hour: int = 1,
+    end_hour: int = 24,
+    objective: str = "self_consumption",
+    time_slot: str = "nocturna",
+):
+    """
+    Move flexible consumption (dishwashers, water heating, EV charging...) of every
+    day of the analysisId to the surpluses or the cheapest hours. Works with solar
+    and energy analyses
+
+    :param analysisId: id of the analysis
+    :param budget: flexible consumption that can be moved each day in kWh
+    :param max_power: max flexible consumption of an hour in kWh
+    :param start_hour: first hour (1 to 24) where the flexible consumption can run
+    :param end_hour: last hour (1 to 24) where the flexible consumption can run,
+        before start_hour to wrap around midnight
+    :param objective: "self_consumption" to only use the surpluses, "cost" to also
+        use the cheapest time slots
+    :param time_slot: time slot scheme of the prices
+    :return: results before and after moving the consumption in json format
+    """
+    logger.info("Processing request")
+
+    try:
+        results = core.get_load_shifting_results(
+            analysisId,
+            budget,
+            max_power,
+            start_hour=start_hour,
+            end_hour=end_hour,
+            objective=objective,
+            time_slot=time_slot,
+        )
+    except ValueError as e:
+        logger.error(e)
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileNotFoundError as e:
+        logger.error(e)
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error(e)
+        # Return 500 error
+        raise HTTPException(status_code=500, detail=str(e))
+
+    logger.info("Request processed")
+    return results
+
+
+@router.get("/series/{analysisId}")
+def series(
+    analysisId: str,
+    start: Annotated[str | None, Query(alias="from")] = None,
+    end: Annotated[str | None, Query(alias="to")] = None,
+    max_points: int = 1000,
+    measures: Annotated[list[str] | None, Query()] = None,
+):
+    """
+    Get the hourly consumption and production of the analysisId between two times,
+    downsampled to max_points keeping the shape of the series. Works with solar and
+    energy analyses
+
+    :param analysisId: id of the analysis
+    :param start: first time, e.g. 2023-03-01T00:00, in the dates of the
+        consumption file
+    :param end: last time, included
+    :param max_points: max points of each measure, from 3 to 10000
+    :param measures: "consumption" and/or "production", both if not given
+    :return: points of every measure in json format
+    """
+    logger.info("Processing request")
+
+    try:
+        results = core.get_series(
+            analysisId,
+            start=start,
+            end=end,
+            max_points=max_points,
+            measures=measures,
+        )
+    except ValueError as e:
+        logger.error(e)
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileNotFoundError as e:
+        logger.error(e)
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error(e)
+        # Return 500 error
+        raise HTTPException(status_code=500, detail=str(e))
+
+    logger.info("Request processed")
+    return results
+
+
+@router.delete("/analysis/{analysisId}")
+def delete_analysis(analysisId: str):
+    """
+    Delete every file of the analysisId
+
+    :param analysisId: id of the analysis
+    """
+    logger.info("DELETE /api/solar/analysis/%s", analysisId)
+
+    message = core.delete_solar_analysis(analysisId)
+    return {"message": message}
+
+
+@router.post("/geocode")
+def geocode(locations: Annotated[list[str], Body(embed=True)]):
+    """
+    Get the coordinates of a list of locations concurrently, e.g. to warm the cache
+    before processing a portfolio
+
+    :param locations: locations to geocode
+    :return: coordinates and source of each location, or its error
+    """
+    logger.info("Processing request")
+
+    if len(locations) > MAX_GEOCODE_LOCATIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_GEOCODE_LOCATIONS} locations per request",
+        )
+
+    try:
+        results = core.geocode_locations(locations)
+    except Exception as e:
+        logger.error(e)
+        # Return 500 error
+        raise HTTPException(status_code=500, detail=str(e))
 
     logger.info("Request processed")
-    return Response(content=solar, media_type="text/csv", headers=headers)
+    return {"results": results}
 
 
 @router.get("/analysis")
@@ -0,0 +1,70 @@
+from fastapi import APIRouter, HTTPException
+from tools.energy_analysis_lib import core
+from tools.utils import logger
+
+router = APIRouter()
+
+
+@router.get("/")
+def get_summary(
+    kind: str | None = None,
+    location: str | None = None,
+    min_consumption: float | None = None,
+    max_consumption: float | None = None,
+    min_production: float | None = None,
+    max_production: float | None = None,
+    min_self_consumption_ratio: float | None = None,
+    max_self_consumption_ratio: float | None = None,
+    since: float | None = None,
+    until: float | None = None,
+    sort: str = "-updated_at",
+    limit: int = 100,
+    offset: int = 0,
+):
+    """
+    Return the annual totals of the analyses, a page at a time, and the totals and
+    means of every analysis matching the filters
+
+    :param kind: "solar" or "energy"
+    :param location: location of the solar analyses
+    :param min_consumption: min annual consumption in kWh
+    :param max_consumption: max annual consumption in kWh
+    :param min_production: min annual production in kWh
+    :param max_production: max annual production in kWh
+    :param min_self_consumption_ratio: min share of the production consumed
+    :param max_self_consumption_ratio: max share of the production consumed
+    :param since: min update time of the analyses, as a unix timestamp
+    :param until: max update time of the analyses, as a unix timestamp
+    :param sort: column to sort by, prefixed by "-" for descending order
+    :param limit: max analyses returned, up to 1000
+    :param offset: analyses skipped
+    :return: total analyses, totals, means and the page of analyses in json format
+    """
+    logger.info("Processing request")
+
+    try:
+        results = core.get_summary(
+            kind=kind,
+            location=location,
+            min_consumption=min_consumption,
+            max_consumption=max_consumption,
+            min_production=min_production,
+            max_production=max_production,
+            min_self_consumption_ratio=min_self_consumption_ratio,
+            max_self_consumption_ratio=max_self_consumption_ratio,
+            since=since,
+            until=until,
+            sort=sort,
+            limit=limit,
+            offset=offset,
+        )
+    except ValueError as e:
+        logger.error(e)
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(e)
+        # Return 500 error
+        raise HTTPException(status_code=500, detail=str(e))
+
+    logger.info("Request processed")
+    return results
@@ -0,0 +1,22 @@
+from io import StringIO, TextIOWrapper
+
+from fastapi import UploadFile
+from tools.energy_analysis_lib.constants import EXECUTOR
+
+
+def open_upload(upload: UploadFile):
+    """
+    Open an uploaded consumption file as text. The file is read as it is parsed, so
+    big uploads, spooled to disk by the server, are never held whole in memory. The
+    process pool pickles the arguments of the analyses, so it gets a copy instead.
+
+    :param upload: The uploaded file
+    :return: Text file object at the start of the file
+    """
+    upload.file.seek(0)
+    if EXECUTOR["kind"] == "process":
+        return StringIO(upload.file.read().decode("utf-8"))
+
+    # Without newline translation, the text is the same as decoding the whole file.
+    # pandas compares the name of the encoding with the one of read_csv
+    return TextIOWrapper(upload.file, encoding="UTF-8", newline="")
@@ -0,0 +1,201 @@
+"""
+Run the energy or the solar analysis of consumption files without the api, e.g. for
+nightly backfills:
+
+    cd apps/backend/app && python -m tools.batch consumption/ meters.zip file.csv \
+        --output results.parquet --workers 8
+
+With the parameters of an installation (--location, --peakpower, --mountingplace,
+--loss, --angle and --aspect) every file gets a solar analysis with its production.
+The rows of the analyzed files are appended to a journal next to the output, so an
+interrupted run resumes where it stopped: files analyzed by a previous run are
+skipped unless they changed.
+"""
+
+import argparse
+import json
+import os
+import shutil
+
+from dotenv import load_dotenv
+from tools.energy_analysis_lib import core, portfolio
+from tools.energy_analysis_lib import utils as lib_utils
+from tools.energy_analysis_lib.constants import PATHS
+
+
+def journal_path(output: str) -> str:
+    return f"{output}.journal"
+
+
+def load_journal(path: str) -> dict[str, dict]:
+    """
+    Load the rows of the files analyzed by previous runs. Failed files are analyzed
+    again.
+
+    :param path: The path of the journal
+    :return: dict meter key -> row
+    """
+    rows = {}
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line cut by an interruption
+                    continue
+                if row["status"] == "ok":
+                    rows[row["key"]] = row
+    except FileNotFoundError:
+        pass
+
+    return rows
+
+
+def use_production_files(
+    solar_parameters: dict, hourly: str | None, monthly: str | None
+) -> None:
+    """
+    Use PVGIS files of the installation, downloaded before, instead of the api.
+
+    :param solar_parameters: The parameters of the installation
+    :param hourly: The path of the hourly production (seriescalc csv)
+    :param monthly: The path of the monthly production (PVcalc csv)
+    """
+    productionId = core.get_solar_analysis_id(**solar_parameters)
+    for path, source in [
+        ("production_hourly", hourly),
+        ("production_monthly", monthly),
+    ]:
+        if source is None:
+            continue
+        with (
+            open(source, "rb") as f,
+            lib_utils.atomic_write(
+                os.path.join(PATHS[path], f"{productionId}.csv"), "wb"
+            ) as copy,
+        ):
+            shutil.copyfileobj(f, copy)
+
+
+def print_summary(state: dict) -> None:
+    """
+    Print the counts, the throughput, the totals and the time spent in every stage
+    of a run.
+    """
+    analyzed = state["done"] - state["skipped"]
+    print(
+        f"{state['done']} files: {analyzed} analyzed, {state['skipped']} skipped, "
+        f"{state['failed']} failed in {state['elapsed_seconds']:.1f}s "
+        f"({state['meters_per_second']} files/s)"
+    )
+    print(f"Results: {state['output']}")
+
+    print("Totals (kWh):")
+    for column, total in state["totals"].items():
+        if total:
+            print(f"  {column:<24} {total:>14.3f}")
+
+    # Stages of the workers add up the time of every process, so their total can be
+    # longer than the run
+    timings = state["timings"]
+    total_seconds = sum(timings.values()) or 1
+    print("Stages:")
+    print(f"  {'stage':<16} {'seconds':>10} {'share':>7} {'per file':>10}")
+    for stage, seconds in sorted(timings.items(), key=lambda item: -item[1]):
+        print(
+            f"  {stage:<16} {seconds:>10.3f} {seconds / total_seconds:>7.1%} "
+            f"{seconds / max(analyzed, 1):>10.3f}"
+        )
+
+
+def main(argv: list[str] | None = None) -> int:
+    # .env variables read at run time, e.g. POSITIONSTACK_ACCESS_KEY or AWS_*
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(
+        description="Run the energy or the solar analysis of consumption files"
+    )
+    parser.add_argument(
+        "paths", nargs="+", help="Consumption csv files, folders or zip archives"
+    )
+    parser.add_argument(
+        "--output",
+        default="results.csv",
+        help="Results of every file, .csv or .parquet (default: results.csv)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Processes (default: PORTFOLIO_WORKERS or every core)",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Analyze every file again, ignoring the results of previous runs",
+    )
+
+    solar = parser.add_argument_group("solar analysis")
+    solar.add_argument("--location")
+    solar.add_argument("--peakpower", type=float)
+    solar.add_argument("--mountingplace")
+    solar.add_argument("--loss", type=float)
+    solar.add_argument("--angle", type=float)
+    solar.add_argument("--aspect", type=float)
+    solar.add_argument(
+        "--production-hourly", help="PVGIS hourly production, instead of the api"
+    )
+    solar.add_argument(
+        "--production-monthly", help="PVGIS monthly production, instead of the api"
+    )
+    args = parser.parse_args(argv)
+
+    for path in args.paths:
+        if not os.path.exists(path):
+            parser.error(f"{path} does not exist")
+
+    solar_parameters = {
+        name: getattr(args, name) for name in portfolio.SOLAR_PARAMETERS
+    }
+    missing = [name for name, value in solar_parameters.items() if value is None]
+    if len(missing) == len(solar_parameters):
+        solar_parameters = None
+    elif missing:
+        parser.error(f"Missing installation parameters: {', '.join(missing)}")
+
+    if args.production_hourly or args.production_monthly:
+        if solar_parameters is None:
+            parser.error("The production files need the installation parameters")
+        use_production_files(
+            solar_parameters, args.production_hourly, args.production_monthly
+        )
+
+    journal = journal_path(args.output)
+    if args.restart and os.path.exists(journal):
+        os.remove(journal)
+    completed = load_journal(journal)
+    if completed:
+        print(f"Resuming: {len(completed)} files analyzed by previous runs")
+
+    with open(journal, "a") as f:
+
+        def on_row(row: dict) -> None:
+            f.write(json.dumps(row) + "\n")
+            f.flush()
+
+        state = portfolio.run_portfolio(
+            args.paths,
+            args.output,
+            solar_parameters,
+            workers=args.workers,
+            completed=completed,
+            on_row=on_row,
+        )
+
+    print_summary(state)
+    return 1 if state["failed"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,457 @@
+"""
+Dependency graph of the artifacts of an analysis.
+
+Every derived artifact records in the manifest of its analysis a fingerprint of
+its inputs, of the code that builds it and of its config (e.g. TIME_SLOTS). An
+artifact is stale when its fingerprint changes or its files are missing, and only
+stale artifacts are rebuilt.
+
+Rebuild the stale artifacts of every analysis, e.g. after changing the tariffs:
+
+    python -m tools.energy_analysis_lib.artifacts [--dry-run] [analysisId ...]
+"""
+
+import argparse
+import functools
+import hashlib
+import importlib
+import inspect
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+from tools.energy_analysis_lib import result_cache, storage
+from tools.energy_analysis_lib import utils as lib_utils
+from tools.utils import log_context, logger
+
+from .constants import HOLIDAYS, PATHS, TIME_SLOTS
+
+energy = lib_utils.LazyModule("tools.energy_analysis_lib.energy")
+solar = lib_utils.LazyModule("tools.energy_analysis_lib.solar")
+
+# Bump the version of a node to rebuild it when a change of its code is not
+# detected from the source of its functions. Optional inputs only exist for some
+# analyses, e.g. the production of a solar analysis
+GRAPH = {
+    # Sources: their fingerprint is the digest of their files
+    "consumption": {
+        "files": [
+            ("consumption_parsed_hourly", "{analysisId}.csv"),
+            ("consumption_parsed_monthly", "{analysisId}.csv"),
+        ],
+    },
+    "production": {
+        "files": [
+            ("production_hourly", "{analysisId}.csv"),
+            ("production_monthly", "{analysisId}.csv"),
+        ],
+    },
+    # Only fetched for multi-year analyses
+    "production_series": {
+        "files": [("production_series", "{analysisId}.csv")],
+    },
+    # Derived artifacts, in build order
+    "production_parsed": {
+        "inputs": ["production"],
+        "files": [
+            ("production_parsed_hourly", "{analysisId}.csv"),
+            ("production_parsed_monthly", "{analysisId}.csv"),
+        ],
+        "code": [
+            "tools.energy_analysis_lib.solar.parse_hourly_production_file",
+            "tools.energy_analysis_lib.solar.parse_monthly_production_file",
+        ],
+        "version": 1,
+    },
+    "production_series_parsed": {
+        "inputs": ["production_series"],
+        "files": [("production_parsed_series", "{analysisId}.npz")],
+        "code": ["tools.energy_analysis_lib.solar.parse_production_series_file"],
+        "version": 1,
+    },
+    "self_consumption": {
+        "inputs": ["consumption", "production_parsed"],
+        "files": [("results", "{analysisId}.csv")],
+        "code": ["tools.energy_analysis_lib.solar.plot_self_consumption_monthly"],
+        "version": 1,
+    },
+    "profile_cube": {
+        "inputs": ["consumption", "production_parsed"],
+        "files": [("results_profiles", "{analysisId}.npz")],
+        "code": ["tools.energy_analysis_lib.solar.build_profile_cube"],
+        "config": HOLIDAYS,
+        "version": 1,
+    },
+    "time_slots": {
+        "inputs": ["consumption"],
+        # Surpluses and consumption after self consumption of solar analyses
+        "optional_inputs": ["production_parsed"],
+        "files": [("time_slots", "{analysisId}.csv")],
+        "code": [
+            "tools.energy_analysis_lib.solar.process_results_time_slot_solar",
+            "tools.energy_analysis_lib.energy.process_results_time_slot_energy",
+            (
+                "tools.energy_analysis_lib.energy."
+                "process_results_time_slot_energy_with_generation"
+            ),
+            "tools.energy_analysis_lib.utils.is_within_time_slot",
+        ],
+        "config": TIME_SLOTS,
+        "version": 1,
+    },
+    # Plots are rendered on their first request, so their files are optional
+    "plots": {
+        "inputs": ["consumption", "production_parsed"],
+        "files": [],
+        "code": [
+            "tools.energy_analysis_lib.solar.plot_consumption_production_chart",
+            "tools.energy_analysis_lib.solar.plot_monthly_profiles",
+            "tools.energy_analysis_lib.solar.load_monthly_profiles",
+            "tools.energy_analysis_lib.solar.load_consumption_production_monthly",
+        ],
+        "version": 1,
+    },
+}
+
+
+def _path(path: str, name: str, analysisId: str) -> str:
+    return os.path.join(PATHS[path], name.format(analysisId=analysisId))
+
+
+@functools.lru_cache(maxsize=1024)
+def _digest(path: str, mtime_ns: int, size: int) -> str:
+    # Files are replaced atomically, so a file with the same path, modification
+    # time and size has the same contents
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _file_digest(path: str) -> str | None:
+    path = storage.fetch(path)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return _digest(path, stat.st_mtime_ns, stat.st_size)
+
+
+@functools.cache
+def _code_digest(names: tuple[str, ...]) -> str:
+    digest = hashlib.sha256()
+    for name in names:
+        module, function = name.rsplit(".", 1)
+        digest.update(
+            inspect.getsource(
+                getattr(importlib.import_module(module), function)
+            ).encode("utf-8")
+        )
+    return digest.hexdigest()
+
+
+@functools.cache
+def _ancestors(node: str) -> frozenset[str]:
+    # The node and every node it is built from
+    return frozenset([node]).union(
+        *(
+            _ancestors(input_node)
+            for input_node in GRAPH[node].get("inputs", [])
+            + GRAPH[node].get("optional_inputs", [])
+        )
+    )
+
+
+def fingerprints(
+    analysisId: str, nodes: list[str] | None = None
+) -> dict[str, str | None]:
+    """
+    Return the current fingerprint of the nodes of an analysis.
+
+    :param analysisId: The id of the analysis
+    :param nodes: The nodes, with the ones they are built from. Every node if None
+    :return: dict node -> fingerprint. None if the node does not apply to the
+        analysis, e.g. the production of an energy analysis
+    """
+    needed = (
+        frozenset().union(*(_ancestors(node) for node in nodes))
+        if nodes is not None
+        else GRAPH.keys()
+    )
+
+    results = {}
+    for node, spec in GRAPH.items():
+        if node not in needed:
+            continue
+        if "inputs" not in spec:
+            digests = [
+                _file_digest(_path(path, name, analysisId))
+                for path, name in spec["files"]
+            ]
+            results[node] = (
+                None
+                if None in digests
+                else hashlib.sha256("".join(digests).encode("utf-8")).hexdigest()
+            )
+            continue
+
+        inputs = [results[input_node] for input_node in spec["inputs"]]
+        if None in inputs:
+            results[node] = None
+            continue
+
+        fingerprint = {
+            "inputs": inputs
+            + [results[input_node] for input_node in spec.get("optional_inputs", [])],
+            "code": _code_digest(tuple(spec["code"])),
+            "config": spec.get("config"),
+            "version": spec["version"],
+        }
+        results[node] = hashlib.sha256(
+            json.dumps(fingerprint, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    return results
+
+
+def _manifest_path(analysisId: str) -> str:
+    return os.path.join(PATHS["manifests"], f"{analysisId}.json")
+
+
+def load_manifest(analysisId: str) -> dict[str, str]:
+    """
+    Return the fingerprints of the artifacts of an analysis when they were built.
+
+    :param analysisId: The id of the analysis
+    :return: dict node -> fingerprint, empty if there is no manifest
+    """
+    try:
+        with open(storage.fetch(_manifest_path(analysisId)), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def stale_nodes(
+    analysisId: str,
+    current: dict[str, str | None] | None = None,
+    nodes: list[str] | None = None,
+) -> list[str]:
+    """
+    Return the derived artifacts of an analysis that must be rebuilt, in build
+    order: their fingerprint changed, was never recorded or their files are
+    missing.
+
+    :param analysisId: The id of the analysis
+    :param current: The current fingerprints of the nodes checked, computed if None
+    :param nodes: The nodes checked. Every node if None
+    """
+    current = current if current is not None else fingerprints(analysisId, nodes)
+    manifest = load_manifest(analysisId)
+
+    return [
+        node
+        for node, spec in GRAPH.items()
+        if (nodes is None or node in nodes)
+        and "inputs" in spec
+        and current[node] is not None
+        and (
+            manifest.get(node) != current[node]
+            or not all(
+                os.path.exists(storage.fetch(_path(path, name, analysisId)))
+                for path, name in spec["files"]
+            )
+        )
+    ]
+
+
+def is_stale(analysisId: str, node: str) -> bool:
+    """
+    Check if an artifact of an analysis must be rebuilt. Only the artifact and the
+    ones it is built from are fingerprinted, as it is checked on reads.
+
+    :param analysisId: The id of the analysis
+    :param node: The name of the artifact in the graph, e.g. "time_slots"
+    """
+    return bool(stale_nodes(analysisId, nodes=[node]))
+
+
+def record(analysisId: str, nodes: list[str]) -> None:
+    """
+    Record the current fingerprints of artifacts that were just built. Call it
+    holding the lock of the analysis.
+
+    :param analysisId: The id of the analysis
+    :param nodes: The built artifacts
+    """
+    current = fingerprints(analysisId)
+    manifest = load_manifest(analysisId)
+    manifest.update({node: current[node] for node in nodes if current[node]})
+
+    with lib_utils.atomic_write(_manifest_path(analysisId), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def build_time_slots(analysisId: str) -> None:
+    """
+    Build the time slot results of a solar or an energy analysis.
+
+    :param analysisId: The id of the analysis
+    """
+    if os.path.exists(
+        storage.fetch(
+            os.path.join(PATHS["production_parsed_hourly"], f"{analysisId}.csv")
+        )
+    ):
+        solar.process_results_time_slot_solar(analysisId)
+        return
+
+    with open(
+        storage.fetch(
+            os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv")
+        ),
+        "rb",
+    ) as hourly:
+        with_generation = "Generation" in hourly.readline().decode("utf-8")
+    if with_generation:
+        energy.process_results_time_slot_energy_with_generation(analysisId)
+    else:
+        energy.process_results_time_slot_energy(analysisId)
+
+
+def remove_plots(analysisId: str) -> None:
+    """
+    Remove the plots of an analysis, they are rendered again on their next request.
+
+    :param analysisId: The id of the analysis
+    """
+    storage.delete(
+        [os.path.join(PATHS["plots_consumption_production_chart"], f"{analysisId}.png")]
+        + [
+            os.path.join(PATHS["plots_monthly"], f"{analysisId}_{month}.png")
+            for month in range(1, 13)
+        ]
+    )
+
+
+BUILDERS = {
+    "production_parsed": lambda analysisId: (
+        solar.parse_hourly_production_file(analysisId),
+        solar.parse_monthly_production_file(analysisId),
+    ),
+    "production_series_parsed": lambda analysisId: solar.parse_production_series_file(
+        analysisId
+    ),
+    "self_consumption": lambda analysisId: solar.plot_self_consumption_monthly(
+        analysisId, render_plots=False
+    ),
+    "profile_cube": lambda analysisId: solar.build_profile_cube(analysisId),
+    "time_slots": build_time_slots,
+    "plots": remove_plots,
+}
+
+
+def build(analysisId: str) -> list[str]:
+    """
+    Rebuild the stale artifacts of an analysis and record their fingerprints. Call
+    it holding the lock of the analysis.
+
+    :param analysisId: The id of the analysis
+    :return: The rebuilt artifacts
+    """
+    current = fingerprints(analysisId)
+    # The fingerprints only depend on the sources, so building a node does not
+    # change the fingerprints of the next ones
+    stale = stale_nodes(analysisId, current)
+
+    for node in stale:
+        logger.info("Building %s of %s", node, analysisId)
+        BUILDERS[node](analysisId)
+
+    if stale:
+        record(analysisId, stale)
+    return stale
+
+
+def rebuild(analysisId: str, dry_run: bool = False) -> list[str]:
+    """
+    Rebuild the stale artifacts of an analysis and share them with the rest of the
+    workers.
+
+    :param analysisId: The id of the analysis
+    :param dry_run: Only return the stale artifacts
+    :return: The stale artifacts
+    """
+    if dry_run:
+        return stale_nodes(analysisId)
+
+    started = time.time()
+    with lib_utils.file_lock(analysisId), log_context(analysisId=analysisId):
+        stale = build(analysisId)
+        if stale:
+            storage.publish_analysis(analysisId, since=started)
+            result_cache.invalidate(analysisId)
+
+    return stale
+
+
+def rebuild_all(
+    analysisIds: list[str] | None = None, dry_run: bool = False, workers: int = 1
+) -> dict[str, list[str]]:
+    """
+    Rebuild the stale artifacts of many analyses.
+
+    :param analysisIds: The ids of the analyses. All of them if None
+    :param dry_run: Only return the stale artifacts
+    :param workers: The number of analyses rebuilt at the same time
+    :return: dict analysisId -> stale artifacts, only for analyses with stale ones
+    """
+    if analysisIds is None:
+        analysisIds = [
+            file[:-4]
+            for file, _ in storage.listdir(PATHS["consumption_parsed_hourly"])
+            if file.endswith(".csv")
+        ]
+
+    def run(analysisId):
+        try:
+            return rebuild(analysisId, dry_run=dry_run)
+        except Exception as e:
+            logger.error("Could not rebuild %s: %s", analysisId, e)
+            return []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = dict(zip(analysisIds, executor.map(run, analysisIds)))
+
+    return {analysisId: stale for analysisId, stale in results.items() if stale}
+
+
+def main() -> int:
+    # .env variables read at run time, e.g. POSITIONSTACK_ACCESS_KEY or AWS_*
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(
+        description="Rebuild the stale artifacts of the analyses"
+    )
+    parser.add_argument("analysisIds", nargs="*", help="All the analyses if empty")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only list the stale artifacts"
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    results = rebuild_all(
+        args.analysisIds or None, dry_run=args.dry_run, workers=args.workers
+    )
+    for analysisId, stale in results.items():
+        print(f"{analysisId}: {', '.join(stale)}")
+    print(f"{len(results)} analyses {'stale' if args.dry_run else 'rebuilt'}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,168 @@
+import numpy as np
+import pandas as pd
+from tools.energy_analysis_lib import utils as lib_utils
+from tools.utils import logger
+
+from .constants import PATHS
+from .solar import load_merged_hourly_data
+
+
+def simulate_battery(
+    consumption: np.ndarray,
+    production: np.ndarray,
+    capacities: list[float],
+    charge_power: float | None = None,
+    discharge_power: float | None = None,
+    efficiency: float = 0.9,
+    min_soc: float = 0.1,
+) -> dict[str, np.ndarray]:
+    """
+    Simulates the hourly dispatch of a battery that stores the surpluses and
+    discharges them when consumption is greater than production.
+
+    All the capacities are simulated at the same time: the state of charge is a
+    vector with one element per capacity, so the sequential loop only runs once over
+    the hours no matter how many capacities are swept.
+
+    :param consumption: hourly consumption (kWh), sorted chronologically
+    :param production: hourly production (kWh), sorted chronologically
+    :param capacities: battery capacities to simulate (kWh)
+    :param charge_power: max charge power (kW). If None, half the capacity
+    :param discharge_power: max discharge power (kW). If None, half the capacity
+    :param efficiency: round trip efficiency, between 0 and 1
+    :param min_soc: minimum state of charge, as a fraction of the capacity
+    :return: dict with hourly arrays of shape (hours, capacities): 'grid_import',
+        'grid_export', 'charge', 'discharge' and 'soc'
+    """
+    if not 0 < efficiency <= 1:
+        raise ValueError("Efficiency must be between 0 and 1")
+    if not 0 <= min_soc < 1:
+        raise ValueError("Minimum state of charge must be between 0 and 1")
+
+    capacities = np.asarray(capacities, dtype=float)
+    if (capacities < 0).any():
+        raise ValueError("Capacities must be non-negative")
+
+    net = np.asarray(production, dtype=float) - np.asarray(consumption, dtype=float)
+    surplus = np.maximum(net, 0).tolist()
+    deficit = np.maximum(-net, 0).tolist()
+    n_hours = len(net)
+
+    # Losses are split evenly between charge and discharge
+    charge_efficiency = discharge_efficiency = np.sqrt(efficiency)
+
+    max_charge = (
+        capacities / 2
+        if charge_power is None
+        else np.full_like(capacities, charge_power)
+    )
+    max_discharge = (
+        capacities / 2
+        if discharge_power is None
+        else np.full_like(capacities, discharge_power)
+    )
+    soc_min = capacities * min_soc
+
+    soc = soc_min.copy()
+    charge = np.zeros((n_hours, len(capacities)))
+    discharge = np.zeros((n_hours, len(capacities)))
+    soc_hourly = np.zeros((n_hours, len(capacities)))
+
+    # The state of charge is a recurrence, so loop over the hours but keep every
+    # operation vectorized over the capacities
+    for hour in range(n_hours):
+        if surplus[hour] > 0:
+            charged = np.minimum(
+                np.minimum(surplus[hour], max_charge),
+                (capacities - soc) / charge_efficiency,
+            )
+            soc += charged * charge_efficiency
+            charge[hour] = charged
+        elif deficit[hour] > 0:
+            discharged = np.minimum(
+                np.minimum(deficit[hour], max_discharge),
+                (soc - soc_min) * discharge_efficiency,
+            )
+            soc -= discharged / discharge_efficiency
+            discharge[hour] = discharged
+        soc_hourly[hour] = soc
+
+    surplus = np.asarray(surplus)[:, None]
+    deficit = np.asarray(deficit)[:, None]
+
+    return {
+        "grid_import": deficit - discharge,
+        "grid_export": surplus - charge,
+        "charge": charge,
+        "discharge": discharge,
+        "soc": soc_hourly,
+    }
+
+
+def process_results_battery(
+    analysisId: str,
+    capacities: list[float],
+    charge_power: float | None = None,
+    discharge_power: float | None = None,
+    efficiency: float = 0.9,
+    min_soc: float = 0.1,
+) -> pd.DataFrame:
+    """
+    Calculates the self consumption, surpluses and the time slot grid imports of the
+    analysis for each battery capacity. A capacity of 0 gives the results without
+    storage.
+
+    :param analysisId: id of the user
+    :param capacities: battery capacities to simulate (kWh)
+    :param charge_power: max charge power (kW). If None, half the capacity
+    :param discharge_power: max discharge power (kW). If None, half the capacity
+    :param efficiency: round trip efficiency, between 0 and 1
+    :param min_soc: minimum state of charge, as a fraction of the capacity
+    :return: dataframe with one row per capacity
+    """
+    logger.info("Calculating battery results")
+
+    df = load_merged_hourly_data(analysisId)
+    consumption = df["Energy_consumption"].to_numpy()
+    production = df["Energy_production"].to_numpy()
+
+    simulation = simulate_battery(
+        consumption,
+        production,
+        capacities,
+        charge_power=charge_power,
+        discharge_power=discharge_power,
+        efficiency=efficiency,
+        min_soc=min_soc,
+    )
+    grid_import = simulation["grid_import"]
+    grid_export = simulation["grid_export"]
+
+    total_production = production.sum()
+    self_consumption = total_production - grid_export.sum(axis=0)
+
+    results = pd.DataFrame(
+        {
+            "Capacity": np.asarray(capacities, dtype=float),
+            "Self_consumption": self_consumption,
+            "Self_consumption_ratio": (
+                self_consumption / total_production if total_production else 0.0
+            ),
+            "Surpluses": grid_export.sum(axis=0),
+            "Consumption_after_self_consumption": grid_import.sum(axis=0),
+        }
+    )
+
+    # Grid imports of each time slot as a matrix product: (slots x hours) @
+    # (hours x capacities)
+    masks = lib_utils.time_slot_masks(df["Month"], df["Day"], df["Hour"])
+    slot_imports = np.stack(list(masks.values())).astype(float) @ grid_import
+    for time_slot, imports in zip(masks.keys(), slot_imports):
+        results[time_slot] = imports
+
+    results = results.round(3)
+
+    saved_path = lib_utils.save_csv_file(PATHS["results_battery"], analysisId, results)
+    logger.info("Written file %s", saved_path)
+
+    return results
@@ -24,6 +24,58 @@ TIME_SLOTS = {
     },
 }
 
+# Energy prices (€/kWh) of each time slot type, used to rank the hours when the
+# load shifting minimizes the cost
+TIME_SLOT_PRICES = {
+    "nocturna": {"Punta": 0.2, "Llana": 0.13, "Valle": 0.08},
+    "14h": {"Promocionadas": 0.09, "No promocionadas": 0.17},
+    "6h": {"Promocionadas": 0.09, "No promocionadas": 0.17},
+    "16h": {"Promocionadas": 0.09, "No promocionadas": 0.17},
+}
+
+# Row order of the stored time slot results, which are saved without row labels.
+# Analyses with generation have an extra "Generation" row
+TIME_SLOT_RESULTS_ROWS = [
+    "nocturna_Punta",
+    "nocturna_Llana",
+    "nocturna_Valle",
+    "14h_Promocionadas",
+    "14h_No promocionadas",
+    "6h_Promocionadas",
+    "6h_No promocionadas",
+    "16h_Promocionadas",
+    "16h_No promocionadas",
+    "Generation",
+]
+
+# Fixed national holidays (month, day), a day type of the profile cube
+HOLIDAYS = [
+    (1, 1),
+    (1, 6),
+    (5, 1),
+    (8, 15),
+    (10, 12),
+    (11, 1),
+    (12, 6),
+    (12, 8),
+    (12, 25),
+]
+
+# Months of each season of the profiles
+SEASONS = {
+    "winter": [12, 1, 2],
+    "spring": [3, 4, 5],
+    "summer": [6, 7, 8],
+    "autumn": [9, 10, 11],
+}
+
+# Formats of the tabular results. csv is the default, arrow and parquet need pyarrow
+MEDIA_TYPES = {
+    "csv": "text/csv",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+
 output_path = os.environ.get("OUTPUT_PATH", "output")
 
 PATHS = {
@@ -33,6 +85,14 @@ PATHS = {
     "results": os.path.join(output_path, "results"),
     "time_slots": os.path.join(output_path, "time_slots"),
     "locations": os.path.join(output_path, "locations"),
+    "locks": os.path.join(output_path, "locks"),
+    "manifests": os.path.join(output_path, "manifests"),
+    "portfolios": os.path.join(output_path, "portfolios"),
+    # Read-only arrays memory-mapped by every worker
+    "shared": os.path.join(output_path, "shared"),
+    "summary": os.path.join(output_path, "summary"),
+    # Index of the reads of the artifacts and of the local copies of the s3 backend
+    "cache_index": os.path.join(output_path, "cache_index"),
 }
 
 PATHS["consumption_parsed_hourly"] = os.path.join(PATHS["consumption"], "parsed_hourly")
@@ -46,8 +106,109 @@ PATHS["production_parsed_hourly"] = os.path.join(PATHS["production"], "parsed_ho
 PATHS["production_parsed_monthly"] = os.path.join(PATHS["production"], "parsed_monthly")
 PATHS["production_hourly"] = os.path.join(PATHS["production"], "hourly")
 PATHS["production_monthly"] = os.path.join(PATHS["production"], "monthly")
+PATHS["production_series"] = os.path.join(PATHS["production"], "series")
+PATHS["production_parsed_series"] = os.path.join(PATHS["production"], "parsed_series")
 PATHS["results_self_consumption"] = os.path.join(PATHS["results"], "self_consumption")
+PATHS["results_battery"] = os.path.join(PATHS["results"], "battery")
+PATHS["results_profiles"] = os.path.join(PATHS["results"], "profiles")
+PATHS["results_load_shifting"] = os.path.join(PATHS["results"], "load_shifting")
+PATHS["results_series"] = os.path.join(PATHS["results"], "series")
 PATHS["plots_consumption_production_chart"] = os.path.join(
     PATHS["plots"], "consumption_production_chart"
 )
 PATHS["plots_monthly"] = os.path.join(PATHS["plots"], "monthly")
+
+# Retention of the analyses. 0 disables the limit
+RETENTION = {
+    "ttl_seconds": float(os.environ.get("RETENTION_TTL_DAYS", "0")) * 24 * 3600,
+    "max_bytes": int(os.environ.get("OUTPUT_MAX_BYTES", "0")),
+    "sweep_interval_seconds": int(
+        os.environ.get("RETENTION_SWEEP_INTERVAL_SECONDS", "3600")
+    ),
+    # Finished portfolio jobs, with their archive and results
+    "portfolio_ttl_seconds": (
+        float(os.environ.get("PORTFOLIO_TTL_DAYS", "7")) * 24 * 3600
+    ),
+}
+
+# Years of the multi-year hourly production. PVGIS-SARAH2 covers 2005-2020
+PVGIS_SERIES = {
+    "start_year": int(os.environ.get("PVGIS_SERIES_START_YEAR", "2005")),
+    "end_year": int(os.environ.get("PVGIS_SERIES_END_YEAR", "2020")),
+}
+
+# Base urls of the external apis, e.g. a local stub for load tests
+UPSTREAM_URLS = {
+    "pvgis": os.environ.get("PVGIS_URL", "https://re.jrc.ec.europa.eu/api/v5_2"),
+    "positionstack": os.environ.get(
+        "POSITIONSTACK_URL", "http://api.positionstack.com/v1"
+    ),
+}
+
+# Portfolio jobs. 0 workers uses every core
+PORTFOLIO = {
+    "workers": int(os.environ.get("PORTFOLIO_WORKERS", "0")),
+    # Jobs running at once, shared by the workers of the api. The others wait queued
+    "max_jobs": max(int(os.environ.get("PORTFOLIO_MAX_JOBS", "1")), 1),
+    "batch_rows": 100,
+    "progress_interval_seconds": 1,
+}
+
+# Pool running the analyses of the uploads out of the event loop, "thread" or
+# "process". 0 workers uses every core. Uploads wait in a queue of max_queued
+# analyses when every worker is busy, and are rejected with 429 when it is full
+EXECUTOR = {
+    "kind": os.environ.get("EXECUTOR_KIND", "thread"),
+    "workers": int(os.environ.get("EXECUTOR_WORKERS", "0")),
+    "max_queued": int(os.environ.get("EXECUTOR_MAX_QUEUED", "8")),
+    # Retry-After of the rejected uploads until the duration of an analysis is known
+    "retry_after_seconds": int(os.environ.get("EXECUTOR_RETRY_AFTER_SECONDS", "5")),
+}
+
+# Memory budget of the cached results of the read endpoints of each worker. 0
+# disables the cache
+RESULT_CACHE = {
+    "max_bytes": int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(64 * 1024**2))),
+}
+
+# Exports bigger than the threshold are streamed in chunks instead of being built in
+# memory
+STREAMING = {
+    "threshold_bytes": int(os.environ.get("STREAMING_THRESHOLD_BYTES", "262144")),
+    "chunk_rows": 5000,
+    "chunk_bytes": 64 * 1024,
+}
+
+# Consumption files bigger than the threshold are parsed in chunks of rows, so the
+# memory used does not grow with the size of the file
+CONSUMPTION_PARSING = {
+    "threshold_bytes": int(
+        os.environ.get("CONSUMPTION_CHUNK_THRESHOLD_BYTES", str(1024**2))
+    ),
+    "chunk_rows": int(os.environ.get("CONSUMPTION_CHUNK_ROWS", "2000")),
+}
+
+# Files written for each analysis: (PATHS key, file name)
+ANALYSIS_ARTIFACTS = [
+    ("consumption_parsed_hourly", "{analysisId}.csv"),
+    ("consumption_parsed_monthly", "{analysisId}.csv"),
+    ("production_hourly", "{analysisId}.csv"),
+    ("production_monthly", "{analysisId}.csv"),
+    ("production_parsed_hourly", "{analysisId}.csv"),
+    ("production_parsed_monthly", "{analysisId}.csv"),
+    ("production_series", "{analysisId}.csv"),
+    ("production_parsed_series", "{analysisId}.npz"),
+    # Extracted copy memory-mapped by the workers
+    ("production_parsed_series", "{analysisId}.npy"),
+    ("results", "{analysisId}.csv"),
+    ("results_self_consumption", "{analysisId}.csv"),
+    ("results_battery", "{analysisId}.csv"),
+    ("results_profiles", "{analysisId}.npz"),
+    ("results_load_shifting", "{analysisId}.csv"),
+    ("results_series", "{analysisId}_v2.npy"),
+    # Series of an older version
+    ("results_series", "{analysisId}.npy"),
+    ("time_slots", "{analysisId}.csv"),
+    ("plots_consumption_production_chart", "{analysisId}.png"),
+    ("manifests", "{analysisId}.json"),
+] + [("plots_monthly", f"{{analysisId}}_{month}.png") for month in range(1, 13)]
@@ -1,20 +1,77 @@
+import hashlib
 import os
+import time
 import uuid
-
-import tools.energy_analysis_lib.energy as energy
-import tools.energy_analysis_lib.solar as solar
-import tools.pvgis_api_wrapper as api
-from tools.energy_analysis_lib.energy import (
-    parse_consumption_file,
-    parse_consumption_file_with_generation,
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, BinaryIO, TextIO
+
+from tools import gazetteer
+from tools.energy_analysis_lib import (
+    artifacts,
+    result_cache,
+    retention,
+    single_flight,
+    storage,
+    summary,
 )
-from tools.utils import logger
+from tools.energy_analysis_lib import utils as lib_utils
+from tools.utils import log_context, logger
 
-from .constants import PATHS
+from .constants import PATHS, TIME_SLOT_RESULTS_ROWS
 
+if TYPE_CHECKING:
+    import pandas as pd
 
-def solar_calculation(
-    consumption_file: bytes,
+# pandas, numpy and matplotlib are only imported by the first analysis
+battery = lib_utils.LazyModule("tools.energy_analysis_lib.battery")
+energy = lib_utils.LazyModule("tools.energy_analysis_lib.energy")
+load_shifting = lib_utils.LazyModule("tools.energy_analysis_lib.load_shifting")
+series = lib_utils.LazyModule("tools.energy_analysis_lib.series")
+solar = lib_utils.LazyModule("tools.energy_analysis_lib.solar")
+api = lib_utils.LazyModule("tools.pvgis_api_wrapper")
+
+
+def convert_dataframe(
+    df: "pd.DataFrame", file_format: str, index: bool = False
+) -> bytes | Iterator[bytes]:
+    """
+    Return the data in the requested format. Big csv exports are returned as an
+    iterator of chunks to stream.
+
+    :param df: The data
+    :param file_format: "csv", "arrow" or "parquet"
+    :param index: Write the index as the first column of the csv
+    """
+    if file_format == "csv":
+        return lib_utils.export_csv(df, index=index)
+    if file_format == "arrow":
+        return lib_utils.save_arrow_to_variable(df)
+    if file_format == "parquet":
+        return lib_utils.save_parquet_to_variable(df)
+
+    raise ValueError(f"Unknown format {file_format}")
+
+
+def convert_results(
+    path: str, file_format: str, row_labels: list[str] | None = None
+) -> bytes | Iterator[bytes]:
+    """
+    Return a stored csv results file in the requested format. Big csv files are
+    returned as an iterator of chunks to stream.
+
+    :param path: The path to the csv file
+    :param file_format: "csv", "arrow" or "parquet"
+    :param row_labels: Labels of the rows, for files saved without them
+    """
+    if file_format == "csv":
+        return lib_utils.export_file(path)
+
+    df = lib_utils.read_csv_file(path, row_labels=row_labels)
+    return convert_dataframe(df, file_format)
+
+
+def get_solar_analysis_id(
     location: str,
     peakpower: float,
     mountingplace: str,
@@ -23,21 +80,17 @@ def solar_calculation(
     aspect: float,
 ) -> str:
     """
-    Generate all the data necessary for the solar analysis.
+    Return the id of the solar analysis of an installation.
 
-    :param consumption_file: The consumption file
     :param location: The location of the solar panels
     :param peakpower: The peak power of the solar panels
     :param mountingplace: The mounting place of the solar panels
     :param loss: The loss of the solar panels
     :param angle: The angle of the solar panels
     :param aspect: The aspect of the solar panels
-
-    :return: The id of the analysis
     """
-
     # Create a unique id for the analysis repeatable by the parameters
-    analysisId = str(
+    return str(
         uuid.uuid3(
             uuid.NAMESPACE_DNS,
             location
@@ -49,79 +102,228 @@ def solar_calculation(
         )
     )
 
-    # Parse the consumption file
-    parse_consumption_file(consumption_file, analysisId)
 
-    # Get the production data from api
-    api.get_monthly_production(
-        location, peakpower, mountingplace, loss, angle, aspect, analysisId
+def solar_calculation(
+    consumption_file: TextIO | BinaryIO,
+    location: str,
+    peakpower: float,
+    mountingplace: str,
+    loss: float,
+    angle: float,
+    aspect: float,
+    render_plots: bool = False,
+    multi_year: bool = False,
+) -> str:
+    """
+    Generate all the data necessary for the solar analysis.
+
+    :param consumption_file: The consumption file
+    :param location: The location of the solar panels
+    :param peakpower: The peak power of the solar panels
+    :param mountingplace: The mounting place of the solar panels
+    :param loss: The loss of the solar panels
+    :param angle: The angle of the solar panels
+    :param aspect: The aspect of the solar panels
+    :param render_plots: Render the png plots now instead of on their first request
+    :param multi_year: Also get the hourly production of every year of
+        PVGIS_SERIES, for the production statistics
+
+    :return: The id of the analysis
+    """
+
+    analysisId = get_solar_analysis_id(
+        location, peakpower, mountingplace, loss, angle, aspect
     )
-    api.get_hourly_production(
-        location, peakpower, mountingplace, loss, angle, aspect, analysisId
+
+    # Retries and users submitting the same site and consumption at the same time
+    # share a single computation
+    # Read in blocks, uploads are not held whole in memory
+    digest = hashlib.sha256()
+    while block := consumption_file.read(1024**2):
+        digest.update(block.encode("utf-8") if isinstance(block, str) else block)
+    consumption_file.seek(0)
+    consumption_digest = digest.hexdigest()
+
+    return single_flight.do(
+        f"solar:{analysisId}:{consumption_digest}:{multi_year}",
+        lambda: run_solar_analysis(
+            consumption_file,
+            location,
+            peakpower,
+            mountingplace,
+            loss,
+            angle,
+            aspect,
+            analysisId,
+            render_plots=render_plots,
+            multi_year=multi_year,
+        ),
     )
 
-    # Parse the production file
-    solar.parse_hourly_production_file(analysisId)
-    solar.parse_monthly_production_file(analysisId)
 
-    # Generate consumption vs production plot
-    solar.consumption_production_chart(
-        location, peakpower, mountingplace, loss, angle, aspect, analysisId
-    )
+def run_solar_analysis(
+    consumption_file: TextIO,
+    location: str,
+    peakpower: float,
+    mountingplace: str,
+    loss: float,
+    angle: float,
+    aspect: float,
+    analysisId: str,
+    render_plots: bool = False,
+    multi_year: bool = False,
+) -> str:
+    """
+    Run the solar analysis pipeline and share its files with the rest of the
+    workers.
 
-    # Calculate the self consumption
-    solar.plot_self_consumption_monthly(analysisId)
+    :param consumption_file: The consumption file
+    :param location: The location of the solar panels
+    :param peakpower: The peak power of the solar panels
+    :param mountingplace: The mounting place of the solar panels
+    :param loss: The loss of the solar panels
+    :param angle: The angle of the solar panels
+    :param aspect: The aspect of the solar panels
+    :param analysisId: The id of the analysis
+    :param render_plots: Render the png plots now instead of on their first request
+    :param multi_year: Also get the hourly production of every year of
+        PVGIS_SERIES
 
-    # Get the time slot consumption
-    solar.process_results_time_slot_solar(analysisId)
+    :return: The id of the analysis
+    """
+    started = time.time()
+
+    # The id is deterministic, so concurrent requests with the same parameters write
+    # the same files. Only one worker processes an analysis at a time
+    with lib_utils.file_lock(analysisId), log_context(analysisId=analysisId):
+        # Parse the consumption file
+        energy.parse_consumption_file(consumption_file, analysisId)
+
+        # Get the production data from api
+        api.get_monthly_production(
+            location, peakpower, mountingplace, loss, angle, aspect, analysisId
+        )
+        api.get_hourly_production(
+            location, peakpower, mountingplace, loss, angle, aspect, analysisId
+        )
+        if multi_year:
+            api.get_hourly_production_series(
+                location, peakpower, mountingplace, loss, angle, aspect, analysisId
+            )
+
+        # Rebuild the results whose inputs, code or config changed since the
+        # last run of the analysis
+        artifacts.build(analysisId)
+
+        if render_plots:
+            solar.plot_consumption_production_chart(analysisId)
+            solar.plot_monthly_profiles(analysisId)
+
+        # Share the new files with the rest of the workers
+        storage.publish_analysis(analysisId, since=started)
+
+        result_cache.invalidate(analysisId)
+
+        summary.record(
+            analysisId,
+            "solar",
+            {
+                "location": location,
+                "peakpower": peakpower,
+                "mountingplace": mountingplace,
+                "loss": loss,
+                "angle": angle,
+                "aspect": aspect,
+            },
+        )
 
     return analysisId
 
 
-def get_monthly_production(analysisId: str) -> bytes:
+@result_cache.cached
+def get_monthly_production(
+    analysisId: str, file_format: str = "csv"
+) -> bytes | Iterator[bytes]:
     """
     Return the monthly production data to the api.
 
     :param analysisId: The id of the analysis
+    :param file_format: "csv", "arrow" or "parquet"
     """
-    try:
-        production_file = open(
-            os.path.join(PATHS["production_parsed_monthly"], f"{analysisId}.csv"), "rb"
-        )
-    except FileNotFoundError:
+    production_path = storage.fetch(
+        os.path.join(PATHS["production_parsed_monthly"], f"{analysisId}.csv")
+    )
+    if not os.path.exists(production_path):
         logger.error("The production file does not exist")
         raise FileNotFoundError("The production file does not exist")
 
-    return production_file.read()
+    return convert_results(production_path, file_format)
 
 
-def get_monthly_consumption(analysisId: str) -> bytes:
+@result_cache.cached
+def get_monthly_consumption(
+    analysisId: str, file_format: str = "csv"
+) -> bytes | Iterator[bytes]:
     """
     Return the monthly consumption data to the api.
 
     :param analysisId: The id of the analysis
+    :param file_format: "csv", "arrow" or "parquet"
     """
-    try:
-        consumption_file = open(
-            os.path.join(PATHS["consumption_parsed_monthly"], f"{analysisId}.csv"), "rb"
-        )
-    except FileNotFoundError:
+    consumption_path = storage.fetch(
+        os.path.join(PATHS["consumption_parsed_monthly"], f"{analysisId}.csv")
+    )
+    if not os.path.exists(consumption_path):
         logger.error("The consumption file does not exist")
         raise FileNotFoundError("The consumption file does not exist")
 
-    return consumption_file.read()
+    return convert_results(consumption_path, file_format)
+
+
+def render_missing_plots(analysisId: str, paths: list[str], render) -> None:
+    """
+    Render the plots of an analysis if they were not rendered when it was processed.
+
+    :param analysisId: The id of the analysis
+    :param paths: The paths of the plots
+    :param render: The function rendering the plots from the analysisId
+    """
+    if all(os.path.exists(storage.fetch(path)) for path in paths):
+        return
+
+    with lib_utils.file_lock(analysisId):
+        # Another worker may have rendered them while waiting for the lock
+        if all(os.path.exists(path) for path in paths):
+            return
+
+        logger.info("Rendering plots on demand")
+        render(analysisId)
+        storage.publish(paths)
 
 
+@result_cache.cached
 def get_monthly_consumption_production_plot(analysisId: str) -> bytes:
     """
     Return the monthly consumption vs production plot to the api.
 
     :param analysisId: The id of the analysis
     """
-    try:
-        consumption_production_plot = open(
+    render_missing_plots(
+        analysisId,
+        [
             os.path.join(
                 PATHS["plots_consumption_production_chart"], f"{analysisId}.png"
+            )
+        ],
+        solar.plot_consumption_production_chart,
+    )
+
+    try:
+        consumption_production_plot = open(
+            storage.fetch(
+                os.path.join(
+                    PATHS["plots_consumption_production_chart"], f"{analysisId}.png"
+                )
             ),
             "rb",
         )
@@ -141,12 +343,25 @@ def get_results_monthly_plots(analysisId: str) -> [bytes]:
 
     :param analysisId: The id of the analysis
     """
+    render_missing_plots(
+        analysisId,
+        [
+            os.path.join(PATHS["plots_monthly"], f"{analysisId}_{month}.png")
+            for month in range(1, 13)
+        ],
+        solar.plot_monthly_profiles,
+    )
+
     results_monthly = []
     try:
         for month in range(1, 13):
             results_monthly.append(
                 open(
-                    os.path.join(PATHS["plots_monthly"], f"{analysisId}_{month}.png"),
+                    storage.fetch(
+                        os.path.join(
+                            PATHS["plots_monthly"], f"{analysisId}_{month}.png"
+                        )
+                    ),
                     "rb",
                 )
             )
@@ -156,6 +371,33 @@ def get_results_monthly_plots(analysisId: str) -> [bytes]:
     return results_monthly
 
 
+@result_cache.cached
+def get_monthly_consumption_production_data(analysisId: str) -> dict:
+    """
+    Return the data of the monthly consumption vs production chart to the api, as
+    columns.
+
+    :param analysisId: The id of the analysis
+    """
+    df = solar.load_consumption_production_monthly(analysisId)
+    df = df[["Month", "Energy_consumption", "Energy_production"]].round(3)
+
+    return df.to_dict(orient="list")
+
+
+@result_cache.cached
+def get_monthly_profiles_data(analysisId: str) -> dict:
+    """
+    Return the average hourly profile of each month to the api, as columns.
+
+    :param analysisId: The id of the analysis
+    """
+    df = solar.load_monthly_profiles(analysisId).round(3)
+
+    return df.to_dict(orient="list")
+
+
+@result_cache.cached
 def get_self_percent_ratios(analysisId: str) -> dict:
     """
     Return the self consumption percentages and the averageto the api.
@@ -168,21 +410,169 @@ def get_self_percent_ratios(analysisId: str) -> dict:
     return {"monthly_ratios": monthly_ratios, "average": average}
 
 
-def get_results_time_slot_solar(analysisId: str) -> bytes:
+@result_cache.cached
+def get_production_statistics(analysisId: str) -> dict:
     """
-    Return the time slot solar results to the api.
+    Return the mean, P50 and P90 of the production, self consumption and surplus
+    across the years of the multi-year production to the api.
 
     :param analysisId: The id of the analysis
     """
-    try:
-        results_time_slot_solar = open(
-            os.path.join(PATHS["time_slots"], f"{analysisId}.csv"), "rb"
+    path = os.path.join(PATHS["production_parsed_series"], f"{analysisId}.npz")
+    if not os.path.exists(storage.fetch(path)):
+        raise FileNotFoundError(
+            "The analysis has no multi-year production, process it with multi_year"
         )
-    except FileNotFoundError:
+
+    return solar.get_production_statistics(analysisId)
+
+
+@result_cache.cached
+def get_profiles(
+    analysisId: str,
+    months: list[int] | None = None,
+    day_types: list[str] | None = None,
+    group_by: str | None = None,
+) -> dict:
+    """
+    Return the average daily profiles of consumption, production, self consumption
+    and surplus of a group of days to the api.
+
+    :param analysisId: The id of the analysis
+    :param months: The months of the days, every month if None
+    :param day_types: "weekday", "weekend" or "holiday", every type if None
+    :param group_by: "month", "day_type" or "season" for one profile of each, a
+        single profile if None
+    """
+    # Solar analyses processed before the cube existed
+    if artifacts.is_stale(analysisId, "profile_cube"):
+        artifacts.rebuild(analysisId)
+
+    return solar.get_profiles(analysisId, months, day_types, group_by)
+
+
+@result_cache.cached
+def get_results_time_slot_solar(
+    analysisId: str, file_format: str = "csv"
+) -> bytes | Iterator[bytes]:
+    """
+    Return the time slot solar results to the api.
+
+    :param analysisId: The id of the analysis
+    :param file_format: "csv", "arrow" or "parquet". The typed formats have the
+        name of each time slot in the "Time_slot" column
+    """
+    results_path = storage.fetch(os.path.join(PATHS["time_slots"], f"{analysisId}.csv"))
+    if not os.path.exists(results_path):
         logger.error("The time slot results after solar do not exist")
         raise FileNotFoundError("The time slot results after solar do not exist")
 
-    return results_time_slot_solar.read()
+    return convert_results(results_path, file_format, row_labels=TIME_SLOT_RESULTS_ROWS)
+
+
+def get_hourly_data(
+    analysisId: str, file_format: str = "csv"
+) -> bytes | Iterator[bytes]:
+    """
+    Return the hourly consumption and production data to the api.
+
+    :param analysisId: The id of the analysis
+    :param file_format: "csv", "arrow" or "parquet"
+    """
+    df = solar.load_merged_hourly_data(analysisId)[
+        ["Month", "Day", "Hour", "Energy_consumption", "Energy_production"]
+    ]
+
+    return convert_dataframe(df, file_format)
+
+
+@result_cache.cached
+def get_battery_results(
+    analysisId: str,
+    capacities: list[float],
+    charge_power: float | None = None,
+    discharge_power: float | None = None,
+    efficiency: float = 0.9,
+    min_soc: float = 0.1,
+) -> dict:
+    """
+    Return the self consumption, surpluses and time slot grid imports for each
+    battery capacity to the api.
+
+    :param analysisId: The id of the analysis
+    :param capacities: The battery capacities to simulate (kWh)
+    :param charge_power: The max charge power (kW)
+    :param discharge_power: The max discharge power (kW)
+    :param efficiency: The round trip efficiency
+    :param min_soc: The minimum state of charge
+    """
+    results = battery.process_results_battery(
+        analysisId,
+        capacities,
+        charge_power=charge_power,
+        discharge_power=discharge_power,
+        efficiency=efficiency,
+        min_soc=min_soc,
+    )
+
+    return results.to_dict(orient="list")
+
+
+def get_load_shifting_results(
+    analysisId: str,
+    budget: float,
+    max_power: float,
+    start_hour: int = 1,
+    end_hour: int = 24,
+    objective: str = "self_consumption",
+    time_slot: str = "nocturna",
+) -> dict:
+    """
+    Return the self consumption, surpluses, cost and time slot grid imports before
+    and after moving the flexible consumption of every day to the api.
+
+    :param analysisId: The id of the solar or energy analysis
+    :param budget: The flexible consumption that can be moved each day (kWh)
+    :param max_power: The max flexible consumption of an hour (kWh)
+    :param start_hour: The first hour where the flexible consumption can run
+    :param end_hour: The last hour where the flexible consumption can run
+    :param objective: "self_consumption" or "cost"
+    :param time_slot: The time slot scheme of the prices
+    """
+    results = load_shifting.process_results_load_shifting(
+        analysisId,
+        budget,
+        max_power,
+        start_hour=start_hour,
+        end_hour=end_hour,
+        objective=objective,
+        time_slot=time_slot,
+    )
+
+    return results.to_dict(orient="list")
+
+
+@result_cache.cached
+def get_series(
+    analysisId: str,
+    start: str | None = None,
+    end: str | None = None,
+    max_points: int = 1000,
+    measures: list[str] | None = None,
+) -> dict:
+    """
+    Return the hourly consumption and production of a time range, downsampled to
+    max_points, to the api.
+
+    :param analysisId: The id of the solar or energy analysis
+    :param start: The first time of the range, ISO format
+    :param end: The last time of the range, ISO format
+    :param max_points: The max points of each measure
+    :param measures: "consumption" and/or "production"
+    """
+    return series.get_series(
+        analysisId, start=start, end=end, max_points=max_points, measures=measures
+    )
 
 
 """
@@ -190,7 +580,7 @@ def get_results_time_slot_solar(analysisId: str) -> bytes:
 """
 
 
-def process_consumption_file(consumption_file: bytes) -> str:
+def process_consumption_file(consumption_file: TextIO) -> str:
     """
     Process the consumption file. If some exception is raised,
 
@@ -200,45 +590,75 @@ def process_consumption_file(consumption_file: bytes) -> str:
     logger.info("Processing consumption file")
 
     analysisId = str(uuid.uuid4())
+    started = time.time()
+
+    with log_context(analysisId=analysisId):
+        try:
+            # Read only the header, big files are parsed in chunks
+            header = consumption_file.readline()
+            consumption_file.seek(0)
+
+            # If first row contains a "GENERACION Wh" string, then it is a solar
+            # file
+            if "GENERACION Wh" in header:
+                energy.parse_consumption_file_with_generation(
+                    consumption_file, analysisId
+                )
+            else:
+                # Big files get their time slot results with the chunks, instead
+                # of reading the parsed file again on their first request
+                energy.parse_consumption_file(
+                    consumption_file, analysisId, time_slots=True
+                )
+                if os.path.exists(
+                    os.path.join(PATHS["time_slots"], f"{analysisId}.csv")
+                ):
+                    artifacts.record(analysisId, ["time_slots"])
 
-    try:
-        # Read StringIO object into a string
-        consumption_file_str = consumption_file.getvalue()
-
-        # Split string into rows
-        rows = consumption_file_str.split("\n")
+            storage.publish_analysis(analysisId, since=started)
 
-        # If first row contains a "GENERACION Wh" string, then it is a solar file
-        if "GENERACION Wh" in rows[0]:
-            parse_consumption_file_with_generation(consumption_file, analysisId)
-        else:
-            parse_consumption_file(consumption_file, analysisId)
+            summary.record(analysisId, "energy")
 
-        return analysisId
-    except Exception as e:
-        logger.error(e)
-        raise e
+            return analysisId
+        except Exception as e:
+            logger.error(e)
+            raise e
 
 
-def get_results_time_slot_energy_by_id(analysisId: str) -> bytes:
+def get_results_time_slot_energy_by_id(
+    analysisId: str, file_format: str = "csv"
+) -> bytes | Iterator[bytes]:
     """
     Return the time slot energy results to the api.
 
     :param analysisId: The id of the analysis
+    :param file_format: "csv", "arrow" or "parquet". The typed formats have the
+        name of each time slot in the "Time_slot" column
     """
-    # Check if the results exist in output folder
-    time_slot_energy_results = None
-    try:
-        time_slot_energy_results = open(
-            os.path.join(PATHS["time_slots"], f"{analysisId}.csv"), "rb"
-        ).read()
-    except FileNotFoundError:
-        logger.info("The time slot energy results do not exist, calculating")
+    results_path = os.path.join(PATHS["time_slots"], f"{analysisId}.csv")
+    # Check if the results exist in output folder and are up to date with the
+    # consumption and the time slots
+    if not artifacts.is_stale(analysisId, "time_slots"):
+        return convert_results(
+            results_path, file_format, row_labels=TIME_SLOT_RESULTS_ROWS
+        )
+
+    logger.info("The time slot energy results do not exist or are stale, calculating")
+
+    with lib_utils.file_lock(analysisId), log_context(analysisId=analysisId):
+        # Computed by another request while waiting for the lock
+        if not artifacts.is_stale(analysisId, "time_slots"):
+            return convert_results(
+                results_path, file_format, row_labels=TIME_SLOT_RESULTS_ROWS
+            )
 
         hourly = None
         # Check if the hourly consumption file exists
         hourly = open(
-            os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv"), "rb"
+            storage.fetch(
+                os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv")
+            ),
+            "rb",
         )
         # If first row contains a "Generation" column, then it is a solar file
         if "Generation" in hourly.readline().decode("utf-8"):
@@ -249,6 +669,19 @@ def get_results_time_slot_energy_by_id(analysisId: str) -> bytes:
             time_slot_energy_results = energy.process_results_time_slot_energy(
                 analysisId
             )
+        artifacts.record(analysisId, ["time_slots"])
+        storage.publish(
+            [results_path, os.path.join(PATHS["manifests"], f"{analysisId}.json")]
+        )
+
+        # The time slot results of the solar analysis are replaced too
+        result_cache.invalidate(analysisId)
+
+    # The first csv response has the names of the time slots as row labels
+    if file_format != "csv":
+        return convert_results(
+            results_path, file_format, row_labels=TIME_SLOT_RESULTS_ROWS
+        )
     return time_slot_energy_results
 
 
@@ -256,22 +689,15 @@ def get_results_time_slot_energy() -> list:
     """
     Return all the analysisId
     """
-    # Create the path if it does not exist
-    if not os.path.exists(PATHS["consumption_parsed_hourly"]):
-        os.makedirs(PATHS["consumption_parsed_hourly"])
     # Check csv files in "parsed_hourly" folder
-    files = os.listdir(os.path.join(PATHS["consumption_parsed_hourly"]))
+    files = storage.listdir(PATHS["consumption_parsed_hourly"])
     results = []
-    for file in files:
+    for file, created_at in files:
         # Check if the file is a csv file
         if file.endswith(".csv"):
             # Remove the extension
             analysisId = file[:-4]
-            # Get date from the file
-            time = os.path.getctime(
-                os.path.join(PATHS["consumption_parsed_hourly"], file)
-            )
-            results.append({"analysisId": analysisId, "created_at": time})
+            results.append({"analysisId": analysisId, "created_at": created_at})
 
     return results
 
@@ -282,44 +708,81 @@ def delete_results_time_slot_energy_by_id(analysisId: str):
 
     :param analysisId: The id of the analysis
     """
-    # Delet if exists in folders 'parsed_hourly', 'parsed_monthly' and 'time_slots'
-    if os.path.exists(
-        os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv")
-    ):
-        os.remove(os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv"))
-
-    if os.path.exists(
-        os.path.join(PATHS["consumption_parsed_monthly"], f"{analysisId}.csv")
-    ):
-        os.remove(
-            os.path.join(PATHS["consumption_parsed_monthly"], f"{analysisId}.csv")
-        )
-
-    if os.path.exists(os.path.join(PATHS["time_slots"], f"{analysisId}.csv")):
-        os.remove(os.path.join(PATHS["time_slots"], f"{analysisId}.csv"))
+    # Delete every artifact of the analysis, not only the energy ones
+    retention.delete_analysis(analysisId)
 
     message = "The analysis was deleted"
 
     return message
 
 
+def geocode_locations(locations: list[str], max_workers: int = 8) -> list[dict]:
+    """
+    Get the coordinates of many locations concurrently and save them in the cache.
+    Spellings of the same location are only geocoded once.
+
+    :param locations: The locations
+    :param max_workers: The number of locations geocoded at the same time. The
+        requests to positionstack are also bounded by its own limits
+    :return: For each location, in order, dict with "location", "latitude",
+        "longitude" and "source" ("cache", "gazetteer" or "api"), or "location" and
+        "error"
+    """
+    # One lookup per normalized location
+    keys = {location: gazetteer.normalize_location(location) for location in locations}
+    unique = {}
+    for location, key in keys.items():
+        unique.setdefault(key, location)
+
+    def geocode(location):
+        try:
+            latitude, longitude, source = api.locate(location)
+        except Exception as e:
+            logger.error(e)
+            return {"error": str(e)}
+        return {"latitude": latitude, "longitude": longitude, "source": source}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        found = dict(zip(unique.keys(), executor.map(geocode, unique.values())))
+
+    return [{"location": location, **found[keys[location]]} for location in locations]
+
+
 def get_solar_analysis() -> list:
     """
     Return all the analysisId
     """
-    # Create the path if it does not exist
-    if not os.path.exists(PATHS["results"]):
-        os.makedirs(PATHS["results"])
-    # Check csv files in "parsed_hourly" folder
-    files = os.listdir(os.path.join(PATHS["results"]))
+    # Check csv files in "results" folder
+    files = storage.listdir(PATHS["results"])
     results = []
-    for file in files:
+    for file, created_at in files:
         # Check if the file is a csv file
         if file.endswith(".csv"):
             # Remove the extension
             analysisId = file[:-4]
-            # Get date from the file
-            time = os.path.getctime(os.path.join(PATHS["results"], file))
-            results.append({"analysisId": analysisId, "created_at": time})
+            results.append({"analysisId": analysisId, "created_at": created_at})
 
     return results
+
+
+def get_summary(**filters) -> dict:
+    """
+    Return a page of the summaries of the analyses and the totals of all the
+    analyses matching the filters.
+
+    :param filters: The filters, sort and page of summary.query
+    """
+    return summary.query(**filters)
+
+
+def delete_solar_analysis(analysisId: str) -> str:
+    """
+    Delete the solar analysis: consumption, production, results and plots.
+
+    :param analysisId: The id of the analysis
+    """
+    retention.delete_analysis(analysisId)
+
+    message = "The analysis was deleted"
+
+    return message
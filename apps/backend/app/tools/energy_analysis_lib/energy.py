@@ -1,25 +1,37 @@
 import datetime
 import os
 
+import numpy as np
 import pandas as pd
+from tools.energy_analysis_lib import storage
 from tools.energy_analysis_lib import utils as lib_utils
 from tools.utils import logger
 
-from .constants import PATHS, TIME_SLOTS
+from .constants import CONSUMPTION_PARSING, PATHS, TIME_SLOTS
 
 
-def parse_consumption_file(csv_file: bytes, analysisId: str) -> None:
+def file_size(csv_file) -> int:
     """
-    Converts a csv file with consumption data to a csv file with 3 columns:
-    'Month','Day', 'Hour', 'Energy'
+    Size of an uploaded file object without reading it.
+
+    :param csv_file: file object, e.g. a StringIO or a TextIOWrapper of an upload
+    :return: size in bytes or characters
+    """
+    position = csv_file.tell()
+    size = csv_file.seek(0, os.SEEK_END)
+    csv_file.seek(position)
+
+    return size
+
+
+def read_consumption_file(csv_file, chunksize: int | None = None):
+    """
+    Read a consumption file, whole or as an iterator of chunks of rows.
 
     :param csv_file: csv file with consumption data
-    :param analysisId: id of the user
-    :return: None
+    :param chunksize: rows of each chunk, None to read the whole file
     """
-    logger.info("Importing file")
-    # Import the csv file as a pandas dataframe
-    df = pd.read_csv(
+    return pd.read_csv(
         csv_file,
         sep=";",
         decimal=",",
@@ -27,9 +39,18 @@ def parse_consumption_file(csv_file: bytes, analysisId: str) -> None:
         encoding="UTF-8",
         parse_dates=[1],
         dayfirst=True,
+        chunksize=chunksize,
     )
-    logger.info("File imported")
 
+
+def prepare_consumption(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert the rows of a consumption file to the columns 'Datetime', 'Energy',
+    'Month', 'Day' and 'Hour'.
+
+    :param df: rows of the consumption file
+    :return: converted rows
+    """
     # Remove first and last columns
     df = df.iloc[:, 1:-1]
     # Convert date column with name 'Fecha' to 3 columns 'Month', 'Day', 'Hour'
@@ -42,24 +63,112 @@ def parse_consumption_file(csv_file: bytes, analysisId: str) -> None:
     # One column can be named "Consumo" or "Consumo_kWh" depending on the file. Rename
     # it to "Energy"
     df = df.rename(columns={"Consumo": "Energy", "Consumo_kWh": "Energy"})
+    # Values without decimals are read as integers. Always write them as floats, so
+    # the file is the same whether it is read whole or in chunks
+    if "Energy" in df:
+        df["Energy"] = df["Energy"].astype(float)
+
+    return df
+
+
+def duplicated_hours_error() -> ValueError:
+    return ValueError(
+        "There are multiple rows with same month, \
+            day and hour"
+    )
+
+
+def monthly_consumption(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Sum the consumption of each month.
+
+    :param df: converted rows of the consumption file, with hour 25
+    :return: 'Month' and 'Energy' columns
+    """
+    # Create a dataframe with monthly data
+    df_monthly = df.drop(columns=["Datetime"], errors="ignore").groupby(["Month"]).sum()
+    df_monthly = df_monthly.reset_index()
+
+    # Only keep Month and Energy columns
+    return df_monthly.iloc[:, [0, 1]]
+
+
+def add_monthly_sums(sums: pd.DataFrame | None, df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Add the sums of each month of some rows to running sums. The sums of a file
+    read in chunks only differ from the sums of the whole file in their last digits.
+
+    :param sums: running sums indexed by 'Month', None before the first rows
+    :param df: rows with a 'Month' column and the columns to sum
+    :return: the running sums with the rows added
+    """
+    df_sums = df.groupby("Month").sum()
+    return df_sums if sums is None else sums.add(df_sums, fill_value=0)
+
+
+def time_slot_energy(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Split the energy of every hour of the consumption in the time slots.
+
+    :param df: converted rows of the consumption file, without hour 25
+    :return: 'Month' and the energy of every "<time slot name>_<time slot type>"
+    """
+    masks = lib_utils.time_slot_masks(df["Month"], df["Day"], df["Hour"])
+    energy = df["Energy"].to_numpy()
+
+    return pd.DataFrame(
+        {
+            "Month": df["Month"].to_numpy(),
+            **{name: np.where(mask, energy, 0.0) for name, mask in masks.items()},
+        }
+    )
+
+
+def parse_consumption_file(
+    csv_file: bytes,
+    analysisId: str,
+    chunk_rows: int | None = None,
+    time_slots: bool = False,
+) -> None:
+    """
+    Converts a csv file with consumption data to a csv file with 3 columns:
+    'Month','Day', 'Hour', 'Energy'
+
+    Files bigger than CONSUMPTION_CHUNK_THRESHOLD_BYTES are parsed in chunks of
+    CONSUMPTION_CHUNK_ROWS rows.
+
+    :param csv_file: csv file with consumption data
+    :param analysisId: id of the user
+    :param chunk_rows: parse the file in chunks of this number of rows
+    :param time_slots: when the file is parsed in chunks, also write the time slot
+        results of an energy analysis, summed with the chunks
+    :return: None
+    """
+    if chunk_rows is None and (
+        file_size(csv_file) > CONSUMPTION_PARSING["threshold_bytes"]
+    ):
+        chunk_rows = CONSUMPTION_PARSING["chunk_rows"]
+    if chunk_rows:
+        return parse_consumption_file_chunked(
+            csv_file, analysisId, chunk_rows, time_slots=time_slots
+        )
+
+    logger.info("Importing file")
+    # Import the csv file as a pandas dataframe
+    df = read_consumption_file(csv_file)
+    logger.info("File imported")
+
+    df = prepare_consumption(df)
 
     # At the moment only same year data is supported
     # Throw error if there are multiple rows with same month, day and hour
     # TODO: Support for 12 months of different years and better error handling in case
     # of infringement of this rule
     if df.duplicated(subset=["Month", "Day", "Hour"]).any():
-        raise ValueError(
-            "There are multiple rows with same month, \
-            day and hour"
-        )
+        raise duplicated_hours_error()
     else:
         logger.info("No duplicated rows")
-    # Create a dataframe with monthly data
-    df_monthly = df.drop(columns=["Datetime"]).groupby(["Month"]).sum()
-    df_monthly = df_monthly.reset_index()
-
-    # Only keep Month and Energy columns
-    df_monthly = df_monthly.iloc[:, [0, 1]]
+    df_monthly = monthly_consumption(df)
 
     # Remove hour 25 corresponding to the change to winter time
     df = df[df["Hour"] != 25]
@@ -68,13 +177,76 @@ def parse_consumption_file(csv_file: bytes, analysisId: str) -> None:
     hourly_csv = lib_utils.save_csv_file(
         PATHS["consumption_parsed_hourly"], analysisId, df
     )
-    logger.info(f"Written file {hourly_csv}")
+    logger.info("Written file %s", hourly_csv)
 
     # Save the monthly dataframe as a csv file
     monthly_csv = lib_utils.save_csv_file(
         PATHS["consumption_parsed_monthly"], analysisId, df_monthly
     )
-    logger.info(f"Written file {monthly_csv}")
+    logger.info("Written file %s", monthly_csv)
+
+
+def parse_consumption_file_chunked(
+    csv_file: bytes, analysisId: str, chunk_rows: int, time_slots: bool = False
+) -> None:
+    """
+    Same as parse_consumption_file, reading the file in chunks of rows. Each chunk is
+    appended to the hourly file as soon as it is converted and added to running
+    sums of each month, and of each time slot and month, so the memory used does
+    not grow with the file. Repeated
+    hours are detected as soon as their chunk is read, so files with several years
+    fail without being read whole.
+
+    :param csv_file: csv file with consumption data
+    :param analysisId: id of the user
+    :param chunk_rows: rows of each chunk
+    :param time_slots: also write the time slot results of an energy analysis
+    :return: None
+    """
+    logger.info("Importing file in chunks of %s rows", chunk_rows)
+    hourly_csv = os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv")
+    # Month, day and hour of the rows read, to find the repeated ones. At most one
+    # year of hours, as any other row is an error
+    seen = set()
+    # Running sums of each month
+    monthly_sums = None
+    time_slot_sums = None
+
+    with (
+        lib_utils.atomic_write(hourly_csv, "w", encoding="UTF-8", newline="") as f,
+        read_consumption_file(csv_file, chunksize=chunk_rows) as chunks,
+    ):
+        for i, chunk in enumerate(chunks):
+            chunk = prepare_consumption(chunk)
+
+            hours = set(zip(chunk["Month"], chunk["Day"], chunk["Hour"]))
+            if len(hours) < len(chunk) or not seen.isdisjoint(hours):
+                raise duplicated_hours_error()
+            seen |= hours
+
+            monthly_sums = add_monthly_sums(
+                monthly_sums, monthly_consumption(chunk).set_index("Month")
+            )
+
+            # Remove hour 25 corresponding to the change to winter time
+            chunk = chunk[chunk["Hour"] != 25]
+            chunk.to_csv(f, header=i == 0, index=False, sep=";", decimal=",")
+
+            if time_slots:
+                time_slot_sums = add_monthly_sums(
+                    time_slot_sums, time_slot_energy(chunk)
+                )
+
+    logger.info("No duplicated rows")
+    logger.info("Written file %s", hourly_csv)
+
+    monthly_csv = lib_utils.save_csv_file(
+        PATHS["consumption_parsed_monthly"], analysisId, monthly_sums.reset_index()
+    )
+    logger.info("Written file %s", monthly_csv)
+
+    if time_slots:
+        save_time_slot_results(analysisId, time_slot_sums.reset_index())
 
 
 def parse_consumption_file_with_generation(csv_file: bytes, analysisId: str) -> None:
@@ -128,7 +300,7 @@ def parse_consumption_file_with_generation(csv_file: bytes, analysisId: str) ->
     df["Consumption"] = df["Consumption"] / 1000
 
     # Create a dataframe with monthly data
-    df_monthly = df.drop(columns=["Datetime"]).groupby(["Month"]).sum()
+    df_monthly = df.drop(columns=["Datetime"], errors="ignore").groupby(["Month"]).sum()
     df_monthly = df_monthly.reset_index()
 
     # Only keep Month and Energy columns
@@ -141,13 +313,13 @@ def parse_consumption_file_with_generation(csv_file: bytes, analysisId: str) ->
     saved_path = lib_utils.save_csv_file(
         PATHS["consumption_parsed_hourly"], analysisId, df
     )
-    logger.info(f"Written file {saved_path}")
+    logger.info("Written file %s", saved_path)
 
     # Save the monthly dataframe as a csv file
     saved_path = lib_utils.save_csv_file(
         PATHS["consumption_parsed_monthly"], analysisId, df_monthly
     )
-    logger.info(f"Written file {saved_path}")
+    logger.info("Written file %s", saved_path)
 
 
 def process_results_time_slot_energy(analysisId: str) -> bytes:
@@ -161,7 +333,10 @@ def process_results_time_slot_energy(analysisId: str) -> bytes:
     hourly_file = None
     try:
         hourly_file = open(
-            os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv"), "rb"
+            storage.fetch(
+                os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv")
+            ),
+            "rb",
         )
 
     except FileNotFoundError:
@@ -219,6 +394,17 @@ def process_results_time_slot_energy(analysisId: str) -> bytes:
         .reset_index()
     )
 
+    return save_time_slot_results(analysisId, df)
+
+
+def save_time_slot_results(analysisId: str, df: pd.DataFrame) -> bytes:
+    """
+    Saves the time slot results of an energy analysis
+
+    :param analysisId: id of the user
+    :param df: 'Month' and the energy of every time slot in each month
+    :return: CSV file with the results
+    """
     # Transpose the dataframe
     df = df.transpose()
 
@@ -241,7 +427,7 @@ def process_results_time_slot_energy(analysisId: str) -> bytes:
 
     # Save the results
     results_path = lib_utils.save_csv_file(PATHS["time_slots"], analysisId, df)
-    logger.info(f"Written file {results_path}")
+    logger.info("Written file %s", results_path)
 
     results_csv = lib_utils.save_csv_to_variable(df)
 
@@ -259,7 +445,10 @@ def process_results_time_slot_energy_with_generation(analysisId: str) -> bytes:
     hourly_file = None
     try:
         hourly_file = open(
-            os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv"), "rb"
+            storage.fetch(
+                os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv")
+            ),
+            "rb",
         )
 
     except FileNotFoundError:
@@ -338,7 +527,7 @@ def process_results_time_slot_energy_with_generation(analysisId: str) -> bytes:
 
     # Save the results
     results_path = lib_utils.save_csv_file(PATHS["time_slots"], analysisId, df)
-    logger.info(f"Written file {results_path}")
+    logger.info("Written file %s", results_path)
 
     results_csv = lib_utils.save_csv_to_variable(df)
 
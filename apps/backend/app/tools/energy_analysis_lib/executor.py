@@ -0,0 +1,202 @@
+"""
+Pool running the analyses of the uploads out of the event loop, so the rest of the
+requests of the worker, health checks included, are answered while they run.
+
+The pool runs EXECUTOR["workers"] analyses at a time, in threads or in processes
+(EXECUTOR_KIND). When every worker is busy up to EXECUTOR["max_queued"] analyses
+wait in its queue, and the next ones are rejected with SaturatedError, so a burst
+of uploads does not pile up work that the clients stopped waiting for.
+"""
+
+import asyncio
+import math
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from tools.utils import log_context, logger, request_id
+
+from .constants import EXECUTOR
+
+
+class SaturatedError(Exception):
+    """
+    Every worker is busy and the queue is full.
+    """
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+_pool: Executor | None = None
+_lock = threading.Lock()
+_stats = {
+    "in_flight": 0,
+    "submitted": 0,
+    "completed": 0,
+    "failed": 0,
+    "rejected": 0,
+    "wait_seconds_total": 0.0,
+    "wait_seconds_max": 0.0,
+    "run_seconds_total": 0.0,
+}
+
+
+def get_workers() -> int:
+    return EXECUTOR["workers"] or os.cpu_count() or 1
+
+
+def get_pool() -> Executor:
+    """
+    Return the pool, created on its first use.
+    """
+    global _pool
+    with _lock:
+        if _pool is None:
+            if EXECUTOR["kind"] == "process":
+                # Same start method as the portfolio jobs, forking a process with
+                # threads is unsafe
+                _pool = ProcessPoolExecutor(
+                    max_workers=get_workers(),
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            else:
+                _pool = ThreadPoolExecutor(
+                    max_workers=get_workers(), thread_name_prefix="analysis"
+                )
+            logger.info(
+                "Started a %s pool of %s workers", EXECUTOR["kind"], get_workers()
+            )
+
+        return _pool
+
+
+def shutdown() -> None:
+    """
+    Stop the pool, waiting for the analyses that are running.
+    """
+    global _pool
+    with _lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _run(fn, args: tuple, kwargs: dict, requestId: str | None):
+    """
+    Run fn in a worker, with the request id in its log records.
+
+    :return: the time it started and its result
+    """
+    started = time.time()
+    with log_context(requestId=requestId):
+        return started, fn(*args, **kwargs)
+
+
+def retry_after() -> int:
+    """
+    Estimate the seconds until the queue has room, from the mean duration of the
+    analyses.
+    """
+    with _lock:
+        completed = _stats["completed"] + _stats["failed"]
+        if not completed:
+            return EXECUTOR["retry_after_seconds"]
+        mean_seconds = _stats["run_seconds_total"] / completed
+        queued = max(_stats["in_flight"] - get_workers(), 0)
+
+    return max(1, math.ceil(mean_seconds * (queued + 1) / get_workers()))
+
+
+def _admit() -> None:
+    with _lock:
+        if _stats["in_flight"] >= get_workers() + EXECUTOR["max_queued"]:
+            _stats["rejected"] += 1
+            saturated = True
+        else:
+            _stats["in_flight"] += 1
+            _stats["submitted"] += 1
+            saturated = False
+
+    if saturated:
+        raise SaturatedError("Too many analyses in progress", retry_after())
+
+
+def _finished(future, submitted: float) -> None:
+    """
+    Update the statistics when an analysis ends, or is cancelled before starting.
+    Called by the pool, so it also counts the analyses whose client left.
+    """
+    with _lock:
+        _stats["in_flight"] -= 1
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            _stats["failed"] += 1
+            _stats["run_seconds_total"] += time.time() - submitted
+            return
+
+        started, _ = future.result()
+        wait_seconds = max(started - submitted, 0.0)
+        _stats["completed"] += 1
+        _stats["wait_seconds_total"] += wait_seconds
+        _stats["wait_seconds_max"] = max(_stats["wait_seconds_max"], wait_seconds)
+        _stats["run_seconds_total"] += time.time() - started
+
+
+async def run(fn, *args, **kwargs):
+    """
+    Run fn(*args, **kwargs) in the pool and wait for its result without blocking
+    the event loop. With a process pool, fn, its arguments and its result must be
+    picklable.
+
+    :raises SaturatedError: if every worker is busy and the queue is full
+    """
+    _admit()
+    submitted = time.time()
+    try:
+        future = get_pool().submit(_run, fn, args, kwargs, request_id.get())
+    except BaseException:
+        with _lock:
+            _stats["in_flight"] -= 1
+        raise
+    future.add_done_callback(lambda future: _finished(future, submitted))
+
+    _, result = await asyncio.wrap_future(future)
+    return result
+
+
+def get_stats() -> dict:
+    """
+    Return the state of the pool: the analyses running and queued, the counters and
+    the time the analyses waited in the queue.
+    """
+    workers = get_workers()
+    with _lock:
+        stats = dict(_stats)
+
+    completed = stats["completed"]
+    return {
+        "kind": EXECUTOR["kind"],
+        "workers": workers,
+        "max_queued": EXECUTOR["max_queued"],
+        # The pool runs the analyses in order, so the first ones are running
+        "running": min(stats["in_flight"], workers),
+        "queued": max(stats["in_flight"] - workers, 0),
+        "submitted": stats["submitted"],
+        "completed": completed,
+        "failed": stats["failed"],
+        "rejected": stats["rejected"],
+        "wait_seconds_mean": (
+            round(stats["wait_seconds_total"] / completed, 3) if completed else 0
+        ),
+        "wait_seconds_max": round(stats["wait_seconds_max"], 3),
+        "run_seconds_mean": (
+            round(stats["run_seconds_total"] / (completed + stats["failed"]), 3)
+            if completed + stats["failed"]
+            else 0
+        ),
+    }
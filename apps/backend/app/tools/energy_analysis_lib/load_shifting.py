@@ -0,0 +1,333 @@
+import os
+
+import numpy as np
+import pandas as pd
+from tools.energy_analysis_lib import storage
+from tools.energy_analysis_lib import utils as lib_utils
+from tools.utils import logger
+
+from .constants import PATHS, TIME_SLOT_PRICES, TIME_SLOTS
+from .solar import load_merged_hourly_data
+
+OBJECTIVES = ["self_consumption", "cost"]
+
+# Hours of the day grid. The parsed files use hours 1 to 24 for the consumption
+# and 0 to 23 for the production, merged on the same number
+HOURS_PER_DAY = 25
+
+
+def _starts(ends: np.ndarray) -> np.ndarray:
+    """
+    Start of each segment from the cumulative capacities of the rows.
+    """
+    return np.pad(ends[:, :-1], ((0, 0), (1, 0)))
+
+
+def _allocate(capacities: np.ndarray, amounts: np.ndarray) -> np.ndarray:
+    """
+    Fill the segments of each row in order with the amount of the row.
+
+    :param capacities: (rows x segments) capacity of each segment, in fill order
+    :param amounts: (rows) amount of each row
+    :return: (rows x segments) amount taken by each segment
+    """
+    starts = _starts(np.cumsum(capacities, axis=1))
+    return np.clip(amounts[:, None] - starts, 0, capacities)
+
+
+def _segment_at(ends: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """
+    Index of the segment of each row that contains each position, searching all the
+    rows at once. Positions at or past the end of the row get the number of
+    segments.
+
+    :param ends: (rows x segments) cumulative capacities, non decreasing
+    :param positions: (rows x n) positions, from 0
+    """
+    rows, segments = ends.shape
+    positions = np.minimum(positions, ends[:, -1:])
+    # Move every row to its own range, so one sorted search covers all of them
+    offsets = np.arange(rows)[:, None] * (ends[:, -1].max() + 1)
+    index = np.searchsorted(
+        (ends + offsets).ravel(), (positions + offsets).ravel(), side="right"
+    )
+
+    return index.reshape(positions.shape) - np.arange(rows)[:, None] * segments
+
+
+def shift_load(
+    consumption: np.ndarray,
+    production: np.ndarray,
+    prices: np.ndarray,
+    budget: float,
+    max_power: float,
+    allowed: np.ndarray,
+) -> dict[str, np.ndarray]:
+    """
+    Moves up to budget kWh of the consumption of each day to the hours where it
+    costs the least, for every day at the same time.
+
+    Load is removed first from the hours that import from the grid, saving their
+    price, and added first to the surpluses, for free, and then to the cheapest
+    hours. Load is moved while the cost of adding it is lower than the saving of
+    removing it, so with the same price in every hour only the imports that fit in
+    the surpluses of the day are moved.
+
+    :param consumption: (days x hours) consumption (kWh)
+    :param production: (days x hours) production (kWh)
+    :param prices: (days x hours) price of the energy imported each hour
+    :param budget: max flexible consumption moved each day (kWh)
+    :param max_power: max flexible consumption added to or removed from an hour (kWh)
+    :param allowed: (days x hours) hours where the flexible consumption can be added
+    :return: dict with the shifted (days x hours) 'consumption' and the (days)
+        'moved' energy
+    """
+    if budget < 0:
+        raise ValueError("The flexible consumption must be non-negative")
+    if max_power <= 0:
+        raise ValueError("The max power must be greater than 0")
+
+    hours = consumption.shape[1]
+    surplus = np.maximum(production - consumption, 0)
+    imports = np.maximum(consumption - production, 0)
+    zeros = np.zeros_like(prices)
+
+    # Two segments per hour where load can be added: the surplus, free, and the
+    # rest of the power, at the price of the hour
+    add_power = np.where(allowed, max_power, 0)
+    add_free = np.minimum(surplus, add_power)
+    add_capacities = np.concatenate([add_free, add_power - add_free], axis=1)
+    add_prices = np.concatenate([zeros, prices], axis=1)
+
+    # Two segments per hour where load can be removed: the imports, saving their
+    # price, and the self consumed energy, saving nothing
+    remove_power = np.minimum(consumption, max_power)
+    remove_imports = np.minimum(imports, remove_power)
+    remove_capacities = np.concatenate(
+        [remove_imports, remove_power - remove_imports], axis=1
+    )
+    remove_savings = np.concatenate([prices, zeros], axis=1)
+
+    # Cheapest additions and biggest savings first
+    add_order = np.argsort(add_prices, axis=1, kind="stable")
+    remove_order = np.argsort(-remove_savings, axis=1, kind="stable")
+    add_capacities = np.take_along_axis(add_capacities, add_order, axis=1)
+    add_prices = np.take_along_axis(add_prices, add_order, axis=1)
+    remove_capacities = np.take_along_axis(remove_capacities, remove_order, axis=1)
+    remove_savings = np.take_along_axis(remove_savings, remove_order, axis=1)
+
+    add_ends = np.cumsum(add_capacities, axis=1)
+    remove_ends = np.cumsum(remove_capacities, axis=1)
+
+    # The marginal price of adding only rises and the marginal saving of removing
+    # only falls, so the best amount to move is the first position where moving
+    # one more kWh does not save anything. Both only change at the start of a
+    # segment
+    positions = np.concatenate(
+        [
+            _starts(add_ends),
+            _starts(remove_ends),
+            add_ends[:, -1:],
+            remove_ends[:, -1:],
+        ],
+        axis=1,
+    )
+    add_segment = _segment_at(add_ends, positions)
+    remove_segment = _segment_at(remove_ends, positions)
+    price = np.take_along_axis(
+        np.pad(add_prices, ((0, 0), (0, 1)), constant_values=np.inf),
+        add_segment,
+        axis=1,
+    )
+    saving = np.take_along_axis(
+        np.pad(remove_savings, ((0, 0), (0, 1)), constant_values=-np.inf),
+        remove_segment,
+        axis=1,
+    )
+    best = np.where(price >= saving, positions, np.inf).min(axis=1)
+    moved = np.minimum(best, budget)
+
+    # Fill the segments in order and put them back in their hours
+    added = np.zeros_like(add_capacities)
+    np.put_along_axis(added, add_order, _allocate(add_capacities, moved), axis=1)
+    removed = np.zeros_like(remove_capacities)
+    np.put_along_axis(
+        removed, remove_order, _allocate(remove_capacities, moved), axis=1
+    )
+
+    shifted = (
+        consumption
+        + added[:, :hours]
+        + added[:, hours:]
+        - removed[:, :hours]
+        - removed[:, hours:]
+    )
+
+    return {"consumption": np.maximum(shifted, 0), "moved": moved}
+
+
+def load_hourly_data(analysisId: str) -> pd.DataFrame:
+    """
+    Loads the hourly consumption and production of a solar analysis, or the
+    consumption and the generation, if any, of an energy analysis.
+
+    :param analysisId: id of the user
+    :return: dataframe with 'Month', 'Day', 'Hour', 'Energy_consumption' and
+        'Energy_production'
+    """
+    if os.path.exists(
+        storage.fetch(
+            os.path.join(PATHS["production_parsed_hourly"], f"{analysisId}.csv")
+        )
+    ):
+        return load_merged_hourly_data(analysisId)
+
+    try:
+        df = pd.read_csv(
+            storage.fetch(
+                os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv")
+            ),
+            sep=";",
+            decimal=",",
+            thousands=".",
+            encoding="UTF-8",
+        )
+    except FileNotFoundError:
+        raise FileNotFoundError("Consumption file not found")
+
+    if "Generation" in df:
+        df = df.rename(
+            columns={
+                "Consumption": "Energy_consumption",
+                "Generation": "Energy_production",
+            }
+        )
+    else:
+        df = df.rename(columns={"Energy": "Energy_consumption"})
+        df["Energy_production"] = 0.0
+
+    return df.sort_values(["Month", "Day", "Hour"]).reset_index(drop=True)
+
+
+def hour_mask(hours: np.ndarray, start_hour: int, end_hour: int) -> np.ndarray:
+    """
+    Check which hours are between start_hour and end_hour, both included. The
+    range wraps around midnight when start_hour is greater than end_hour, like the
+    ranges of TIME_SLOTS.
+    """
+    if start_hour > end_hour:
+        return (hours >= start_hour) | (hours <= end_hour)
+    return (hours >= start_hour) & (hours <= end_hour)
+
+
+def process_results_load_shifting(
+    analysisId: str,
+    budget: float,
+    max_power: float,
+    start_hour: int = 1,
+    end_hour: int = 24,
+    objective: str = "self_consumption",
+    time_slot: str = "nocturna",
+) -> pd.DataFrame:
+    """
+    Calculates the self consumption, surpluses, cost and time slot grid imports of
+    the analysis before and after moving flexible consumption, e.g. dishwashers,
+    water heating or EV charging, to the surpluses or the cheapest time slots.
+
+    :param analysisId: id of the user
+    :param budget: flexible consumption that can be moved each day (kWh)
+    :param max_power: max flexible consumption added to or removed from an hour
+        (kWh)
+    :param start_hour: first hour where the flexible consumption can run
+    :param end_hour: last hour where the flexible consumption can run
+    :param objective: 'self_consumption' to only move consumption to the
+        surpluses, 'cost' to also move it to cheaper time slots
+    :param time_slot: time slot scheme of the prices, a key of TIME_SLOTS
+    :return: dataframe with the 'Original' and the 'Shifted' rows
+    """
+    if objective not in OBJECTIVES:
+        raise ValueError(f"Unknown objective: {objective}")
+    if time_slot not in TIME_SLOTS:
+        raise ValueError(f"Unknown time slot: {time_slot}")
+    if not (1 <= start_hour <= 24 and 1 <= end_hour <= 24):
+        raise ValueError("Hours must be between 1 and 24")
+
+    logger.info("Calculating load shifting results")
+
+    df = load_hourly_data(analysisId)
+    month = df["Month"].to_numpy()
+    day = df["Day"].to_numpy()
+    hour = df["Hour"].to_numpy()
+    consumption = df["Energy_consumption"].to_numpy(dtype=float)
+    production = df["Energy_production"].to_numpy(dtype=float)
+
+    masks = lib_utils.time_slot_masks(month, day, hour)
+    prices = np.zeros(len(df))
+    for time_slot_type, price in TIME_SLOT_PRICES[time_slot].items():
+        prices[masks[f"{time_slot}_{time_slot_type}"]] = price
+
+    # Every hour of the year in a (days x hours) grid, so all the days are
+    # optimized at the same time
+    day_of_year = (
+        pd.to_datetime(
+            pd.DataFrame({"year": 2024, "month": month, "day": day})
+        ).dt.dayofyear.to_numpy()
+        - 1
+    )
+    grid_index = (day_of_year, hour)
+
+    def to_grid(values: np.ndarray) -> np.ndarray:
+        grid = np.zeros((366, HOURS_PER_DAY))
+        grid[grid_index] = values
+        return grid
+
+    allowed = np.zeros((366, HOURS_PER_DAY), dtype=bool)
+    allowed[grid_index] = hour_mask(hour, start_hour, end_hour)
+
+    shifting = shift_load(
+        to_grid(consumption),
+        to_grid(production),
+        # With the same price in every hour, only the imports that fit in the
+        # surpluses are moved
+        to_grid(prices if objective == "cost" else np.ones(len(df))),
+        budget,
+        max_power,
+        allowed,
+    )
+    shifted = shifting["consumption"][grid_index]
+
+    total_production = production.sum()
+    rows = []
+    for scenario, scenario_consumption in [
+        ("Original", consumption),
+        ("Shifted", shifted),
+    ]:
+        grid_import = np.maximum(scenario_consumption - production, 0)
+        self_consumption = (
+            total_production - np.maximum(production - scenario_consumption, 0).sum()
+        )
+        row = {
+            "Scenario": scenario,
+            "Moved": shifting["moved"].sum() if scenario == "Shifted" else 0.0,
+            "Consumption": scenario_consumption.sum(),
+            "Self_consumption": self_consumption,
+            "Self_consumption_ratio": (
+                self_consumption / total_production if total_production else 0.0
+            ),
+            "Surpluses": total_production - self_consumption,
+            "Consumption_after_self_consumption": grid_import.sum(),
+            "Cost": (grid_import * prices).sum(),
+        }
+        # Grid imports of each time slot
+        for name, mask in masks.items():
+            row[name] = grid_import[mask].sum()
+        rows.append(row)
+
+    results = pd.DataFrame(rows).round(3)
+
+    saved_path = lib_utils.save_csv_file(
+        PATHS["results_load_shifting"], analysisId, results
+    )
+    logger.info("Written file %s", saved_path)
+
+    return results
@@ -0,0 +1,690 @@
+"""
+Portfolio jobs: the analysis of the consumption files of many meters (CUPS) of an
+energy community or a retailer, from a zip archive or a folder. Meters are analyzed
+in a process pool and their results are written in batches to one parquet or csv
+file, with the totals of the portfolio in its last row.
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from collections.abc import Callable, Iterator
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
+from io import StringIO
+
+from tools.energy_analysis_lib import core, storage
+from tools.energy_analysis_lib import utils as lib_utils
+from tools.utils import log_context, logger
+
+from .constants import PATHS, PORTFOLIO, TIME_SLOT_RESULTS_ROWS
+
+solar = lib_utils.LazyModule("tools.energy_analysis_lib.solar")
+api = lib_utils.LazyModule("tools.pvgis_api_wrapper")
+
+# Parameters of the installation shared by every meter of a solar portfolio
+SOLAR_PARAMETERS = ["location", "peakpower", "mountingplace", "loss", "angle", "aspect"]
+
+# Energy in kWh: total consumption and total of every time slot
+ENERGY_COLUMNS = ["consumption", *TIME_SLOT_RESULTS_ROWS]
+SOLAR_COLUMNS = ["production", "self_consumption", "surplus"]
+COLUMNS = [
+    "meter",
+    "analysisId",
+    "status",
+    "error",
+    "seconds",
+    *ENERGY_COLUMNS,
+    *SOLAR_COLUMNS,
+    "self_consumption_ratio",
+]
+TEXT_COLUMNS = ["meter", "analysisId", "status", "error"]
+# States of the jobs that did not finish
+ACTIVE_STATUSES = ("queued", "running")
+
+
+def is_consumption_file(name: str) -> bool:
+    # Skip the metadata folders added by some archivers
+    return name.lower().endswith(".csv") and not name.startswith("__MACOSX")
+
+
+def list_consumption_files(source: str) -> list[str]:
+    """
+    List the consumption files of a zip archive, a folder or a single csv file.
+
+    :param source: The path of the archive, the folder or the file
+    :return: The names of the files, relative to the folder
+    """
+    if os.path.isdir(source):
+        return sorted(
+            os.path.relpath(os.path.join(root, name), source)
+            for root, _, names in os.walk(source)
+            for name in names
+            if is_consumption_file(name)
+        )
+
+    if not zipfile.is_zipfile(source):
+        return [os.path.basename(source)] if is_consumption_file(source) else []
+
+    with zipfile.ZipFile(source) as archive:
+        return [
+            info.filename
+            for info in archive.infolist()
+            if not info.is_dir() and is_consumption_file(info.filename)
+        ]
+
+
+def iter_consumption_files(source: str) -> Iterator[tuple[str, bytes]]:
+    """
+    Read the consumption files of a zip archive, a folder or a single csv file one
+    by one.
+
+    :param source: The path of the archive, the folder or the file
+    :return: Iterator of (name, content)
+    """
+    if os.path.isdir(source):
+        for name in list_consumption_files(source):
+            with open(os.path.join(source, name), "rb") as f:
+                yield name, f.read()
+        return
+
+    if not zipfile.is_zipfile(source):
+        for name in list_consumption_files(source):
+            with open(source, "rb") as f:
+                yield name, f.read()
+        return
+
+    with zipfile.ZipFile(source) as archive:
+        for name in list_consumption_files(source):
+            yield name, archive.read(name)
+
+
+def iter_sources(sources: list[str]) -> Iterator[tuple[str, bytes]]:
+    """
+    Read the consumption files of many sources. With more than one source, the
+    names of the files start with the name of their source.
+
+    :param sources: The paths of the archives, folders or files
+    :return: Iterator of (name, content)
+    """
+    for source in sources:
+        prefix = (
+            os.path.basename(source.rstrip("/"))
+            if len(sources) > 1
+            and (os.path.isdir(source) or zipfile.is_zipfile(source))
+            else ""
+        )
+        for name, content in iter_consumption_files(source):
+            yield os.path.join(prefix, name), content
+
+
+def meter_key(name: str, content: bytes) -> str:
+    """
+    Return the key of a meter in the results of previous runs. A file changed since
+    its analysis has a different key.
+
+    :param name: The name of the consumption file
+    :param content: The consumption file
+    """
+    return f"{name}:{hashlib.sha256(content).hexdigest()}"
+
+
+@contextmanager
+def timed(timings: dict, stage: str):
+    """
+    Add the time spent in a block to a stage of the timings.
+
+    :param timings: dict stage -> seconds
+    :param stage: The name of the stage
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0) + time.perf_counter() - started
+
+
+def prepare_production(solar_parameters: dict) -> str:
+    """
+    Get the production of the installation shared by the meters, once for the
+    whole portfolio.
+
+    :param solar_parameters: The parameters of the installation
+    :return: The id of the solar analysis with the production
+    """
+    productionId = core.get_solar_analysis_id(**solar_parameters)
+    with lib_utils.file_lock(productionId):
+        api.get_monthly_production(**solar_parameters, analysisId=productionId)
+        api.get_hourly_production(**solar_parameters, analysisId=productionId)
+
+    return productionId
+
+
+def share_production(productionId: str, analysisId: str) -> None:
+    """
+    Give an analysis the production files of another one, so it does not get them
+    from the api again.
+
+    :param productionId: The id of the analysis with the production
+    :param analysisId: The id of the analysis
+    """
+    for path in ["production_hourly", "production_monthly"]:
+        source = storage.fetch(os.path.join(PATHS[path], f"{productionId}.csv"))
+        destination = os.path.join(PATHS[path], f"{analysisId}.csv")
+        if os.path.exists(destination):
+            continue
+
+        # Hard links do not take space for every meter
+        try:
+            os.link(source, destination)
+        except FileExistsError:
+            pass
+        except OSError:
+            with (
+                open(source, "rb") as f,
+                lib_utils.atomic_write(destination, "wb") as copy,
+            ):
+                shutil.copyfileobj(f, copy)
+
+
+def get_energy_totals(analysisId: str) -> dict:
+    """
+    Return the total consumption and the total of every time slot of an analysis.
+
+    :param analysisId: The id of the analysis
+    """
+    consumption = lib_utils.read_csv_file(
+        storage.fetch(
+            os.path.join(PATHS["consumption_parsed_monthly"], f"{analysisId}.csv")
+        )
+    )
+    time_slots = lib_utils.read_csv_file(
+        storage.fetch(os.path.join(PATHS["time_slots"], f"{analysisId}.csv")),
+        row_labels=TIME_SLOT_RESULTS_ROWS,
+    )
+
+    totals = time_slots.set_index("Time_slot").sum(axis=1)
+    return {
+        "consumption": float(consumption["Energy"].sum()),
+        **{name: float(total) for name, total in totals.items()},
+    }
+
+
+def get_solar_totals(analysisId: str) -> dict:
+    """
+    Return the total production, self consumption and surplus of a solar analysis.
+
+    :param analysisId: The id of the analysis
+    """
+    df = solar.load_merged_hourly_data(analysisId)
+
+    production = float(df["Energy_production"].sum())
+    self_consumption = float(
+        df[["Energy_consumption", "Energy_production"]].min(axis=1).sum()
+    )
+    return {
+        "production": production,
+        "self_consumption": self_consumption,
+        "surplus": production - self_consumption,
+        "self_consumption_ratio": (
+            round(self_consumption / production, 3) if production else None
+        ),
+    }
+
+
+def analyze_meter(
+    name: str,
+    content: bytes,
+    solar_parameters: dict | None = None,
+    productionId: str | None = None,
+) -> dict:
+    """
+    Run the energy analysis of a meter, or the solar analysis with the shared
+    installation. Run in the workers of the process pool.
+
+    :param name: The name of the consumption file
+    :param content: The consumption file
+    :param solar_parameters: The parameters of the shared installation, None for
+        an energy analysis
+    :param productionId: The id of the analysis with the shared production
+    :return: The row of the meter in the results. Errors are reported in the row
+    """
+    started = time.perf_counter()
+    row = {column: None for column in COLUMNS}
+    row["meter"] = name
+    timings = {}
+
+    try:
+        consumption_file = StringIO(content.decode("utf-8"))
+        if solar_parameters is None:
+            with timed(timings, "parse"):
+                analysisId = core.process_consumption_file(consumption_file)
+            with timed(timings, "time_slots"):
+                core.get_results_time_slot_energy_by_id(analysisId)
+        else:
+            # Every meter has its own analysis with the shared production. Names
+            # like 1.csv are repeated across portfolios, so the content is part of
+            # the id too
+            analysisId = str(
+                uuid.uuid3(uuid.UUID(productionId), meter_key(name, content))
+            )
+            share_production(productionId, analysisId)
+            with timed(timings, "solar_analysis"):
+                core.run_solar_analysis(
+                    consumption_file, **solar_parameters, analysisId=analysisId
+                )
+            with timed(timings, "totals"):
+                row.update(get_solar_totals(analysisId))
+
+        with timed(timings, "totals"):
+            row.update(get_energy_totals(analysisId))
+        row["analysisId"] = analysisId
+        row["status"] = "ok"
+    except Exception as e:
+        logger.error("Could not analyze meter %s: %s", name, e)
+        row["status"] = "error"
+        row["error"] = str(e)
+
+    row["seconds"] = round(time.perf_counter() - started, 3)
+    # Not columns of the results
+    row["key"] = meter_key(name, content)
+    row["timings"] = timings
+    return row
+
+
+class ResultsWriter:
+    """
+    Write the rows of the meters in batches to a parquet or a csv file, moved to its
+    final path when it is closed.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: The path of the results. Parquet if it ends with .parquet
+        """
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.parquet = path.endswith(".parquet")
+        self.rows = []
+        self.writer = None
+        self.file = None
+
+    def write(self, row: dict) -> None:
+        self.rows.append(row)
+        if len(self.rows) >= PORTFOLIO["batch_rows"]:
+            self.flush()
+
+    def flush(self) -> None:
+        import pandas as pd
+
+        if not self.rows:
+            return
+        df = pd.DataFrame(self.rows, columns=COLUMNS)
+        self.rows = []
+
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            schema = pa.schema(
+                [
+                    (column, pa.string() if column in TEXT_COLUMNS else pa.float64())
+                    for column in COLUMNS
+                ]
+            )
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(
+                    self.tmp_path, schema, compression="zstd"
+                )
+            self.writer.write_table(
+                pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+            )
+            return
+
+        header = self.file is None
+        if header:
+            self.file = open(self.tmp_path, "w", encoding="UTF-8", newline="")
+        df.to_csv(self.file, index=False, header=header, sep=";", decimal=",")
+
+    def close(self) -> None:
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+        if self.file is not None:
+            self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.replace(self.tmp_path, self.path)
+
+
+def run_portfolio(
+    source: str | list[str],
+    output: str,
+    solar_parameters: dict | None = None,
+    workers: int = 0,
+    progress: Callable[[dict], None] | None = None,
+    completed: dict[str, dict] | None = None,
+    on_row: Callable[[dict], None] | None = None,
+) -> dict:
+    """
+    Analyze every consumption file of zip archives, folders or csv files in a
+    process pool.
+
+    :param source: The path of the archive, the folder or the file, or a list of
+        them
+    :param output: The path of the results, a .parquet or a .csv file
+    :param solar_parameters: The parameters of the installation shared by the
+        meters (location, peakpower, mountingplace, loss, angle and aspect). None
+        for an energy analysis of every meter
+    :param workers: The number of processes. 0 uses PORTFOLIO_WORKERS or every core
+    :param progress: Function called with the state of the job as it runs
+    :param completed: Rows of meters analyzed by a previous run, by meter_key. Their
+        meters are not analyzed again
+    :param on_row: Function called with the row of every meter analyzed
+    :return: The final state of the job, with the totals of the portfolio and the
+        seconds spent in every stage
+    """
+    sources = [source] if isinstance(source, str) else source
+    completed = completed or {}
+    workers = workers or PORTFOLIO["workers"] or os.cpu_count() or 1
+    started = time.time()
+    state = {
+        "status": "running",
+        "total": sum(len(list_consumption_files(source)) for source in sources),
+        "done": 0,
+        "skipped": 0,
+        "failed": 0,
+        "elapsed_seconds": 0,
+        "meters_per_second": 0,
+        "eta_seconds": None,
+    }
+    totals = {column: 0.0 for column in ENERGY_COLUMNS + SOLAR_COLUMNS}
+    timings = {}
+    reported = 0.0
+
+    productionId = None
+    if solar_parameters is not None:
+        with timed(timings, "production"):
+            productionId = prepare_production(solar_parameters)
+
+    writer = ResultsWriter(output)
+
+    def add(row: dict) -> None:
+        with timed(timings, "write"):
+            writer.write(row)
+
+        state["done"] += 1
+        if row["status"] == "ok":
+            for column in totals:
+                totals[column] += row[column] or 0
+        else:
+            state["failed"] += 1
+
+    def collect(futures) -> None:
+        nonlocal reported
+        for future in futures:
+            row = future.result()
+            for stage, seconds in row["timings"].items():
+                timings[stage] = timings.get(stage, 0) + seconds
+            add(row)
+            if on_row is not None:
+                on_row(row)
+
+        elapsed = time.time() - started
+        state["elapsed_seconds"] = round(elapsed, 3)
+        state["meters_per_second"] = round(
+            (state["done"] - state["skipped"]) / elapsed, 3
+        )
+        if state["meters_per_second"]:
+            state["eta_seconds"] = round(
+                (state["total"] - state["done"]) / state["meters_per_second"], 1
+            )
+        if elapsed - reported >= PORTFOLIO["progress_interval_seconds"]:
+            reported = elapsed
+            logger.info(
+                "Portfolio: %s/%s meters, %s failed, %s meters/s",
+                state["done"],
+                state["total"],
+                state["failed"],
+                state["meters_per_second"],
+            )
+            if progress is not None:
+                progress(dict(state))
+
+    # Spawned workers do not inherit the threads and locks of the api
+    context = multiprocessing.get_context("spawn")
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            pending = set()
+            files = iter_sources(sources)
+            while True:
+                with timed(timings, "read"):
+                    name, content = next(files, (None, None))
+                if name is None:
+                    break
+
+                # Analyzed by a previous run
+                row = completed.get(meter_key(name, content))
+                if row is not None:
+                    state["skipped"] += 1
+                    add(row)
+                    continue
+
+                pending.add(
+                    executor.submit(
+                        analyze_meter, name, content, solar_parameters, productionId
+                    )
+                )
+                # Read the next files only as the meters finish, so big portfolios
+                # are not loaded in memory
+                if len(pending) >= 2 * workers:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(finished)
+            collect(pending)
+
+        totals = {column: round(total, 3) for column, total in totals.items()}
+        totals["self_consumption_ratio"] = (
+            round(totals["self_consumption"] / totals["production"], 3)
+            if totals["production"]
+            else None
+        )
+        writer.write(
+            {
+                **{column: None for column in COLUMNS},
+                **totals,
+                "meter": "Total",
+                "status": "ok",
+                "seconds": state["elapsed_seconds"],
+            }
+        )
+    finally:
+        writer.close()
+
+    state.update(
+        status="done",
+        eta_seconds=0,
+        totals=totals,
+        timings={stage: round(seconds, 3) for stage, seconds in timings.items()},
+        output=output,
+    )
+    logger.info(
+        "Portfolio of %s meters done in %ss, %s failed",
+        state["total"],
+        state["elapsed_seconds"],
+        state["failed"],
+    )
+    if progress is not None:
+        progress(dict(state))
+
+    return state
+
+
+def _job_path(jobId: str, name: str) -> str:
+    return os.path.join(PATHS["portfolios"], jobId, name)
+
+
+def _job_lock_name(jobId: str) -> str:
+    return f"portfolio-{jobId}"
+
+
+def _save_status(jobId: str, status: dict) -> None:
+    with lib_utils.atomic_write(_job_path(jobId, "status.json"), "w") as f:
+        json.dump({"jobId": jobId, **status}, f)
+
+
+def _load_status(jobId: str) -> dict:
+    try:
+        with open(_job_path(jobId, "status.json"), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Portfolio job {jobId} not found")
+
+
+def get_job(jobId: str) -> dict:
+    """
+    Return the state of a portfolio job: its progress while it runs, and the totals
+    of the portfolio when it is done. A job left queued or running by a restart of
+    the api is reported as an error.
+
+    :param jobId: The id of the job
+    """
+    job = _load_status(jobId)
+    if job["status"] not in ACTIVE_STATUSES:
+        return job
+
+    # The thread of the job holds its lock while it is queued or running
+    try:
+        with lib_utils.file_lock(_job_lock_name(jobId), blocking=False):
+            # It may have finished while the lock was taken
+            job = _load_status(jobId)
+            if job["status"] in ACTIVE_STATUSES:
+                logger.warning("Portfolio job %s was interrupted", jobId)
+                job.update(status="error", error="The job was interrupted")
+                _save_status(jobId, job)
+    except BlockingIOError:
+        pass
+
+    return job
+
+
+def list_jobs() -> list[str]:
+    """
+    Return the ids of the portfolio jobs in the output folder.
+    """
+    if not os.path.exists(PATHS["portfolios"]):
+        return []
+    return [entry.name for entry in os.scandir(PATHS["portfolios"]) if entry.is_dir()]
+
+
+def delete_job(jobId: str) -> None:
+    """
+    Delete the archive, the status and the results of a finished portfolio job. The
+    analyses of its meters are kept, they are deleted by the retention of the
+    analyses.
+
+    :param jobId: The id of the job
+    :raises BlockingIOError: If the job is queued or running
+    """
+    # Held by the thread of the job until it finishes
+    with lib_utils.file_lock(_job_lock_name(jobId), blocking=False):
+        shutil.rmtree(os.path.join(PATHS["portfolios"], jobId))
+
+    logger.info("Deleted portfolio job %s", jobId)
+
+
+def get_job_results(jobId: str) -> str:
+    """
+    Return the path of the results of a finished portfolio job.
+
+    :param jobId: The id of the job
+    """
+    job = get_job(jobId)
+    if job["status"] != "done":
+        raise ValueError(f"Portfolio job {jobId} is {job['status']}")
+    return job["output"]
+
+
+@contextmanager
+def _job_slot():
+    """
+    Wait for one of the PORTFOLIO_MAX_JOBS slots shared by the workers of the api,
+    as every job runs its own process pool.
+    """
+    while True:
+        for slot in range(PORTFOLIO["max_jobs"]):
+            with ExitStack() as stack:
+                try:
+                    stack.enter_context(
+                        lib_utils.file_lock(f"portfolio-slot-{slot}", blocking=False)
+                    )
+                except BlockingIOError:
+                    continue
+                yield
+                return
+        time.sleep(1)
+
+
+def _run_job(
+    jobId: str,
+    solar_parameters: dict | None,
+    file_format: str,
+    locked: threading.Event,
+) -> None:
+    # The records of the job carry its id, the workers add the id of each meter
+    with log_context(requestId=jobId), lib_utils.file_lock(_job_lock_name(jobId)):
+        locked.set()
+        try:
+            with _job_slot():
+                run_portfolio(
+                    _job_path(jobId, "consumption.zip"),
+                    _job_path(jobId, f"results.{file_format}"),
+                    solar_parameters,
+                    progress=lambda state: _save_status(jobId, state),
+                )
+        except Exception as e:
+            logger.exception(e)
+            _save_status(jobId, {"status": "error", "error": str(e)})
+
+
+def start_job(
+    archive, solar_parameters: dict | None = None, file_format: str = "parquet"
+) -> str:
+    """
+    Start a portfolio job in the background. It waits queued while
+    PORTFOLIO_MAX_JOBS jobs are running.
+
+    :param archive: File object with a zip archive of consumption files
+    :param solar_parameters: The parameters of the installation shared by the
+        meters, None for an energy analysis of every meter
+    :param file_format: The format of the results, "parquet" or "csv"
+    :return: The id of the job
+    """
+    jobId = str(uuid.uuid4())
+    archive_path = _job_path(jobId, "consumption.zip")
+    with lib_utils.atomic_write(archive_path, "wb") as f:
+        shutil.copyfileobj(archive, f)
+
+    if not zipfile.is_zipfile(archive_path):
+        shutil.rmtree(os.path.dirname(archive_path))
+        raise ValueError("The portfolio must be a zip archive of consumption files")
+
+    _save_status(
+        jobId, {"status": "queued", "total": len(list_consumption_files(archive_path))}
+    )
+    locked = threading.Event()
+    threading.Thread(
+        target=_run_job,
+        args=(jobId, solar_parameters, file_format, locked),
+        name=f"portfolio-{jobId}",
+        daemon=True,
+    ).start()
+    # Until the job holds its lock it would be reported as interrupted
+    locked.wait()
+
+    logger.info("Started portfolio job %s", jobId)
+    return jobId
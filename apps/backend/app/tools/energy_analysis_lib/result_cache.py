@@ -0,0 +1,201 @@
+import functools
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from tools.energy_analysis_lib import storage
+from tools.utils import logger
+
+from .constants import PATHS, RESULT_CACHE
+
+
+def sizeof(value) -> int:
+    """
+    Estimate the memory used by a result.
+
+    :param value: The result: bytes, str, numbers, dataframes or lists, tuples and
+        dicts of them
+    :return: The size in bytes
+    """
+    if hasattr(value, "memory_usage"):
+        # pandas objects
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            sizeof(key) + sizeof(item) for key, item in value.items()
+        )
+    if isinstance(value, list | tuple):
+        return sys.getsizeof(value) + sum(sizeof(item) for item in value)
+    return sys.getsizeof(value)
+
+
+def _version_path(analysisId: str) -> str:
+    return os.path.join(PATHS["locks"], f"{analysisId}.version")
+
+
+def get_version(analysisId: str) -> tuple[int, str | None]:
+    """
+    Return the version of the results of an analysis, changed by every worker when
+    it recomputes or deletes the analysis, and by the other hosts with the s3
+    backend.
+
+    :param analysisId: The id of the analysis
+    """
+    try:
+        local = os.stat(_version_path(analysisId)).st_mtime_ns
+    except FileNotFoundError:
+        # Deleted by the sweeper, a new version makes every cached result out of
+        # date, as any of them may have been computed before the deleted one
+        os.makedirs(PATHS["locks"], exist_ok=True)
+        with open(_version_path(analysisId), "a") as f:
+            local = os.fstat(f.fileno()).st_mtime_ns
+    return local, storage.get_version(analysisId)
+
+
+class ResultCache:
+    """
+    Least recently used cache of results with a budget of bytes. Entries are
+    weighted by their size, so a few big results do not take the memory of many
+    small ones.
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        :param max_bytes: The max size of the cached results. 0 disables the cache
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, key: tuple, version: tuple):
+        """
+        Return a cached result if it was computed from the current version of its
+        analysis.
+
+        :param key: The key of the result. The analysis id is its second element
+        :param version: The current version of the analysis
+        :return: (True, result) on a hit, (False, None) on a miss
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] != version:
+                self.stats["misses"] += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return True, entry[0]
+
+    def put(self, key: tuple, version: tuple, value) -> None:
+        """
+        Cache a result, evicting the least recently used ones over the budget.
+
+        :param key: The key of the result
+        :param version: The version of the analysis the result was computed from
+        :param value: The result
+        """
+        size = sizeof(value)
+        # A result bigger than a fraction of the budget would evict everything
+        if size > self.max_bytes / 4:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[2]
+            self.entries[key] = (value, version, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.stats["evictions"] += 1
+
+    def invalidate(self, analysisId: str) -> None:
+        """
+        Remove the cached results of an analysis.
+
+        :param analysisId: The id of the analysis
+        """
+        with self.lock:
+            for key in [key for key in self.entries if key[1] == analysisId]:
+                self.bytes -= self.entries.pop(key)[2]
+                self.stats["invalidations"] += 1
+
+    def get_stats(self) -> dict:
+        """
+        Return the hit and miss counters and the size of the cache.
+        """
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "hit_ratio": round(self.stats["hits"] / lookups, 3) if lookups else 0,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+cache = ResultCache(RESULT_CACHE["max_bytes"])
+
+
+def cached(fn):
+    """
+    Cache the results of a read function whose first argument is the analysis id.
+    Streamed results (iterators) are not cached.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(analysisId: str, *args, **kwargs):
+        if not cache.max_bytes:
+            return fn(analysisId, *args, **kwargs)
+
+        # Lists are not hashable
+        key = (
+            fn.__name__,
+            analysisId,
+            repr(args),
+            repr(sorted(kwargs.items())),
+        )
+        # Read the version before computing, so a result computed while the
+        # analysis is being recomputed is never taken as up to date
+        version = get_version(analysisId)
+        hit, value = cache.get(key, version)
+        if hit:
+            return value
+
+        value = fn(analysisId, *args, **kwargs)
+        if isinstance(value, bytes | str | dict | list | tuple):
+            cache.put(key, version, value)
+        return value
+
+    return wrapper
+
+
+def invalidate(analysisId: str, deleted: bool = False) -> None:
+    """
+    Invalidate the cached results of an analysis in every worker and host, after it
+    is recomputed or deleted.
+
+    :param analysisId: The id of the analysis
+    :param deleted: The analysis was deleted
+    """
+    cache.invalidate(analysisId)
+    storage.mark_changed(analysisId, deleted=deleted)
+
+    # Other workers compare the version of their entries with this file
+    os.makedirs(PATHS["locks"], exist_ok=True)
+    now = time.time_ns()
+    with open(_version_path(analysisId), "a") as f:
+        # Through the file, which may be deleted by the sweeper in the meantime
+        os.utime(f.fileno(), ns=(now, now))
+    logger.info("Invalidated the cached results of %s", analysisId)
+
+
+def get_stats() -> dict:
+    """
+    Return the statistics of the result cache of this worker.
+    """
+    return cache.get_stats()
@@ -0,0 +1,264 @@
+import os
+import threading
+import time
+
+from tools.energy_analysis_lib import result_cache, single_flight, storage, summary
+from tools.energy_analysis_lib import utils as lib_utils
+from tools.utils import logger
+
+from .constants import ANALYSIS_ARTIFACTS, PATHS, RETENTION
+
+api = lib_utils.LazyModule("tools.pvgis_api_wrapper")
+portfolio = lib_utils.LazyModule("tools.energy_analysis_lib.portfolio")
+
+# Lock files are created again when needed, versions are only deleted when they did
+# not change for a day, as their results are computed again
+LOCKS_MAX_AGE_SECONDS = 3600
+VERSIONS_MAX_AGE_SECONDS = 24 * 3600
+
+_sweeper_stop = threading.Event()
+_sweeper_thread = None
+
+
+def delete_analysis(analysisId: str, blocking: bool = True) -> None:
+    """
+    Delete every artifact of an analysis: parsed files, pvgis responses, results and
+    plots.
+
+    :param analysisId: The id of the analysis
+    :param blocking: If False, raise BlockingIOError instead of waiting when the
+        analysis is being processed
+    """
+    with lib_utils.file_lock(analysisId, blocking=blocking):
+        storage.delete(storage.artifact_paths(analysisId))
+        api.remove_from_cache(api.production_monthly_cache, analysisId)
+        api.remove_from_cache(api.production_hourly_cache, analysisId)
+        api.remove_from_cache(api.production_series_cache, analysisId)
+        api.remove_values_from_cache(api.production_requests_cache, analysisId)
+        summary.delete(analysisId)
+        result_cache.invalidate(analysisId, deleted=True)
+
+    logger.info("Deleted analysis %s", analysisId)
+
+
+def get_analyses_usage() -> dict[str, dict]:
+    """
+    Return the disk usage of every analysis in the output folder.
+
+    :return: dict analysisId -> {"bytes", "last_modified", "last_accessed"}
+    """
+    accessed = storage.get_accessed()
+    usage = {}
+    for path in {PATHS[path] for path, _ in ANALYSIS_ARTIFACTS}:
+        if not os.path.exists(path):
+            continue
+        for entry in os.scandir(path):
+            if not entry.is_file() or entry.name.startswith("."):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            # Monthly plots are named <analysisId>_<month>.png
+            analysisId = os.path.splitext(entry.name)[0].split("_")[0]
+            analysis = usage.setdefault(
+                analysisId, {"bytes": 0, "last_modified": 0, "last_accessed": 0}
+            )
+            analysis["bytes"] += stat.st_size
+            analysis["last_modified"] = max(analysis["last_modified"], stat.st_mtime)
+            analysis["last_accessed"] = max(
+                analysis["last_accessed"],
+                accessed.get(os.path.normpath(entry.path), 0),
+                stat.st_mtime,
+            )
+
+    return usage
+
+
+def sweep(ttl_seconds: float = 0, max_bytes: int = 0) -> list[str]:
+    """
+    Delete the analyses not modified during the ttl and then the least recently used
+    ones until the output folder is under max_bytes. Analyses being processed are
+    skipped.
+
+    :param ttl_seconds: Max age of an analysis. 0 disables it
+    :param max_bytes: Disk budget of the output folder. 0 disables it
+    :return: The ids of the deleted analyses
+    """
+    usage = get_analyses_usage()
+    now = time.time()
+
+    expired = []
+    if ttl_seconds:
+        expired = [
+            analysisId
+            for analysisId, analysis in usage.items()
+            if now - analysis["last_modified"] > ttl_seconds
+        ]
+
+    # With the s3 backend the output folder is only a cache, bounded by
+    # STORAGE_CACHE_MAX_BYTES, so exceeding the budget is not a reason to delete
+    evicted = []
+    if max_bytes and not isinstance(storage.backend, storage.S3Storage):
+        expired_ids = set(expired)
+        remaining = {
+            analysisId: analysis
+            for analysisId, analysis in usage.items()
+            if analysisId not in expired_ids
+        }
+        total = sum(analysis["bytes"] for analysis in remaining.values())
+        for analysisId, analysis in sorted(
+            remaining.items(), key=lambda item: item[1]["last_accessed"]
+        ):
+            if total <= max_bytes:
+                break
+            evicted.append(analysisId)
+            total -= analysis["bytes"]
+
+    deleted = []
+    for analysisId in expired + evicted:
+        try:
+            delete_analysis(analysisId, blocking=False)
+        except BlockingIOError:
+            logger.info("Analysis %s is being processed, not deleted", analysisId)
+            continue
+        deleted.append(analysisId)
+
+    logger.info(
+        "Retention sweep: %s expired, %s evicted, %s deleted",
+        len(expired),
+        len(evicted),
+        len(deleted),
+    )
+    return deleted
+
+
+def sweep_locks(
+    max_age_seconds: float = LOCKS_MAX_AGE_SECONDS,
+    versions_max_age_seconds: float = VERSIONS_MAX_AGE_SECONDS,
+) -> int:
+    """
+    Delete the files of the locks folder that are not in use: lock files nobody
+    holds, results of finished single flights, result versions not changed for a
+    while and temporary files left by interrupted writes. They are created again
+    when needed.
+
+    :param max_age_seconds: Min age of the lock, single flight and temporary files
+        deleted
+    :param versions_max_age_seconds: Min age of the versions deleted. Deleting the
+        version of an analysis makes the workers compute its results again
+    :return: The number of files deleted
+    """
+    if not os.path.exists(PATHS["locks"]):
+        return 0
+
+    now = time.time()
+    deleted = 0
+    # Single flight results are deleted under their lock, before the lock files
+    entries = sorted(os.scandir(PATHS["locks"]), key=lambda e: e.name.endswith(".lock"))
+    for entry in entries:
+        try:
+            age = now - entry.stat().st_mtime
+        except FileNotFoundError:
+            continue
+
+        if entry.name.endswith(".version"):
+            max_age = versions_max_age_seconds
+        elif entry.name.endswith((".lock", single_flight.MARKER_SUFFIX, ".tmp")):
+            max_age = max_age_seconds
+        else:
+            continue
+        if age < max_age:
+            continue
+
+        try:
+            if entry.name.endswith(".lock"):
+                # Held locks are skipped. Workers waiting for a deleted lock file
+                # take the lock again with a new one
+                with lib_utils.file_lock(entry.name[: -len(".lock")], blocking=False):
+                    os.remove(entry.path)
+            elif entry.name.endswith(single_flight.MARKER_SUFFIX):
+                # Only read by the workers waiting for the flight when it finished,
+                # so skipped while a flight of the same key is running
+                name = entry.name[: -len(single_flight.MARKER_SUFFIX)]
+                with lib_utils.file_lock(name, blocking=False):
+                    os.remove(entry.path)
+            else:
+                os.remove(entry.path)
+        except (BlockingIOError, FileNotFoundError):
+            continue
+        deleted += 1
+
+    logger.info("Locks sweep: %s files deleted", deleted)
+    return deleted
+
+
+def sweep_portfolios(ttl_seconds: float) -> list[str]:
+    """
+    Delete the portfolio jobs finished before the ttl, with their archive and
+    results. Jobs queued or running are skipped.
+
+    :param ttl_seconds: Max age of a finished job
+    :return: The ids of the deleted jobs
+    """
+    now = time.time()
+    deleted = []
+    for jobId in portfolio.list_jobs():
+        try:
+            # Reports the jobs interrupted by a restart as finished
+            if portfolio.get_job(jobId)["status"] in portfolio.ACTIVE_STATUSES:
+                continue
+            finished = os.path.getmtime(
+                os.path.join(PATHS["portfolios"], jobId, "status.json")
+            )
+            if now - finished <= ttl_seconds:
+                continue
+            portfolio.delete_job(jobId)
+        except (BlockingIOError, FileNotFoundError):
+            continue
+        deleted.append(jobId)
+
+    logger.info("Portfolios sweep: %s jobs deleted", len(deleted))
+    return deleted
+
+
+def _sweeper_loop() -> None:
+    while not _sweeper_stop.wait(RETENTION["sweep_interval_seconds"]):
+        try:
+            # Only one worker sweeps at a time
+            with lib_utils.file_lock("retention", blocking=False):
+                if RETENTION["ttl_seconds"] or RETENTION["max_bytes"]:
+                    sweep(RETENTION["ttl_seconds"], RETENTION["max_bytes"])
+                if RETENTION["portfolio_ttl_seconds"]:
+                    sweep_portfolios(RETENTION["portfolio_ttl_seconds"])
+                sweep_locks()
+        except BlockingIOError:
+            pass
+        except Exception as e:
+            logger.exception(e)
+
+
+def start_sweeper() -> None:
+    """
+    Start the background sweeper of the locks folder and of the finished portfolio
+    jobs, which also deletes old analyses if a ttl or a disk budget is configured
+    with RETENTION_TTL_DAYS or OUTPUT_MAX_BYTES.
+    """
+    global _sweeper_thread
+
+    if _sweeper_thread is not None and _sweeper_thread.is_alive():
+        return
+
+    _sweeper_stop.clear()
+    _sweeper_thread = threading.Thread(
+        target=_sweeper_loop, name="retention-sweeper", daemon=True
+    )
+    _sweeper_thread.start()
+    logger.info("Retention sweeper started")
+
+
+def stop_sweeper() -> None:
+    """
+    Stop the background retention sweeper.
+    """
+    _sweeper_stop.set()
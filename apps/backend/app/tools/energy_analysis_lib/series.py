@@ -0,0 +1,265 @@
+"""
+Hourly series of an analysis for any time range, downsampled to a max number of
+points, e.g. to zoom into a chart.
+
+The series is stored once per analysis as a (3 x hours) .npy file: the sorted time
+index, in hours since EPOCH, and the consumption and production of every hour. The
+dates come from the consumption file, so the series keeps its real years. It is
+memory-mapped, so a range only reads its own pages, found with a binary search of
+the time index, and its points are picked with the Largest-Triangle-Three-Buckets
+algorithm, which keeps the peaks and the shape of the series.
+"""
+
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+from tools.energy_analysis_lib import storage
+from tools.energy_analysis_lib import utils as lib_utils
+from tools.utils import logger
+
+from .constants import PATHS
+from .load_shifting import load_hourly_data
+
+EPOCH = datetime.datetime(1970, 1, 1)
+# In the name of the files and in ANALYSIS_ARTIFACTS, so the files of older versions
+# are built again. Version 1 placed every series in 2024
+SERIES_VERSION = 2
+MEASURES = ["consumption", "production"]
+MAX_POINTS = 10000
+TIME_FORMAT = "%Y-%m-%dT%H:%M"
+
+
+def lttb(x: np.ndarray, y: np.ndarray, max_points: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets downsampling. The first and last points are kept
+    and the rest are split in max_points - 2 buckets; from each bucket the point
+    forming the largest triangle with the point picked from the previous bucket and
+    the mean of the next bucket is picked.
+
+    :param x: Sorted x of the points
+    :param y: y of the points
+    :param max_points: Max points returned, at least 3
+    :return: Sorted indexes of the points picked
+    """
+    n = len(x)
+    if max_points >= n:
+        return np.arange(n)
+    if max_points < 3:
+        raise ValueError("At least 3 points are needed to downsample")
+
+    # Bucket i is [edges[i], edges[i + 1]), the last point is its own bucket
+    edges = (np.arange(max_points - 1) * (n - 2) / (max_points - 2)).astype(int) + 1
+    edges = np.append(edges, n)
+    # Means of every bucket from cumulative sums, for the next bucket of each
+    x_sums = np.concatenate([[0], np.cumsum(x, dtype=float)])
+    y_sums = np.concatenate([[0], np.cumsum(y, dtype=float)])
+    sizes = np.diff(edges)
+    x_means = (x_sums[edges[1:]] - x_sums[edges[:-1]]) / sizes
+    y_means = (y_sums[edges[1:]] - y_sums[edges[:-1]]) / sizes
+
+    picked = np.empty(max_points, dtype=int)
+    picked[0] = 0
+    picked[-1] = n - 1
+    a = 0
+    # Each bucket depends on the point picked from the previous one
+    for i in range(max_points - 2):
+        start, end = edges[i], edges[i + 1]
+        bucket_x = x[start:end]
+        bucket_y = y[start:end]
+        # Twice the area of the triangles, the constant factor does not matter
+        area = np.abs(
+            (x[a] - x_means[i + 1]) * (bucket_y - y[a])
+            - (x[a] - bucket_x) * (y_means[i + 1] - y[a])
+        )
+        a = start + int(area.argmax())
+        picked[i + 1] = a
+
+    return picked
+
+
+def _path(analysisId: str) -> str:
+    return os.path.join(PATHS["results_series"], f"{analysisId}_v{SERIES_VERSION}.npy")
+
+
+def _input_paths(analysisId: str) -> list[str]:
+    return [
+        storage.fetch(os.path.join(PATHS[path], f"{analysisId}.csv"))
+        for path in ["consumption_parsed_hourly", "production_parsed_hourly"]
+    ]
+
+
+def load_dates(analysisId: str, df: pd.DataFrame) -> pd.Series:
+    """
+    Returns the date of every row of the hourly data of an analysis, from the
+    'Datetime' column of the parsed consumption. The days of the production
+    without consumption are placed in the year of consumption they fall in,
+    counting from its first day.
+
+    :param analysisId: id of the user
+    :param df: hourly data with 'Month' and 'Day'
+    :return: date of every row, NaT for the days that do not exist that year, e.g.
+        the 29th of February of the production of a leap year
+    """
+    try:
+        consumption = pd.read_csv(
+            storage.fetch(
+                os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv")
+            ),
+            sep=";",
+            encoding="UTF-8",
+            usecols=["Datetime", "Month", "Day"],
+        )
+    except FileNotFoundError:
+        raise FileNotFoundError("Consumption file not found")
+    consumption["Date"] = pd.to_datetime(consumption["Datetime"]).dt.normalize()
+    consumption = consumption.drop_duplicates(["Month", "Day"])
+
+    dates = df[["Month", "Day"]].merge(
+        consumption[["Month", "Day", "Date"]], on=["Month", "Day"], how="left"
+    )["Date"]
+
+    missing = dates.isna().to_numpy()
+    if missing.any():
+        first = consumption["Date"].min()
+        months = df["Month"].to_numpy()
+        days = df["Day"].to_numpy()
+        before = (months < first.month) | ((months == first.month) & (days < first.day))
+        dates[missing] = pd.to_datetime(
+            pd.DataFrame({"year": first.year + before, "month": months, "day": days})[
+                missing
+            ],
+            errors="coerce",
+        )
+
+    return dates
+
+
+def build_series(analysisId: str) -> str:
+    """
+    Converts the hourly consumption and production of an analysis to a (3 x hours)
+    array: the sorted time index in hours since EPOCH, the consumption and the
+    production.
+
+    :param analysisId: id of the user
+    :return: path of the .npy file
+    """
+    df = load_hourly_data(analysisId)
+    dates = load_dates(analysisId, df)
+    df = df[dates.notna().to_numpy()]
+    dates = dates.dropna()
+
+    # Same alignment as the rest of the analysis: the consumption and the
+    # production of the same hour number are merged, hours go from 0 to 24
+    days = dates.to_numpy().astype("datetime64[D]").astype(np.int64)
+    hours = days * 24 + df["Hour"].to_numpy()
+    # Hour 24 of a day and hour 0 of the next are the same time
+    index, position = np.unique(hours, return_inverse=True)
+    series = np.stack(
+        [
+            index.astype(float),
+            np.bincount(position, weights=df["Energy_consumption"].to_numpy()),
+            np.bincount(position, weights=df["Energy_production"].to_numpy()),
+        ]
+    )
+
+    saved_path = _path(analysisId)
+    with lib_utils.atomic_write(saved_path, "wb") as f:
+        np.save(f, series)
+    logger.info("Written file %s", saved_path)
+
+    return saved_path
+
+
+def load_series(analysisId: str) -> np.ndarray:
+    """
+    Maps the series of an analysis, building it again when it is missing or older
+    than the parsed files.
+
+    :param analysisId: id of the user
+    :return: read-only (3 x hours) array
+    """
+    inputs = [path for path in _input_paths(analysisId) if os.path.exists(path)]
+    if not inputs:
+        raise FileNotFoundError("Consumption file not found")
+
+    path = _path(analysisId)
+    if not (
+        os.path.exists(path)
+        and os.path.getmtime(path) >= max(map(os.path.getmtime, inputs))
+    ):
+        build_series(analysisId)
+
+    return np.load(path, mmap_mode="r")
+
+
+def _to_hours(value: str | None, default: float) -> float:
+    if value is None:
+        return default
+    try:
+        time = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid time: {value}, expected YYYY-MM-DDTHH:MM")
+    return (time.replace(tzinfo=None) - EPOCH).total_seconds() / 3600
+
+
+def get_series(
+    analysisId: str,
+    start: str | None = None,
+    end: str | None = None,
+    max_points: int = 1000,
+    measures: list[str] | None = None,
+) -> dict:
+    """
+    Returns the hourly series of an analysis between two times, downsampled to
+    max_points per measure.
+
+    :param analysisId: id of the user
+    :param start: first time, ISO format, the start of the series if None
+    :param end: last time, included, the end of the series if None
+    :param max_points: max points of each measure, from 3 to MAX_POINTS
+    :param measures: measures returned, MEASURES if None
+    :return: dict with the 'from' and 'to' times, the number of 'hours' in the range
+        and the 'time' and 'energy' (kWh) of the points of every measure
+    """
+    measures = measures or MEASURES
+    unknown = set(measures) - set(MEASURES)
+    if unknown:
+        raise ValueError(f"Unknown measures: {', '.join(sorted(unknown))}")
+    if not 3 <= max_points <= MAX_POINTS:
+        raise ValueError(f"The max points must be between 3 and {MAX_POINTS}")
+    first = _to_hours(start, -np.inf)
+    last = _to_hours(end, np.inf)
+    if first > last:
+        raise ValueError("The start of the range must be before its end")
+
+    series = load_series(analysisId)
+
+    # Binary search of the range in the sorted time index
+    low = np.searchsorted(series[0], first, side="left")
+    high = np.searchsorted(series[0], last, side="right")
+    # Only the pages of the range are read
+    hours = np.asarray(series[0, low:high])
+
+    def times(values: np.ndarray) -> list[str]:
+        return [
+            (EPOCH + datetime.timedelta(hours=int(value))).strftime(TIME_FORMAT)
+            for value in values
+        ]
+
+    results = {}
+    for measure in measures:
+        energy = np.asarray(series[1 + MEASURES.index(measure), low:high])
+        picked = lttb(hours, energy, max_points)
+        results[measure] = {
+            "time": times(hours[picked]),
+            "energy": energy[picked].round(3).tolist(),
+        }
+
+    return {
+        "from": times(hours[:1])[0] if len(hours) else None,
+        "to": times(hours[-1:])[0] if len(hours) else None,
+        "hours": len(hours),
+        "series": results,
+    }
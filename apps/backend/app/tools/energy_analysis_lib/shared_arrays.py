@@ -0,0 +1,169 @@
+"""
+Read-only arrays shared by the workers of a host: the calendar of the time slots
+and the multi-year production of the analyses. The single-year production and the
+json caches are still parsed by every worker.
+
+They are stored as uncompressed .npy files and memory-mapped, so every uvicorn and
+pool worker maps the same pages of the page cache instead of holding its own copy,
+and a worker started later finds them already in memory.
+"""
+
+import functools
+import hashlib
+import json
+import os
+
+import numpy as np
+from tools.energy_analysis_lib import storage
+from tools.energy_analysis_lib import utils as lib_utils
+from tools.utils import logger
+
+from .constants import PATHS, TIME_SLOTS
+
+# Year of the calendar, the same as is_within_time_slot. A leap year, so every
+# month and day of the data has a day of the year
+CALENDAR_YEAR = 2024
+DAYS_PER_MONTH = np.array([31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+MONTH_STARTS = np.concatenate([[0], np.cumsum(DAYS_PER_MONTH)[:-1]])
+# Hours of the parsed files go from 0 (production) to 25 (change to winter time)
+CALENDAR_HOURS = 26
+
+
+def calendar_names() -> list[str]:
+    return [
+        time_slot_name + "_" + time_slot_type
+        for time_slot_name, time_slot in TIME_SLOTS.items()
+        for time_slot_type in time_slot
+    ]
+
+
+def _calendar_path() -> str:
+    # A new file when the time slots change, the workers with the old time slots
+    # keep their own
+    digest = hashlib.sha256(
+        json.dumps([CALENDAR_YEAR, TIME_SLOTS], sort_keys=True).encode("utf-8")
+    ).hexdigest()[:16]
+    return os.path.join(PATHS["shared"], f"calendar-{digest}.npy")
+
+
+def build_calendar() -> str:
+    """
+    Calculates the time slot masks of every hour of the calendar year.
+
+    :return: path of the .npy file with a (time slots x 366 days x 26 hours)
+        boolean array, in the order of calendar_names
+    """
+    days = np.arange(366)
+    months = np.searchsorted(MONTH_STARTS, days, side="right")
+    month_of_day = np.repeat(months, CALENDAR_HOURS)
+    day_of_month = np.repeat(days - MONTH_STARTS[months - 1] + 1, CALENDAR_HOURS)
+    hours = np.tile(np.arange(CALENDAR_HOURS), len(days))
+
+    masks = lib_utils.compute_time_slot_masks(month_of_day, day_of_month, hours)
+    calendar = np.stack([masks[name] for name in calendar_names()]).reshape(
+        len(masks), len(days), CALENDAR_HOURS
+    )
+
+    path = _calendar_path()
+    with lib_utils.atomic_write(path, "wb") as f:
+        np.save(f, calendar)
+    logger.info("Written file %s", path)
+
+    return path
+
+
+@functools.cache
+def get_calendar() -> np.ndarray:
+    """
+    Maps the calendar of the time slots, building it if no worker did it yet.
+
+    :return: read-only (time slots x 366 days x 26 hours) boolean array
+    """
+    path = _calendar_path()
+    if not os.path.exists(path):
+        with lib_utils.file_lock("calendar"):
+            if not os.path.exists(path):
+                build_calendar()
+
+    return np.load(path, mmap_mode="r")
+
+
+def calendar_masks(
+    months: np.ndarray, days: np.ndarray, hours: np.ndarray
+) -> dict[str, np.ndarray]:
+    """
+    Looks up the time slot masks of an hourly series in the shared calendar.
+
+    :param months: month of every row
+    :param days: day of every row
+    :param hours: hour of every row, from 0 to 25
+    :return: dict "<time slot name>_<time slot type>" -> boolean mask
+    """
+    calendar = get_calendar()
+    day_of_year = MONTH_STARTS[np.asarray(months) - 1] + np.asarray(days) - 1
+    # One gather for every time slot
+    masks = calendar[:, day_of_year, np.asarray(hours)]
+
+    return dict(zip(calendar_names(), masks))
+
+
+def map_production_series(analysisId: str) -> (np.ndarray, np.ndarray):
+    """
+    Maps the multi-year hourly production of an analysis. The compressed file of
+    the analysis is extracted once to a .npy file next to it.
+
+    :param analysisId: id of the user
+    :return: years, read-only (years x 8760) array with the hourly energy
+    """
+    path = storage.fetch(
+        os.path.join(PATHS["production_parsed_series"], f"{analysisId}.npz")
+    )
+    mapped_path = os.path.splitext(path)[0] + ".npy"
+
+    try:
+        with np.load(path) as series:
+            years = series["years"]
+            # Extracted again when the production is parsed again
+            if not (
+                os.path.exists(mapped_path)
+                and os.path.getmtime(mapped_path) >= os.path.getmtime(path)
+            ):
+                with lib_utils.atomic_write(mapped_path, "wb") as f:
+                    np.save(f, series["energy"])
+    except FileNotFoundError:
+        raise FileNotFoundError("Production series file not found")
+
+    return years, np.load(mapped_path, mmap_mode="r")
+
+
+def preload() -> None:
+    """
+    Maps the calendar and the production series already extracted by the requests
+    and reads them once, so they are in the page cache before the first request.
+    The series of the other analyses are not extracted, which would double their
+    size on disk.
+    """
+    arrays = [get_calendar()]
+
+    try:
+        names = os.listdir(PATHS["production_parsed_series"])
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        if os.path.splitext(name)[1] != ".npy":
+            continue
+        try:
+            arrays.append(
+                np.load(
+                    os.path.join(PATHS["production_parsed_series"], name),
+                    mmap_mode="r",
+                )
+            )
+        except (OSError, ValueError) as e:
+            logger.error("Could not map the production series of %s: %s", name, e)
+
+    size = sum(array.nbytes for array in arrays)
+    for array in arrays:
+        # Read every page
+        np.asarray(array).sum()
+    logger.info("Preloaded %s shared arrays, %s bytes", len(arrays), size)
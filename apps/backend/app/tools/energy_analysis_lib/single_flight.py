@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from tools.energy_analysis_lib import utils as lib_utils
+from tools.utils import logger
+
+from .constants import PATHS
+
+# Results shared with the workers waiting for a flight, deleted by the sweeper of the
+# locks folder once they are old
+MARKER_SUFFIX = ".flight.json"
+
+
+class _Call:
+    """
+    A computation in flight in this process.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_calls: dict[str, _Call] = {}
+_calls_lock = threading.Lock()
+
+
+def _marker_path(name: str) -> str:
+    return os.path.join(PATHS["locks"], f"{name}{MARKER_SUFFIX}")
+
+
+def _run_across_workers(key: str, fn):
+    """
+    Run fn under a lock shared by the workers. A worker that was waiting for the lock
+    while another one computed the same key takes its result instead of computing it
+    again.
+    """
+    # Keys can be long or contain any character
+    name = "flight-" + hashlib.sha256(key.encode("utf-8")).hexdigest()
+    started = time.time()
+
+    with lib_utils.file_lock(name):
+        try:
+            with open(_marker_path(name), "r") as f:
+                marker = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            marker = None
+
+        # Only results finished while this worker was waiting are shared, older ones
+        # may be out of date
+        if marker is not None and marker["finished"] >= started:
+            logger.info("Sharing the result of %s computed by another worker", key)
+            return marker["result"]
+
+        result = fn()
+
+        with lib_utils.atomic_write(_marker_path(name), "w") as f:
+            json.dump({"finished": time.time(), "result": result}, f)
+
+    return result
+
+
+def do(key: str, fn):
+    """
+    Run fn once for all the concurrent calls with the same key. Calls that arrive
+    while the key is being computed, in this process or in another worker, wait for
+    the computation and get its result or its exception.
+
+    :param key: The key of the computation, e.g. an analysis id with its inputs
+    :param fn: Function without arguments that computes the result. The result must
+        be json serializable to be shared with other workers
+    :return: The result of fn
+    """
+    with _calls_lock:
+        call = _calls.get(key)
+        leader = call is None
+        if leader:
+            call = _calls[key] = _Call()
+
+    if not leader:
+        logger.info("Waiting for %s, already in flight", key)
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    try:
+        call.result = _run_across_workers(key, fn)
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _calls_lock:
+            del _calls[key]
+        call.done.set()
+
+    return call.result
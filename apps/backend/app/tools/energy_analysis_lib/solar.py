@@ -1,20 +1,17 @@
 import datetime
-import logging
 import os
 
 import numpy as np
 import pandas as pd
 import tools.pvgis_api_wrapper as api
-from matplotlib import pyplot as plt
+from tools.energy_analysis_lib import shared_arrays, storage
 from tools.energy_analysis_lib import utils as lib_utils
 from tools.utils import logger
 
-from .constants import PATHS, TIME_SLOTS
+from .constants import HOLIDAYS, PATHS, SEASONS, TIME_SLOTS
 from .energy import process_results_time_slot_energy
 from .utils import is_within_time_slot
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
-
 
 def parse_monthly_production_file(analysisId: str) -> None:
     """
@@ -27,7 +24,7 @@ def parse_monthly_production_file(analysisId: str) -> None:
 
     # Import the csv file as a pandas dataframe
     df = pd.read_csv(
-        os.path.join(PATHS["production_monthly"], f"{analysisId}.csv"),
+        storage.fetch(os.path.join(PATHS["production_monthly"], f"{analysisId}.csv")),
         sep="\t",
         decimal=".",
         thousands=",",
@@ -47,7 +44,7 @@ def parse_monthly_production_file(analysisId: str) -> None:
     saved_path = lib_utils.save_csv_file(
         PATHS["production_parsed_monthly"], analysisId, df
     )
-    logger.info(f"Written file {saved_path}")
+    logger.info("Written file %s", saved_path)
 
 
 def parse_hourly_production_file(analysisId: str) -> None:
@@ -60,12 +57,15 @@ def parse_hourly_production_file(analysisId: str) -> None:
     """
 
     # Count file lines
-    with open(os.path.join(PATHS["production_hourly"], f"{analysisId}.csv"), "r") as f:
+    with open(
+        storage.fetch(os.path.join(PATHS["production_hourly"], f"{analysisId}.csv")),
+        "r",
+    ) as f:
         n_lines = sum(1 for line in f)
 
     # Import the csv file as a pandas dataframe
     df = pd.read_csv(
-        os.path.join(PATHS["production_hourly"], f"{analysisId}.csv"),
+        storage.fetch(os.path.join(PATHS["production_hourly"], f"{analysisId}.csv")),
         sep=",",
         decimal=".",
         thousands=",",
@@ -103,71 +103,429 @@ def parse_hourly_production_file(analysisId: str) -> None:
     saved_path = lib_utils.save_csv_file(
         PATHS["production_parsed_hourly"], analysisId, df
     )
-    logger.info(f"Written file {saved_path}")
+    logger.info("Written file %s", saved_path)
 
 
-def consumption_production_chart(
-    location: str,
-    peakpower: float,
-    mountingplace: str,
-    loss: float,
-    angle: float,
-    aspect: float,
-    analysisId: str,
-) -> None:
+# Hours of a year without 29 February
+HOURS_PER_YEAR = 8760
+DAYS_PER_MONTH = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+# First hour of every month in a year without 29 February
+MONTH_STARTS = np.concatenate([[0], np.cumsum(DAYS_PER_MONTH)[:-1]]) * 24
+
+
+def parse_production_series_file(analysisId: str) -> None:
     """
-    Generates a chart with the consumption and production data for a location
+    Converts a csv file with the multi-year hourly production to a compressed npz
+    file with 2 arrays: 'years' and 'energy', the hourly energy in kWh as a
+    (years x 8760) array. 29 February is deleted from leap years.
 
-    :param location: location to get the data
-    :param peakpower: peak power of the installation
-    :param mountingplace: mounting place of the installation
-    :param loss: loss of the installation
-    :param angle: angle of the installation
-    :param aspect: aspect of the installation
     :param analysisId: id of the user
     :return: None
     """
+    path = storage.fetch(os.path.join(PATHS["production_series"], f"{analysisId}.csv"))
+
+    # Count file lines
+    with open(path, "r") as f:
+        n_lines = sum(1 for line in f)
+
+    # Import only the time and power columns
+    df = pd.read_csv(
+        path,
+        sep=",",
+        decimal=".",
+        thousands=",",
+        encoding="UTF-8",
+        skiprows=10,
+        nrows=n_lines - 22,
+        usecols=["time", "P"],
+    )
+    logger.info("File imported")
+
+    time = pd.to_datetime(df["time"], format="%Y%m%d:%H%M")
+
+    # Delete 29th of February
+    keep = ~((time.dt.month == 2) & (time.dt.day == 29)).to_numpy()
+    years = np.unique(time.dt.year.to_numpy()[keep])
+
+    # Divide by 1000 to convert from Wh to kWh
+    energy = df["P"].to_numpy()[keep] / 1000
+    if energy.size != years.size * HOURS_PER_YEAR:
+        raise ValueError(
+            f"The production series has {energy.size} hours, expected "
+            f"{years.size * HOURS_PER_YEAR} for {years.size} years"
+        )
+    energy = energy.reshape(years.size, HOURS_PER_YEAR).astype(np.float32)
+
+    # Save the arrays as a compressed npz file
+    saved_path = os.path.join(PATHS["production_parsed_series"], f"{analysisId}.npz")
+    with lib_utils.atomic_write(saved_path, "wb") as f:
+        np.savez_compressed(f, years=years, energy=energy)
+    logger.info("Written file %s", saved_path)
+
+
+def load_production_series(analysisId: str) -> (np.ndarray, np.ndarray):
+    """
+    Loads the parsed multi-year hourly production, memory-mapped and shared by the
+    workers of the host
+
+    :param analysisId: id of the user
+    :return: years, read-only (years x 8760) array with the hourly energy
+    """
+    return shared_arrays.map_production_series(analysisId)
+
+
+def load_hourly_consumption_array(analysisId: str) -> (np.ndarray, float):
+    """
+    Loads the parsed hourly consumption as an array aligned with the hours of the
+    production series
+
+    :param analysisId: id of the user
+    :return: array with the energy of each of the 8760 hours, total consumption
+        including the hours without production
+    """
+    try:
+        df = pd.read_csv(
+            storage.fetch(
+                os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv")
+            ),
+            sep=";",
+            decimal=",",
+            thousands=".",
+            encoding="UTF-8",
+            usecols=["Month", "Day", "Hour", "Energy"],
+        )
+    except FileNotFoundError:
+        raise FileNotFoundError("Consumption file not found")
+
+    month = df["Month"].to_numpy()
+    day = df["Day"].to_numpy()
+    hour = df["Hour"].to_numpy()
+    energy = df["Energy"].to_numpy(dtype=float)
+
+    # Same alignment as the merge on 'Month', 'Day', 'Hour' of the rest of the
+    # solar analysis: hours without production are only counted as consumption
+    valid = (hour <= 23) & ~((month == 2) & (day == 29))
+    index = MONTH_STARTS[month[valid] - 1] + (day[valid] - 1) * 24 + hour[valid]
+
+    consumption = np.zeros(HOURS_PER_YEAR)
+    np.add.at(consumption, index, energy[valid])
+
+    return consumption, float(energy.sum())
+
+
+def get_production_statistics(analysisId: str) -> dict:
+    """
+    Calculates the production, self consumption and surplus of every year of the
+    production series with the same consumption, and their mean, P50 and P90.
+    P90 is the value exceeded in 90% of the years.
+
+    :param analysisId: id of the user
+    :return: dict with the years and the 'annual' and 'monthly' statistics of
+        'production', 'self_consumption', 'surplus' and 'self_consumption_ratio'
+    """
+    years, production = load_production_series(analysisId)
+    consumption, total_consumption = load_hourly_consumption_array(analysisId)
+    logger.info("Production series of %s years loaded", years.size)
+
+    # (3 x years x 8760): production, self consumption and surplus of every hour
+    self_consumption = np.minimum(production, consumption)
+    energy = np.stack([production, self_consumption, production - self_consumption])
+
+    monthly = np.add.reduceat(energy, MONTH_STARTS, axis=2)
+    annual = monthly.sum(axis=2)
+
+    # Ratios of every year, 0 without production
+    with np.errstate(divide="ignore", invalid="ignore"):
+        monthly_ratio = np.nan_to_num(monthly[1] / monthly[0])
+        annual_ratio = np.nan_to_num(annual[1] / annual[0])
+    monthly = np.concatenate([monthly, monthly_ratio[np.newaxis]])
+    annual = np.concatenate([annual, annual_ratio[np.newaxis]])
+
+    def statistics(values: np.ndarray) -> dict:
+        # Statistics across the years, the second axis
+        p50, p90 = np.percentile(values, [50, 10], axis=1)
+        return {
+            "mean": values.mean(axis=1),
+            "p50": p50,
+            "p90": p90,
+        }
+
+    names = ["production", "self_consumption", "surplus", "self_consumption_ratio"]
+    annual_statistics = statistics(annual)
+    monthly_statistics = statistics(monthly)
+
+    return {
+        "years": years.tolist(),
+        "consumption": round(total_consumption, 3),
+        "annual": {
+            name: {
+                **{
+                    key: round(float(values[i]), 3)
+                    for key, values in annual_statistics.items()
+                },
+                "by_year": annual[i].round(3).tolist(),
+            }
+            for i, name in enumerate(names)
+        },
+        "monthly": {
+            name: {
+                key: values[i].round(3).tolist()
+                for key, values in monthly_statistics.items()
+            }
+            for i, name in enumerate(names)
+        },
+    }
+
+
+# Axes of the profile cube
+DAY_TYPES = ["weekday", "weekend", "holiday"]
+PROFILE_MEASURES = ["consumption", "production", "self_consumption", "surplus"]
+
+
+def build_profile_cube(analysisId: str) -> str:
+    """
+    Sums the consumption, production, self consumption and surplus of every month,
+    day type (weekday, weekend or holiday) and hour, and counts the days of each,
+    so the average daily profile of any group of days is calculated without the
+    hourly data
+
+    :param analysisId: id of the user
+    :return: path of the npz file with 'sums' (measures x 12 months x day types x
+        24 hours) and 'counts' (12 months x day types x 24 hours)
+    """
+    try:
+        df_consumption = pd.read_csv(
+            storage.fetch(
+                os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv")
+            ),
+            sep=";",
+            decimal=",",
+            thousands=".",
+            encoding="UTF-8",
+            usecols=["Datetime", "Month", "Day", "Hour", "Energy"],
+        )
+    except FileNotFoundError:
+        raise FileNotFoundError("Consumption file not found")
+
+    try:
+        df_production = pd.read_csv(
+            storage.fetch(
+                os.path.join(PATHS["production_parsed_hourly"], f"{analysisId}.csv")
+            ),
+            sep=";",
+            decimal=",",
+            thousands=".",
+            encoding="UTF-8",
+            usecols=["Month", "Day", "Hour", "Energy"],
+        )
+    except FileNotFoundError:
+        raise FileNotFoundError("Production file not found")
+
+    # Same alignment as the rest of the solar analysis. Only the hours with
+    # consumption are days of data
+    df = pd.merge(
+        df_consumption,
+        df_production,
+        on=["Month", "Day", "Hour"],
+        how="left",
+        suffixes=("_consumption", "_production"),
+    )
+    df = df[(df["Hour"] >= 1) & (df["Hour"] <= 24)]
+
+    month = df["Month"].to_numpy()
+    day = df["Day"].to_numpy()
+    hour = df["Hour"].to_numpy()
+    consumption = df["Energy_consumption"].to_numpy(dtype=float)
+    production = df["Energy_production"].fillna(0).to_numpy(dtype=float)
+    self_consumption = np.minimum(consumption, production)
+    measures = np.stack(
+        [consumption, production, self_consumption, production - self_consumption]
+    )
+
+    # Holidays take precedence over weekends
+    weekend = pd.to_datetime(df["Datetime"]).dt.weekday.to_numpy() >= 5
+    holiday = np.isin(month * 100 + day, [m * 100 + d for m, d in HOLIDAYS])
+    day_type = np.where(holiday, 2, weekend.astype(int))
+
+    # Index of the cell of each hour in the flattened cube
+    shape = (12, len(DAY_TYPES), 24)
+    cell = np.ravel_multi_index((month - 1, day_type, hour - 1), shape)
+    size = np.prod(shape)
+    counts = np.bincount(cell, minlength=size).reshape(shape)
+    sums = np.stack(
+        [np.bincount(cell, weights=values, minlength=size) for values in measures]
+    ).reshape(len(PROFILE_MEASURES), *shape)
+
+    saved_path = os.path.join(PATHS["results_profiles"], f"{analysisId}.npz")
+    with lib_utils.atomic_write(saved_path, "wb") as f:
+        np.savez_compressed(f, sums=sums, counts=counts)
+    logger.info("Written file %s", saved_path)
+
+    return saved_path
+
+
+def get_profiles(
+    analysisId: str,
+    months: list[int] | None = None,
+    day_types: list[str] | None = None,
+    group_by: str | None = None,
+) -> dict:
+    """
+    Calculates the average daily profiles of a group of days from the profile cube
+
+    :param analysisId: id of the user
+    :param months: months of the days, every month if None
+    :param day_types: types of the days ('weekday', 'weekend' or 'holiday'), every
+        type if None
+    :param group_by: one profile for each 'month', 'day_type' or 'season' of the
+        days, or a single profile if None
+    :return: dict with the 'hours' and the 'profiles', each with its 'group', its
+        number of 'days' and the average energy of every hour of each measure
+    """
+    months = sorted(set(months or range(1, 13)))
+    day_types = day_types or DAY_TYPES
+    if not all(1 <= month <= 12 for month in months):
+        raise ValueError("Months must be between 1 and 12")
+    unknown = [day_type for day_type in day_types if day_type not in DAY_TYPES]
+    if unknown:
+        raise ValueError(f"Unknown day types: {', '.join(unknown)}")
+
+    if group_by is None:
+        groups = [("all", months, day_types)]
+    elif group_by == "month":
+        groups = [(str(month), [month], day_types) for month in months]
+    elif group_by == "day_type":
+        groups = [(day_type, months, [day_type]) for day_type in day_types]
+    elif group_by == "season":
+        groups = [
+            (season, [month for month in season_months if month in months], day_types)
+            for season, season_months in SEASONS.items()
+        ]
+        groups = [group for group in groups if group[1]]
+    else:
+        raise ValueError(f"Unknown grouping: {group_by}")
+
+    try:
+        with np.load(
+            storage.fetch(os.path.join(PATHS["results_profiles"], f"{analysisId}.npz"))
+        ) as data:
+            sums = data["sums"]
+            counts = data["counts"]
+    except FileNotFoundError:
+        raise FileNotFoundError("Profile cube not found")
+
+    profiles = []
+    for name, group_months, group_day_types in groups:
+        month_index = np.array(group_months) - 1
+        type_index = [DAY_TYPES.index(day_type) for day_type in group_day_types]
+        # (measures x 24) sums and (24) days of the cells of the group
+        group_sums = sums[:, month_index][:, :, type_index].sum(axis=(1, 2))
+        group_counts = counts[month_index][:, type_index].sum(axis=(0, 1))
+        averages = np.divide(
+            group_sums,
+            group_counts,
+            out=np.zeros_like(group_sums),
+            where=group_counts > 0,
+        )
+
+        profile = {"group": name, "days": int(group_counts.max())}
+        for measure, values in zip(PROFILE_MEASURES, averages):
+            profile[measure] = np.round(values, 3).tolist()
+        profiles.append(profile)
+
+    return {"hours": list(range(1, 25)), "profiles": profiles}
+
+
+def load_merged_hourly_data(analysisId: str) -> pd.DataFrame:
+    """
+    Loads the parsed hourly consumption and production data merged on
+    'Month', 'Day', 'Hour' and sorted chronologically. Missing values are 0.
+
+    :param analysisId: id of the user
+    :return: dataframe with 'Energy_consumption' and 'Energy_production' columns
+    """
 
     # Load the consumption data
     try:
         df_consumption = pd.read_csv(
-            os.path.join(PATHS["consumption_parsed_monthly"], f"{analysisId}.csv"),
+            storage.fetch(
+                os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv")
+            ),
             sep=";",
             decimal=",",
             thousands=".",
             encoding="UTF-8",
+            usecols=["Month", "Day", "Hour", "Energy"],
         )
     except FileNotFoundError:
         raise FileNotFoundError("Consumption file not found")
-    logger.info("Consumption data loaded")
 
     # Load the production data
     try:
         df_production = pd.read_csv(
-            os.path.join(PATHS["production_parsed_monthly"], f"{analysisId}.csv"),
+            storage.fetch(
+                os.path.join(PATHS["production_parsed_hourly"], f"{analysisId}.csv")
+            ),
             sep=";",
             decimal=",",
             thousands=".",
             encoding="UTF-8",
         )
     except FileNotFoundError:
-        api.get_monthly_production(
-            location=location,
-            peakpower=peakpower,
-            mountingplace=mountingplace,
-            loss=loss,
-            angle=angle,
-            aspect=aspect,
-            analysisId=analysisId,
+        raise FileNotFoundError("Production file not found")
+
+    # Same alignment as the rest of the solar analysis
+    df = pd.merge(
+        df_consumption,
+        df_production,
+        on=["Month", "Day", "Hour"],
+        how="outer",
+        suffixes=("_consumption", "_production"),
+    )
+    df = df.sort_values(["Month", "Day", "Hour"]).reset_index(drop=True)
+    df[["Energy_consumption", "Energy_production"]] = df[
+        ["Energy_consumption", "Energy_production"]
+    ].fillna(0)
+
+    return df
+
+
+def load_consumption_production_monthly(analysisId: str) -> pd.DataFrame:
+    """
+    Loads the parsed monthly consumption and production data merged on 'Month'
+
+    :param analysisId: id of the user
+    :return: dataframe with 'Month', 'Energy_consumption' and 'Energy_production'
+    """
+
+    # Load the consumption data
+    try:
+        df_consumption = pd.read_csv(
+            storage.fetch(
+                os.path.join(PATHS["consumption_parsed_monthly"], f"{analysisId}.csv")
+            ),
+            sep=";",
+            decimal=",",
+            thousands=".",
+            encoding="UTF-8",
         )
-        parse_monthly_production_file(analysisId)
+    except FileNotFoundError:
+        raise FileNotFoundError("Consumption file not found")
+    logger.info("Consumption data loaded")
+
+    # Load the production data
+    try:
         df_production = pd.read_csv(
-            os.path.join(PATHS["production_parsed_monthly"], f"{analysisId}.csv"),
+            storage.fetch(
+                os.path.join(PATHS["production_parsed_monthly"], f"{analysisId}.csv")
+            ),
             sep=";",
             decimal=",",
             thousands=".",
             encoding="UTF-8",
         )
+    except FileNotFoundError:
+        raise FileNotFoundError("Production file not found")
     logger.info("Production data loaded")
 
     # Merge the consumption and production data
@@ -181,6 +539,66 @@ def consumption_production_chart(
     df = df.reset_index(drop=True)
     logger.info("Data merged")
 
+    return df
+
+
+def consumption_production_chart(
+    location: str,
+    peakpower: float,
+    mountingplace: str,
+    loss: float,
+    angle: float,
+    aspect: float,
+    analysisId: str,
+    render_plot: bool = True,
+) -> None:
+    """
+    Generates a chart with the consumption and production data for a location
+
+    :param location: location to get the data
+    :param peakpower: peak power of the installation
+    :param mountingplace: mounting place of the installation
+    :param loss: loss of the installation
+    :param angle: angle of the installation
+    :param aspect: aspect of the installation
+    :param analysisId: id of the user
+    :param render_plot: if False, only make sure the data of the chart exists
+    :return: None
+    """
+
+    # Get the production data if it does not exist
+    if not os.path.exists(
+        storage.fetch(
+            os.path.join(PATHS["production_parsed_monthly"], f"{analysisId}.csv")
+        )
+    ):
+        api.get_monthly_production(
+            location=location,
+            peakpower=peakpower,
+            mountingplace=mountingplace,
+            loss=loss,
+            angle=angle,
+            aspect=aspect,
+            analysisId=analysisId,
+        )
+        parse_monthly_production_file(analysisId)
+
+    if render_plot:
+        plot_consumption_production_chart(analysisId)
+
+
+def plot_consumption_production_chart(analysisId: str) -> None:
+    """
+    Renders the monthly consumption vs production chart as a png
+
+    :param analysisId: id of the user
+    :return: None
+    """
+    df = load_consumption_production_monthly(analysisId)
+
+    # matplotlib is slow to import, only import it when a chart is generated
+    from matplotlib import pyplot as plt
+
     # Generate the bar chart
     df.plot.bar(x="Month", y=["Energy_consumption", "Energy_production"], rot=0)
     plt.xlabel("Month")
@@ -188,16 +606,13 @@ def consumption_production_chart(
     plt.title("Consumption and production")
     plt.legend(["Consumption", "Production"])
     plt.gcf().set_size_inches(10, 5)
-    # Create the path if it does not exist
-    if not os.path.exists(PATHS["plots_consumption_production_chart"]):
-        os.makedirs(PATHS["plots_consumption_production_chart"])
-    plt.savefig(
+    lib_utils.save_figure(
         os.path.join(PATHS["plots_consumption_production_chart"], f"{analysisId}.png"),
         dpi=100,
     )
 
     # Clear the plot
-    plt.clf()
+    plt.close()
 
     logger.info("Chart saved")
 
@@ -213,7 +628,9 @@ def get_self_consumption_ratio(analysisId: str) -> (list[float], float):
     # Load the consumption data
     try:
         df_consumption = pd.read_csv(
-            os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv"),
+            storage.fetch(
+                os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv")
+            ),
             sep=";",
             decimal=",",
             thousands=".",
@@ -226,7 +643,9 @@ def get_self_consumption_ratio(analysisId: str) -> (list[float], float):
     # Load the production data
     try:
         df_production = pd.read_csv(
-            os.path.join(PATHS["production_parsed_hourly"], f"{analysisId}.csv"),
+            storage.fetch(
+                os.path.join(PATHS["production_parsed_hourly"], f"{analysisId}.csv")
+            ),
             sep=";",
             decimal=",",
             thousands=".",
@@ -279,7 +698,7 @@ def get_self_consumption_ratio(analysisId: str) -> (list[float], float):
     saved_path = lib_utils.save_csv_file(
         PATHS["results_self_consumption"], analysisId, df
     )
-    logger.info(f"Written file {saved_path}")
+    logger.info("Written file %s", saved_path)
 
     self_consumption_avg = df["Self_consumption_ratio"].mean()
     # Return the self consumption ratio and the average
@@ -297,7 +716,9 @@ def process_results_time_slot_solar(analysisId: str) -> None:
     # Load the consumption data
     try:
         df_consumption = pd.read_csv(
-            os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv"),
+            storage.fetch(
+                os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv")
+            ),
             sep=";",
             decimal=",",
             thousands=".",
@@ -310,7 +731,9 @@ def process_results_time_slot_solar(analysisId: str) -> None:
     # Load the production data
     try:
         df_production = pd.read_csv(
-            os.path.join(PATHS["production_parsed_hourly"], f"{analysisId}.csv"),
+            storage.fetch(
+                os.path.join(PATHS["production_parsed_hourly"], f"{analysisId}.csv")
+            ),
             sep=";",
             decimal=",",
             thousands=".",
@@ -419,13 +842,13 @@ def process_results_time_slot_solar(analysisId: str) -> None:
 
     # Save the results
     saved_path = lib_utils.save_csv_file(PATHS["time_slots"], analysisId, df)
-    logger.info(f"Written file {saved_path}")
+    logger.info("Written file %s", saved_path)
 
     process_results_time_slot_energy(analysisId)
     logger.info("Consumption results saved")
 
 
-def plot_self_consumption_monthly(analysisId: str) -> None:
+def plot_self_consumption_monthly(analysisId: str, render_plots: bool = True) -> None:
     """
     Calculate the self consumption for each month and generate the charts for each
     month.
@@ -433,12 +856,15 @@ def plot_self_consumption_monthly(analysisId: str) -> None:
     Return the total self consumption
 
     :param analysisId: The id of the analysis
+    :param render_plots: If False, only export the data of the charts
     """
 
     # Load the consumption data
     try:
         df_consumption = pd.read_csv(
-            os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv"),
+            storage.fetch(
+                os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv")
+            ),
             sep=";",
             decimal=",",
             encoding="UTF-8",
@@ -450,7 +876,9 @@ def plot_self_consumption_monthly(analysisId: str) -> None:
     # Load the production data
     try:
         df_production = pd.read_csv(
-            os.path.join(PATHS["production_parsed_hourly"], f"{analysisId}.csv"),
+            storage.fetch(
+                os.path.join(PATHS["production_parsed_hourly"], f"{analysisId}.csv")
+            ),
             sep=";",
             decimal=",",
             encoding="UTF-8",
@@ -468,8 +896,8 @@ def plot_self_consumption_monthly(analysisId: str) -> None:
         suffixes=("_consumption", "_production"),
     )
 
-    # Get days of each month
-    days_of_month = df.groupby(["Month"]).agg({"Day": "max"}).reset_index()
+    # Get the days with data of each month, months can have gaps
+    days_of_month = df.groupby(["Month"]).agg({"Day": "nunique"}).reset_index()
 
     # Sum all same hours from each month. That is the sum of every hour 1, 2, 3, etc.
     df = (
@@ -481,19 +909,52 @@ def plot_self_consumption_monthly(analysisId: str) -> None:
     # Get the average for each hour. That is dividing the sum of each hour by the
     # number of days of the month
     df = pd.merge(df, days_of_month, on=["Month"], how="left")
-    df["Energy_consumption"] = df.apply(
-        lambda x: x["Energy_consumption"] / x["Day"], axis=1
-    )
-    df["Energy_production"] = df.apply(
-        lambda x: x["Energy_production"] / x["Day"], axis=1
-    )
+    df["Energy_consumption"] = df["Energy_consumption"] / df["Day"]
+    df["Energy_production"] = df["Energy_production"] / df["Day"]
 
     # Keep only the columns we need
     df = df[["Month", "Hour", "Energy_consumption", "Energy_production"]]
 
     # Export the data
     saved_path = lib_utils.save_csv_file(PATHS["results"], analysisId, df)
-    logger.info(f"Written file {saved_path}")
+    logger.info("Written file %s", saved_path)
+
+    if render_plots:
+        plot_monthly_profiles(analysisId)
+
+
+def load_monthly_profiles(analysisId: str) -> pd.DataFrame:
+    """
+    Loads the average hourly profile of each month exported by
+    plot_self_consumption_monthly
+
+    :param analysisId: The id of the analysis
+    :return: dataframe with 'Month', 'Hour', 'Energy_consumption' and
+        'Energy_production'
+    """
+    try:
+        df = pd.read_csv(
+            storage.fetch(os.path.join(PATHS["results"], f"{analysisId}.csv")),
+            sep=";",
+            decimal=",",
+            encoding="UTF-8",
+        )
+    except FileNotFoundError:
+        logger.error("The monthly profiles file does not exist")
+        raise FileNotFoundError("The monthly profiles file does not exist")
+
+    return df
+
+
+def plot_monthly_profiles(analysisId: str) -> None:
+    """
+    Renders the average hourly profile of each month as 12 pngs
+
+    :param analysisId: The id of the analysis
+    """
+    df = load_monthly_profiles(analysisId)
+
+    from matplotlib import pyplot as plt
 
     # Plot the results for each month
     for month in range(1, 13):
@@ -508,10 +969,9 @@ def plot_self_consumption_monthly(analysisId: str) -> None:
         )
         # Wider plot
         plt.gcf().set_size_inches(15, 8)
-        # Create the path if it does not exist
-        if not os.path.exists(PATHS["plots_monthly"]):
-            os.makedirs(PATHS["plots_monthly"])
-        plt.savefig(os.path.join(PATHS["plots_monthly"], f"{analysisId}_{month}.png"))
+        lib_utils.save_figure(
+            os.path.join(PATHS["plots_monthly"], f"{analysisId}_{month}.png")
+        )
         plt.close()
 
     logger.info("Monthly plots saved")
@@ -0,0 +1,683 @@
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+from tools.energy_analysis_lib import utils as lib_utils
+from tools.utils import logger
+
+from .constants import ANALYSIS_ARTIFACTS, PATHS, output_path
+
+
+def artifact_paths(analysisId: str) -> list[str]:
+    """
+    Return the local paths of every artifact of an analysis, existing or not.
+
+    :param analysisId: The id of the analysis
+    """
+    return [
+        os.path.join(PATHS[path], name.format(analysisId=analysisId))
+        for path, name in ANALYSIS_ARTIFACTS
+    ]
+
+
+class LocalStorage:
+    """
+    Artifacts only live in the output folder.
+    """
+
+    def __init__(self):
+        # The reads are recorded in the index and not in the access time of the
+        # files, so their timestamps are left untouched
+        self.index = CacheIndex(os.path.join(PATHS["cache_index"], "index.sqlite3"))
+
+    def fetch(self, path: str) -> str:
+        """
+        Make sure the file is available locally.
+
+        :param path: The local path of the artifact
+        :return: The local path, which may not exist
+        """
+        if os.path.exists(path):
+            # The LRU order of the retention and the eviction
+            self.index.touch(path)
+        return path
+
+    def publish(self, paths: list[str]) -> None:
+        """
+        Share the local files with the rest of the workers.
+
+        :param paths: The local paths of the artifacts
+        """
+
+    def get_version(self, analysisId: str) -> str | None:
+        """
+        Return the version of an analysis shared by the hosts.
+
+        :param analysisId: The id of the analysis
+        """
+        return None
+
+    def mark_changed(self, analysisId: str, deleted: bool = False) -> None:
+        """
+        Tell the other hosts that an analysis was recomputed or deleted.
+
+        :param analysisId: The id of the analysis
+        :param deleted: The analysis was deleted
+        """
+
+    def delete(self, paths: list[str]) -> None:
+        """
+        Delete the files if they exist.
+
+        :param paths: The local paths of the artifacts
+        """
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Removed by another worker
+                pass
+        self.index.remove(paths)
+
+    def get_accessed(self) -> dict[str, float]:
+        """
+        Return when the artifacts were last read.
+
+        :return: dict local path -> timestamp
+        """
+        return self.index.get_accessed()
+
+    def listdir(self, path: str) -> list[tuple[str, float]]:
+        """
+        List the files of a folder.
+
+        :param path: The local path of the folder
+        :return: List of (file name, creation timestamp)
+        """
+        # Create the path if it does not exist
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        return [
+            (file, os.path.getctime(os.path.join(path, file)))
+            for file in os.listdir(path)
+            if os.path.isfile(os.path.join(path, file))
+        ]
+
+
+class CacheIndex:
+    """
+    Sqlite index of the output folder, shared by the workers of the host: when each
+    artifact was last read and, with the s3 backend, the size of every local copy
+    with a running total and the version of the analysis the copies of each
+    analysis belong to.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        analysisId TEXT,
+        size INTEGER NOT NULL,
+        modified_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS files_analysisId ON files (analysisId);
+    CREATE TABLE IF NOT EXISTS accesses (
+        path TEXT PRIMARY KEY,
+        accessed_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS versions (
+        analysisId TEXT PRIMARY KEY,
+        version TEXT
+    );
+    CREATE TABLE IF NOT EXISTS total (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        size INTEGER NOT NULL
+    );
+    INSERT OR IGNORE INTO total VALUES (0, 0);
+    CREATE TRIGGER IF NOT EXISTS files_insert AFTER INSERT ON files BEGIN
+        UPDATE total SET size = size + NEW.size;
+    END;
+    CREATE TRIGGER IF NOT EXISTS files_update AFTER UPDATE OF size ON files BEGIN
+        UPDATE total SET size = size + NEW.size - OLD.size;
+    END;
+    CREATE TRIGGER IF NOT EXISTS files_delete AFTER DELETE ON files BEGIN
+        UPDATE total SET size = size - OLD.size;
+    END;
+    """
+
+    # Reads of the same file closer than this are recorded once
+    ACCESS_RESOLUTION_SECONDS = 60
+
+    def __init__(self, path: str):
+        """
+        :param path: The path of the sqlite file
+        """
+        self.path = path
+        self.created = False
+        self.touched: dict[str, float] = {}
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Open the index, creating it on first use. Every call opens its own
+        connection, so it can be used from any thread.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Writers of other workers hold the lock for a few milliseconds
+        connection = sqlite3.connect(self.path, timeout=30)
+        if not self.created:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(self.SCHEMA)
+            self.created = True
+        return connection
+
+    def add(self, path: str, analysisId: str | None, size: int) -> None:
+        """
+        Record a local copy, downloaded or uploaded.
+
+        :param path: The local path of the artifact
+        :param analysisId: The id of the analysis of the artifact, if any
+        :param size: The size of the file
+        """
+        now = time.time()
+        with closing(self.connect()) as connection, connection:
+            connection.execute(
+                "INSERT INTO files VALUES (?, ?, ?, ?) ON CONFLICT (path) DO UPDATE "
+                "SET size = excluded.size, modified_at = excluded.modified_at",
+                (_index_key(path), analysisId, size, now),
+            )
+        self.touch(path, force=True)
+
+    def touch(self, path: str, force: bool = False) -> None:
+        """
+        Record a read of a file, the least recently read files are evicted first.
+
+        :param path: The local path of the artifact
+        :param force: Record it even if it was recorded a moment ago
+        """
+        now = time.time()
+        if not force and now - self.touched.get(path, 0) < (
+            self.ACCESS_RESOLUTION_SECONDS
+        ):
+            return
+        # Bounded, it only saves writes
+        if len(self.touched) > 100000:
+            self.touched.clear()
+        self.touched[path] = now
+
+        with closing(self.connect()) as connection, connection:
+            connection.execute(
+                "INSERT INTO accesses VALUES (?, ?) ON CONFLICT (path) DO UPDATE "
+                "SET accessed_at = excluded.accessed_at",
+                (_index_key(path), now),
+            )
+
+    def remove(self, paths: list[str]) -> None:
+        """
+        Forget removed files.
+
+        :param paths: The local paths of the artifacts
+        """
+        keys = [(_index_key(path),) for path in paths]
+        with closing(self.connect()) as connection, connection:
+            connection.executemany("DELETE FROM files WHERE path = ?", keys)
+            connection.executemany("DELETE FROM accesses WHERE path = ?", keys)
+
+    def get_accessed(self) -> dict[str, float]:
+        """
+        Return when the artifacts were last read.
+
+        :return: dict local path -> timestamp
+        """
+        with closing(self.connect()) as connection:
+            return {
+                os.path.normpath(os.path.join(output_path, key)): accessed_at
+                for key, accessed_at in connection.execute(
+                    "SELECT path, accessed_at FROM accesses"
+                )
+            }
+
+    def total_size(self) -> int:
+        """
+        Return the size of every local copy.
+        """
+        with closing(self.connect()) as connection:
+            return connection.execute("SELECT size FROM total").fetchone()[0]
+
+    def least_recently_used(self, modified_before: float) -> Iterator[tuple[str, int]]:
+        """
+        Iterate over the local copies from the least recently read one.
+
+        :param modified_before: Only copies written before this timestamp
+        :return: Iterator of (local path, size)
+        """
+        with closing(self.connect()) as connection:
+            for key, size in connection.execute(
+                "SELECT files.path, files.size FROM files "
+                "LEFT JOIN accesses ON files.path = accesses.path "
+                "WHERE files.modified_at < ? "
+                "ORDER BY MAX(files.modified_at, COALESCE(accesses.accessed_at, 0))",
+                (modified_before,),
+            ):
+                yield os.path.join(output_path, key), size
+
+    def analysis_paths(self, analysisId: str) -> list[str]:
+        """
+        Return the local copies of the artifacts of an analysis.
+
+        :param analysisId: The id of the analysis
+        """
+        with closing(self.connect()) as connection:
+            return [
+                os.path.join(output_path, key)
+                for (key,) in connection.execute(
+                    "SELECT path FROM files WHERE analysisId = ?", (analysisId,)
+                )
+            ]
+
+    def get_version(self, analysisId: str) -> str | None:
+        """
+        Return the version of an analysis its local copies belong to.
+
+        :param analysisId: The id of the analysis
+        """
+        with closing(self.connect()) as connection:
+            row = connection.execute(
+                "SELECT version FROM versions WHERE analysisId = ?", (analysisId,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_version(self, analysisId: str, version: str | None) -> None:
+        """
+        Record the version of an analysis its local copies belong to.
+
+        :param analysisId: The id of the analysis
+        :param version: The version, None if the analysis does not exist
+        """
+        with closing(self.connect()) as connection, connection:
+            if version is None:
+                connection.execute(
+                    "DELETE FROM versions WHERE analysisId = ?", (analysisId,)
+                )
+            else:
+                connection.execute(
+                    "INSERT INTO versions VALUES (?, ?) ON CONFLICT (analysisId) "
+                    "DO UPDATE SET version = excluded.version",
+                    (analysisId, version),
+                )
+
+
+def _index_key(path: str) -> str:
+    return os.path.relpath(path, output_path)
+
+
+# Folders of the artifacts, whose files are named after their analysis
+_artifact_folders = {os.path.normpath(PATHS[path]) for path, _ in ANALYSIS_ARTIFACTS}
+
+
+def analysis_id(path: str) -> str | None:
+    """
+    Return the id of the analysis of an artifact.
+
+    :param path: The local path of the artifact
+    :return: The id of the analysis, None if the path is not an artifact
+    """
+    if os.path.dirname(os.path.normpath(path)) not in _artifact_folders:
+        return None
+    # Monthly plots are named <analysisId>_<month>.png
+    return os.path.splitext(os.path.basename(path))[0].split("_")[0]
+
+
+class S3Storage(LocalStorage):
+    """
+    Artifacts are shared through an S3 compatible bucket (AWS S3, MinIO...). The
+    output folder is a bounded read-through cache of the bucket: missing files are
+    downloaded on read and the least recently used ones are evicted when the cache
+    grows over its budget.
+
+    Every change of an analysis writes a new version marker to the bucket. A host
+    checks the marker of an analysis at most every revalidate_seconds before reading
+    its files, and drops its local copies when it was changed by another host.
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        endpoint_url: str | None = None,
+        prefix: str = "",
+        cache_max_bytes: int = 1024**3,
+        cache_grace_seconds: int = 600,
+        upload_workers: int = 8,
+        revalidate_seconds: float = 10,
+    ):
+        """
+        :param bucket: The name of the bucket
+        :param endpoint_url: The url of the S3 compatible service. None for AWS
+        :param prefix: The prefix of the keys in the bucket
+        :param cache_max_bytes: The max size of the output folder
+        :param cache_grace_seconds: Files modified more recently are never evicted,
+            so files of analyses that are still being processed are kept
+        :param upload_workers: The number of parallel uploads
+        :param revalidate_seconds: Max time the local copies of an analysis are used
+            without checking its version in the bucket
+        """
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+        except ImportError:
+            raise ImportError("boto3 is required for the s3 storage backend")
+
+        super().__init__()
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.cache_max_bytes = cache_max_bytes
+        self.cache_grace_seconds = cache_grace_seconds
+        self.upload_workers = upload_workers
+        self.revalidate_seconds = revalidate_seconds
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+        # Big files are uploaded in parts, in parallel
+        self.transfer_config = TransferConfig(
+            multipart_threshold=8 * 1024**2, max_concurrency=upload_workers
+        )
+        # analysisId -> (checked at, version) of the markers checked by this worker
+        self.versions: dict[str, tuple[float, str | None]] = {}
+        self.versions_lock = threading.Lock()
+
+    def key(self, path: str) -> str:
+        """
+        Return the key of a local path in the bucket.
+
+        :param path: The local path of the artifact
+        """
+        key = os.path.relpath(path, output_path).replace(os.sep, "/")
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def version_key(self, analysisId: str) -> str:
+        """
+        Return the key of the version marker of an analysis.
+
+        :param analysisId: The id of the analysis
+        """
+        return self.key(os.path.join(output_path, "versions", analysisId))
+
+    def get_version(self, analysisId: str) -> str | None:
+        """
+        Return the version of an analysis in the bucket, checked at most every
+        revalidate_seconds. The local copies of the analysis are removed when they
+        belong to another version, so they are downloaded again.
+
+        :param analysisId: The id of the analysis
+        :return: The ETag of its marker, None if it has none
+        """
+        from botocore.exceptions import ClientError
+
+        now = time.time()
+        with self.versions_lock:
+            checked = self.versions.get(analysisId)
+        if checked is not None and now - checked[0] < self.revalidate_seconds:
+            return checked[1]
+
+        try:
+            version = self.client.head_object(
+                Bucket=self.bucket, Key=self.version_key(analysisId)
+            )["ETag"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                raise
+            version = None
+
+        if version != self.index.get_version(analysisId):
+            # Changed or deleted by another host
+            stale = self.index.analysis_paths(analysisId)
+            super().delete(stale)
+            self.index.set_version(analysisId, version)
+            if stale:
+                logger.info(
+                    "Dropped %s out of date files of %s", len(stale), analysisId
+                )
+
+        with self.versions_lock:
+            # Bounded, it only saves requests
+            if len(self.versions) > 100000:
+                self.versions.clear()
+            self.versions[analysisId] = (now, version)
+        return version
+
+    def mark_changed(self, analysisId: str, deleted: bool = False) -> None:
+        """
+        Write a new version marker of an analysis, so the other hosts drop their
+        local copies of it.
+
+        :param analysisId: The id of the analysis
+        :param deleted: Remove the marker instead, the analysis does not exist
+        """
+        if deleted:
+            self.client.delete_object(
+                Bucket=self.bucket, Key=self.version_key(analysisId)
+            )
+            version = None
+        else:
+            version = self.client.put_object(
+                Bucket=self.bucket,
+                Key=self.version_key(analysisId),
+                Body=str(time.time_ns()).encode("utf-8"),
+            )["ETag"]
+
+        # The local copies were just written, they belong to the new version
+        self.index.set_version(analysisId, version)
+        with self.versions_lock:
+            self.versions[analysisId] = (time.time(), version)
+
+    def fetch(self, path: str) -> str:
+        from botocore.exceptions import ClientError
+
+        analysisId = analysis_id(path)
+        if analysisId is not None:
+            self.get_version(analysisId)
+
+        if os.path.exists(path):
+            return super().fetch(path)
+
+        try:
+            with lib_utils.atomic_write(path, "wb") as f:
+                self.client.download_fileobj(
+                    self.bucket, self.key(path), f, Config=self.transfer_config
+                )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                # Let the caller raise its own FileNotFoundError
+                return path
+            raise
+        logger.info("Downloaded %s", self.key(path))
+
+        self.index.add(path, analysisId, os.path.getsize(path))
+        self.evict()
+        return path
+
+    def publish(self, paths: list[str]) -> None:
+        paths = [path for path in paths if os.path.exists(path)]
+
+        def upload(path):
+            self.client.upload_file(
+                path, self.bucket, self.key(path), Config=self.transfer_config
+            )
+            self.index.add(path, analysis_id(path), os.path.getsize(path))
+
+        with ThreadPoolExecutor(max_workers=self.upload_workers) as executor:
+            # Consume the iterator to raise the exceptions
+            list(executor.map(upload, paths))
+        logger.info("Uploaded %s files", len(paths))
+
+        self.evict()
+
+    def delete(self, paths: list[str]) -> None:
+        super().delete(paths)
+
+        # 1000 is the max number of keys of delete_objects
+        for start in range(0, len(paths), 1000):
+            self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={
+                    "Objects": [
+                        {"Key": self.key(path)} for path in paths[start : start + 1000]
+                    ],
+                    "Quiet": True,
+                },
+            )
+
+    def listdir(self, path: str) -> list[tuple[str, float]]:
+        prefix = self.key(path).rstrip("/") + "/"
+        paginator = self.client.get_paginator("list_objects_v2")
+
+        results = []
+        for page in paginator.paginate(
+            Bucket=self.bucket, Prefix=prefix, Delimiter="/"
+        ):
+            for item in page.get("Contents", []):
+                results.append(
+                    (item["Key"][len(prefix) :], item["LastModified"].timestamp())
+                )
+        return results
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used local copies until the output folder is under
+        the cache budget. The running size of the copies is kept in the index, so
+        the output folder is not walked.
+        """
+        total = self.index.total_size()
+        if total <= self.cache_max_bytes:
+            return
+
+        evicted = []
+        for path, size in self.index.least_recently_used(
+            time.time() - self.cache_grace_seconds
+        ):
+            if total <= self.cache_max_bytes:
+                break
+            evicted.append(path)
+            total -= size
+
+        # Files already removed by another worker are skipped
+        super().delete(evicted)
+        logger.info("Local cache evicted down to %s bytes", total)
+
+
+def create_storage() -> LocalStorage:
+    """
+    Create the storage backend configured with the STORAGE_BACKEND environment
+    variable: "local" (default) or "s3".
+    """
+    backend = os.environ.get("STORAGE_BACKEND", "local")
+
+    if backend == "local":
+        return LocalStorage()
+    if backend == "s3":
+        return S3Storage(
+            bucket=os.environ["S3_BUCKET"],
+            endpoint_url=os.environ.get("S3_ENDPOINT_URL"),
+            prefix=os.environ.get("S3_PREFIX", ""),
+            cache_max_bytes=int(
+                os.environ.get("STORAGE_CACHE_MAX_BYTES", str(1024**3))
+            ),
+            cache_grace_seconds=int(
+                os.environ.get("STORAGE_CACHE_GRACE_SECONDS", "600")
+            ),
+            upload_workers=int(os.environ.get("STORAGE_UPLOAD_WORKERS", "8")),
+            revalidate_seconds=float(
+                os.environ.get("STORAGE_REVALIDATE_SECONDS", "10")
+            ),
+        )
+
+    raise ValueError(f"Unknown storage backend {backend}")
+
+
+backend = create_storage()
+
+
+def fetch(path: str) -> str:
+    """
+    Make sure an artifact is available locally before reading it.
+
+    :param path: The local path of the artifact
+    :return: The local path, which does not exist if the artifact does not exist
+    """
+    return backend.fetch(path)
+
+
+def publish(paths: list[str]) -> None:
+    """
+    Share artifacts written locally with the rest of the workers.
+
+    :param paths: The local paths of the artifacts
+    """
+    backend.publish(paths)
+
+
+def delete(paths: list[str]) -> None:
+    """
+    Delete artifacts everywhere.
+
+    :param paths: The local paths of the artifacts
+    """
+    backend.delete(paths)
+
+
+def get_version(analysisId: str) -> str | None:
+    """
+    Return the version of an analysis shared by the hosts, so results computed by
+    other hosts are not taken as up to date.
+
+    :param analysisId: The id of the analysis
+    :return: The version, None with the local backend or if it has no version
+    """
+    return backend.get_version(analysisId)
+
+
+def mark_changed(analysisId: str, deleted: bool = False) -> None:
+    """
+    Tell the other hosts that an analysis was recomputed or deleted.
+
+    :param analysisId: The id of the analysis
+    :param deleted: The analysis was deleted
+    """
+    backend.mark_changed(analysisId, deleted=deleted)
+
+
+def listdir(path: str) -> list[tuple[str, float]]:
+    """
+    List the artifacts of a folder.
+
+    :param path: The local path of the folder
+    :return: List of (file name, creation timestamp)
+    """
+    return backend.listdir(path)
+
+
+def get_accessed() -> dict[str, float]:
+    """
+    Return when the artifacts were last read, the LRU order of the retention.
+
+    :return: dict local path -> timestamp
+    """
+    return backend.get_accessed()
+
+
+def publish_analysis(analysisId: str, since: float = 0) -> None:
+    """
+    Upload in parallel the artifacts of an analysis written after a timestamp.
+
+    :param analysisId: The id of the analysis
+    :param since: Only files modified after this timestamp are uploaded
+    """
+    backend.publish(
+        [
+            path
+            for path in artifact_paths(analysisId)
+            # One second of margin for coarse file system timestamps
+            if os.path.exists(path) and os.path.getmtime(path) >= since - 1
+        ]
+    )
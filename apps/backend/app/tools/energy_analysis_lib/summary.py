@@ -0,0 +1,352 @@
+"""
+Summary of every analysis: annual consumption, production, self consumption and
+surplus, in an indexed sqlite table of the host.
+
+A row is written at the end of the pipeline of each analysis and removed with it,
+so the totals across thousands of analyses are read without opening their files.
+Fill it with the analyses processed before it existed with:
+
+    python -m tools.energy_analysis_lib.summary [analysisId ...]
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+from dotenv import load_dotenv
+from tools.energy_analysis_lib import storage
+from tools.energy_analysis_lib import utils as lib_utils
+from tools.utils import logger
+
+from .constants import PATHS
+
+load_shifting = lib_utils.LazyModule("tools.energy_analysis_lib.load_shifting")
+
+KINDS = ["solar", "energy"]
+PARAMETERS = ["location", "peakpower", "mountingplace", "loss", "angle", "aspect"]
+# Energy in kWh
+TOTALS = ["consumption", "production", "self_consumption", "surplus", "grid_import"]
+COLUMNS = [
+    "analysisId",
+    "kind",
+    *PARAMETERS,
+    *TOTALS,
+    "self_consumption_ratio",
+    "peak_consumption",
+    "hours",
+    "updated_at",
+]
+# Columns the rows can be sorted by, all of them indexed
+SORT_COLUMNS = [
+    "updated_at",
+    "consumption",
+    "production",
+    "self_consumption",
+    "surplus",
+    "self_consumption_ratio",
+    "peakpower",
+    "location",
+]
+MAX_LIMIT = 1000
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS summaries (
+    analysisId TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    location TEXT,
+    peakpower REAL,
+    mountingplace TEXT,
+    loss REAL,
+    angle REAL,
+    aspect REAL,
+    consumption REAL NOT NULL,
+    production REAL NOT NULL,
+    self_consumption REAL NOT NULL,
+    surplus REAL NOT NULL,
+    grid_import REAL NOT NULL,
+    self_consumption_ratio REAL,
+    peak_consumption REAL NOT NULL,
+    hours INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS summaries_kind ON summaries (kind, updated_at);
+{
+    "".join(
+        f"CREATE INDEX IF NOT EXISTS summaries_{column} ON summaries ({column});"
+        for column in SORT_COLUMNS
+    )
+}
+"""
+
+
+def _path() -> str:
+    return os.path.join(PATHS["summary"], "summary.sqlite3")
+
+
+# Paths whose schema was already created by this process
+_created: set[str] = set()
+
+
+def connect() -> sqlite3.Connection:
+    """
+    Open the summary table, creating it on first use. Every call opens its own
+    connection, so it can be used from any thread or process.
+    """
+    os.makedirs(PATHS["summary"], exist_ok=True)
+    # Writers of other workers hold the lock for a few milliseconds
+    connection = sqlite3.connect(_path(), timeout=30)
+    connection.row_factory = sqlite3.Row
+    if _path() not in _created:
+        # Readers do not wait for the writers
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+        _created.add(_path())
+    return connection
+
+
+def compute(analysisId: str) -> dict:
+    """
+    Calculate the annual totals of an analysis from its hourly consumption and
+    production, or its generation for an energy analysis.
+
+    :param analysisId: The id of the analysis
+    :return: dict with TOTALS, 'self_consumption_ratio', 'peak_consumption' and
+        'hours'
+    """
+    df = load_shifting.load_hourly_data(analysisId)
+
+    consumption = float(df["Energy_consumption"].sum())
+    production = float(df["Energy_production"].sum())
+    self_consumption = float(
+        df[["Energy_consumption", "Energy_production"]].min(axis=1).sum()
+    )
+    return {
+        "consumption": round(consumption, 3),
+        "production": round(production, 3),
+        "self_consumption": round(self_consumption, 3),
+        "surplus": round(production - self_consumption, 3),
+        "grid_import": round(consumption - self_consumption, 3),
+        # Share of the production consumed, None without production
+        "self_consumption_ratio": (
+            round(self_consumption / production, 4) if production else None
+        ),
+        "peak_consumption": round(float(df["Energy_consumption"].max()), 3),
+        "hours": len(df),
+    }
+
+
+def write(analysisId: str, kind: str, parameters: dict | None = None) -> None:
+    """
+    Write the summary row of an analysis. The parameters of the installation are
+    kept when they are not given, e.g. by the backfill.
+
+    :param analysisId: The id of the analysis
+    :param kind: "solar" or "energy"
+    :param parameters: The parameters of the installation of a solar analysis
+    """
+    row = {
+        "analysisId": analysisId,
+        "kind": kind,
+        **{name: (parameters or {}).get(name) for name in PARAMETERS},
+        **compute(analysisId),
+        "updated_at": time.time(),
+    }
+    updates = [
+        (
+            f"{column} = COALESCE(excluded.{column}, {column})"
+            if column in PARAMETERS
+            else f"{column} = excluded.{column}"
+        )
+        for column in COLUMNS[1:]
+    ]
+    with closing(connect()) as connection, connection:
+        connection.execute(
+            f"INSERT INTO summaries ({', '.join(COLUMNS)}) "
+            f"VALUES ({', '.join(':' + column for column in COLUMNS)}) "
+            f"ON CONFLICT (analysisId) DO UPDATE SET {', '.join(updates)}",
+            row,
+        )
+
+
+def record(analysisId: str, kind: str, parameters: dict | None = None) -> None:
+    """
+    Write the summary row of an analysis at the end of its pipeline. The analysis
+    is already saved, so errors are logged instead of raised.
+
+    :param analysisId: The id of the analysis
+    :param kind: "solar" or "energy"
+    :param parameters: The parameters of the installation of a solar analysis
+    """
+    try:
+        write(analysisId, kind, parameters)
+    except Exception as e:
+        logger.exception("Could not write the summary of %s: %s", analysisId, e)
+
+
+def delete(analysisId: str) -> None:
+    """
+    Remove the summary row of a deleted analysis.
+
+    :param analysisId: The id of the analysis
+    """
+    with closing(connect()) as connection, connection:
+        connection.execute("DELETE FROM summaries WHERE analysisId = ?", (analysisId,))
+
+
+def query(
+    kind: str | None = None,
+    location: str | None = None,
+    min_consumption: float | None = None,
+    max_consumption: float | None = None,
+    min_production: float | None = None,
+    max_production: float | None = None,
+    min_self_consumption_ratio: float | None = None,
+    max_self_consumption_ratio: float | None = None,
+    since: float | None = None,
+    until: float | None = None,
+    sort: str = "-updated_at",
+    limit: int = 100,
+    offset: int = 0,
+) -> dict:
+    """
+    Return a page of the summary rows matching the filters and the aggregates of
+    all of them.
+
+    :param kind: "solar" or "energy"
+    :param location: Location of the solar analyses
+    :param min_consumption: Min annual consumption (kWh), the same for the rest of
+        the min and max filters
+    :param since: Min update time, as a unix timestamp
+    :param until: Max update time, as a unix timestamp
+    :param sort: Column to sort by, prefixed by "-" for descending order
+    :param limit: Max rows returned, up to MAX_LIMIT
+    :param offset: Rows skipped
+    :return: dict with the 'total' rows, the 'totals' and 'means' of the matching
+        rows, and the 'results' of the page
+    """
+    if kind is not None and kind not in KINDS:
+        raise ValueError(f"Unknown kind: {kind}")
+    column = sort.removeprefix("-")
+    if column not in SORT_COLUMNS:
+        raise ValueError(
+            f"Unknown sort column: {column}, one of {', '.join(SORT_COLUMNS)}"
+        )
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ValueError(f"The limit must be between 1 and {MAX_LIMIT}")
+    if offset < 0:
+        raise ValueError("The offset must be positive")
+
+    conditions = []
+    params = []
+    for condition, value in [
+        ("kind = ?", kind),
+        ("location = ?", location),
+        ("consumption >= ?", min_consumption),
+        ("consumption <= ?", max_consumption),
+        ("production >= ?", min_production),
+        ("production <= ?", max_production),
+        ("self_consumption_ratio >= ?", min_self_consumption_ratio),
+        ("self_consumption_ratio <= ?", max_self_consumption_ratio),
+        ("updated_at >= ?", since),
+        ("updated_at <= ?", until),
+    ]:
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    with closing(connect()) as connection:
+        aggregates = connection.execute(
+            f"SELECT COUNT(*) AS total, "
+            f"{', '.join(f'SUM({name}) AS {name}' for name in TOTALS)}, "
+            "AVG(self_consumption_ratio) AS self_consumption_ratio, "
+            "AVG(consumption) AS mean_consumption, "
+            "AVG(production) AS mean_production "
+            f"FROM summaries {where}",
+            params,
+        ).fetchone()
+        # Ties sorted by id, so the pages do not overlap
+        rows = connection.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM summaries {where} "
+            f"ORDER BY {column} {'DESC' if sort.startswith('-') else 'ASC'}, "
+            "analysisId LIMIT ? OFFSET ?",
+            [*params, limit, offset],
+        ).fetchall()
+
+    def rounded(value):
+        return round(value, 3) if value is not None else None
+
+    return {
+        "total": aggregates["total"],
+        "limit": limit,
+        "offset": offset,
+        "totals": {name: rounded(aggregates[name]) or 0 for name in TOTALS},
+        "means": {
+            "consumption": rounded(aggregates["mean_consumption"]),
+            "production": rounded(aggregates["mean_production"]),
+            "self_consumption_ratio": (
+                round(aggregates["self_consumption_ratio"], 4)
+                if aggregates["self_consumption_ratio"] is not None
+                else None
+            ),
+        },
+        "results": [dict(row) for row in rows],
+    }
+
+
+def backfill(analysisIds: list[str] | None = None) -> int:
+    """
+    Write the summary rows of analyses processed before the summary existed. The
+    parameters of their installations are not known.
+
+    :param analysisIds: The ids of the analyses. All of them if None
+    :return: The number of rows written
+    """
+    if analysisIds is None:
+        analysisIds = [
+            file[:-4]
+            for file, _ in storage.listdir(PATHS["consumption_parsed_hourly"])
+            if file.endswith(".csv")
+        ]
+
+    written = 0
+    for analysisId in analysisIds:
+        kind = (
+            "solar"
+            if os.path.exists(
+                storage.fetch(
+                    os.path.join(PATHS["production_parsed_hourly"], f"{analysisId}.csv")
+                )
+            )
+            else "energy"
+        )
+        try:
+            with lib_utils.file_lock(analysisId):
+                write(analysisId, kind)
+        except Exception as e:
+            logger.error("Could not summarize %s: %s", analysisId, e)
+            continue
+        written += 1
+
+    return written
+
+
+def main() -> int:
+    # .env variables read at run time, e.g. POSITIONSTACK_ACCESS_KEY or AWS_*
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(
+        description="Write the summary rows of the analyses"
+    )
+    parser.add_argument("analysisIds", nargs="*", help="All the analyses if empty")
+    args = parser.parse_args()
+
+    print(f"{backfill(args.analysisIds or None)} analyses summarized")
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
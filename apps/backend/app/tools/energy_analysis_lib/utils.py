@@ -1,8 +1,44 @@
+from __future__ import annotations
+
 import datetime
+import fcntl
+import importlib
 import io
 import os
+import tempfile
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+from .constants import PATHS, STREAMING, TIME_SLOTS
+
+# numpy and pandas are only imported when used to keep the api startup fast
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+# The umask can only be read by setting it. Read once at import, before the threads
+# of the api start
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class LazyModule:
+    """
+    Module imported on first attribute access, for heavy modules that are not
+    needed at startup.
+    """
+
+    def __init__(self, name: str):
+        """
+        :param name: The absolute name of the module
+        """
+        self._name = name
 
-import pandas as pd
+    def __getattr__(self, attr: str):
+        # import_module is thread safe and returns the cached module after the
+        # first call
+        return getattr(importlib.import_module(self._name), attr)
 
 
 def is_within_time_slot(
@@ -62,6 +98,133 @@ def save_csv_to_variable(df: pd.DataFrame) -> io.BytesIO:
     return csv_bytes
 
 
+def iter_csv(df: pd.DataFrame, index: bool = False) -> Iterator[bytes]:
+    """
+    Render the CSV data in encoded chunks of rows, so only one chunk is in memory at
+    a time.
+
+    :param df: The data
+    :param index: Write the index as the first column
+    :return: Iterator of CSV chunks, the first one with the header
+    """
+    chunk_rows = STREAMING["chunk_rows"]
+    # The header is written even if there are no rows
+    for start in range(0, max(len(df), 1), chunk_rows):
+        yield (
+            df.iloc[start : start + chunk_rows]
+            .to_csv(header=start == 0, index=index, sep=";", decimal=",")
+            .encode("utf-8")
+        )
+
+
+def iter_file(path: str) -> Iterator[bytes]:
+    """
+    Read a file in chunks.
+
+    :param path: The path to the file
+    :return: Iterator of chunks of bytes
+    """
+    # Open the file now so a missing file raises before the response starts
+    f = open(path, "rb")
+
+    def chunks():
+        with f:
+            while chunk := f.read(STREAMING["chunk_bytes"]):
+                yield chunk
+
+    return chunks()
+
+
+def export_csv(df: pd.DataFrame, index: bool = False) -> bytes | Iterator[bytes]:
+    """
+    Return the CSV data in memory if it is small or as chunks to stream otherwise.
+
+    :param df: The data
+    :param index: Write the index as the first column
+    :return: The CSV data as bytes, or an iterator of chunks if it is bigger than
+        STREAMING_THRESHOLD_BYTES
+    """
+    # The size of the data in memory is a cheap estimation of the size of the CSV
+    if df.memory_usage(index=index).sum() > STREAMING["threshold_bytes"]:
+        return iter_csv(df, index=index)
+
+    return df.to_csv(index=index, sep=";", decimal=",").encode("utf-8")
+
+
+def export_file(path: str) -> bytes | Iterator[bytes]:
+    """
+    Return the content of a file in memory if it is small or as chunks to stream
+    otherwise.
+
+    :param path: The path to the file
+    :return: The content as bytes, or an iterator of chunks if it is bigger than
+        STREAMING_THRESHOLD_BYTES
+    """
+    if os.path.getsize(path) > STREAMING["threshold_bytes"]:
+        return iter_file(path)
+
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def read_csv_file(path: str, row_labels: list[str] | None = None) -> pd.DataFrame:
+    """
+    Read a CSV file saved with save_csv_file.
+
+    :param path: The path to the file
+    :param row_labels: Labels of the rows, added as the first column "Time_slot",
+        for files saved without them
+    :return: The data
+    """
+    import pandas as pd
+
+    df = pd.read_csv(path, sep=";", decimal=",")
+    if row_labels is not None:
+        df.insert(0, "Time_slot", row_labels[: len(df)])
+
+    return df
+
+
+def save_arrow_to_variable(df: pd.DataFrame) -> bytes:
+    """
+    Save the data as an Arrow IPC stream.
+
+    :param df: The data
+    :return: The Arrow stream as bytes
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ImportError("pyarrow is required for the arrow format")
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    return sink.getvalue().to_pybytes()
+
+
+def save_parquet_to_variable(df: pd.DataFrame) -> bytes:
+    """
+    Save the data as a Parquet file.
+
+    :param df: The data
+    :return: The Parquet file as bytes
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("pyarrow is required for the parquet format")
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    pq.write_table(table, sink, compression="zstd")
+
+    return sink.getvalue().to_pybytes()
+
+
 def save_csv_file(path: str, analysisId: str, df: pd.DataFrame) -> str:
     """
     Save the CSV data to a file.
@@ -71,12 +234,157 @@ def save_csv_file(path: str, analysisId: str, df: pd.DataFrame) -> str:
     :return: The path to the file
     """
 
-    # Create the path if it does not exist
-    if not os.path.exists(path):
-        os.makedirs(path)
-
     # Save the CSV data to a file
     save_path = os.path.join(path, f"{analysisId}.csv")
-    df.to_csv(save_path, index=False, sep=";", decimal=",", encoding="UTF-8")
+    with atomic_write(save_path, "w", encoding="UTF-8", newline="") as f:
+        df.to_csv(f, index=False, sep=";", decimal=",")
 
     return str(save_path)
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = "w", **kwargs):
+    """
+    Open a temporary file next to path and move it to path once it is completely
+    written, so readers always see either the old or the new file. If an exception
+    is raised the temporary file is removed and path is left untouched.
+
+    :param path: The final path of the file
+    :param mode: The mode to open the temporary file with, "w" or "wb"
+    :param kwargs: Extra arguments for open
+    :return: The temporary file object
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+
+    # Same directory so the rename never crosses file systems
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, mode, **kwargs) as f:
+            yield f
+            f.flush()
+            # mkstemp creates the file only readable by its owner. Containers
+            # sharing the output volume may run as other users
+            os.fchmod(f.fileno(), 0o666 & ~_UMASK)
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@contextmanager
+def file_lock(name: str, blocking: bool = True):
+    """
+    Exclusive lock shared by every thread, process and host using the same output
+    folder. Not reentrant: do not take the same lock twice in the same call stack.
+
+    :param name: The name of the lock, e.g. an analysis id
+    :param blocking: If False, raise BlockingIOError instead of waiting when the lock
+        is held by someone else
+    """
+    os.makedirs(PATHS["locks"], exist_ok=True)
+    path = os.path.join(PATHS["locks"], f"{name}.lock")
+    while True:
+        # Only the descriptor is needed to hold the lock
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666)
+        try:
+            fcntl.flock(
+                fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            )
+        except BaseException:
+            os.close(fd)
+            raise
+        # The sweeper deletes unused lock files. If it deleted this one while it was
+        # being waited for, take the lock again with the new file
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stat = None
+        if stat is not None and os.path.samestat(os.fstat(fd), stat):
+            break
+        os.close(fd)
+
+    try:
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def save_figure(path: str, **kwargs) -> str:
+    """
+    Save the current matplotlib figure atomically.
+
+    :param path: The path of the image
+    :param kwargs: Extra arguments for plt.savefig
+    :return: The path to the file
+    """
+    from matplotlib import pyplot as plt
+
+    with atomic_write(path, "wb") as f:
+        plt.savefig(f, format="png", **kwargs)
+
+    return str(path)
+
+
+def time_slot_masks(
+    months: np.ndarray, days: np.ndarray, hours: np.ndarray
+) -> dict[str, np.ndarray]:
+    """
+    Vectorized version of is_within_time_slot for whole hourly series, looked up in
+    the calendar shared by the workers.
+
+    :param months: month of every row
+    :param days: day of every row
+    :param hours: hour of every row, from 0 to 25
+    :return: dict "<time slot name>_<time slot type>" -> boolean mask
+    """
+    from . import shared_arrays
+
+    return shared_arrays.calendar_masks(months, days, hours)
+
+
+def compute_time_slot_masks(
+    months: np.ndarray, days: np.ndarray, hours: np.ndarray
+) -> dict[str, np.ndarray]:
+    """
+    Calculates the time slot masks of whole hourly series, used to build the
+    shared calendar.
+
+    :param months: month of every row
+    :param days: day of every row
+    :param hours: hour of every row
+    :return: dict "<time slot name>_<time slot type>" -> boolean mask
+    """
+    import numpy as np
+    import pandas as pd
+
+    hours = np.asarray(hours)
+    weekend = (
+        pd.to_datetime(
+            pd.DataFrame(
+                {"year": 2024, "month": np.asarray(months), "day": np.asarray(days)}
+            )
+        ).dt.weekday.to_numpy()
+        >= 5
+    )
+
+    masks = {}
+    for time_slot_name, time_slot in TIME_SLOTS.items():
+        for time_slot_type, time_slot_hours in time_slot.items():
+            mask = np.zeros(len(hours), dtype=bool)
+            for start, end in time_slot_hours:
+                if start > end:
+                    mask |= (hours >= start) | (hours <= end)
+                else:
+                    mask |= (hours >= start) & (hours <= end)
+            # Same weekend workaround as is_within_time_slot
+            if time_slot_name == "nocturna":
+                mask = np.where(weekend, time_slot_type == "Valle", mask)
+            masks[time_slot_name + "_" + time_slot_type] = mask
+
+    return masks
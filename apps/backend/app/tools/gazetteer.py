@@ -0,0 +1,163 @@
+import csv
+import functools
+import os
+import re
+import unicodedata
+
+from tools.utils import logger
+
+# Articles of Spanish, Catalan and Galician place names, written before the name
+# ("Las Rozas de Madrid") or after it in official lists ("Rozas de Madrid, Las")
+ARTICLES = {
+    "el",
+    "la",
+    "los",
+    "las",
+    "l",
+    "els",
+    "es",
+    "sa",
+    "ses",
+    "o",
+    "a",
+    "os",
+    "as",
+}
+
+# Country suffixes that do not help to locate a municipality
+COUNTRIES = {"espana", "spain", "es"}
+
+GAZETTEER_PATH = os.environ.get(
+    "GAZETTEER_PATH",
+    os.path.join(os.path.dirname(__file__), "data", "municipalities_es.csv"),
+)
+
+
+def normalize_name(name: str) -> str:
+    """
+    Normalize a place name: lower case, without accents, punctuation, leading
+    articles or repeated whitespace.
+
+    :param name: The name
+    :return: The normalized name, e.g. "Las Rozas  de Madrid" -> "rozas de madrid"
+    """
+    name = unicodedata.normalize("NFKD", name)
+    name = "".join(char for char in name if not unicodedata.combining(char))
+    words = re.sub(r"[^a-z0-9]+", " ", name.lower()).split()
+
+    if len(words) > 1 and words[0] in ARTICLES:
+        words = words[1:]
+
+    return " ".join(words)
+
+
+def split_location(location: str) -> (str, str | None):
+    """
+    Split a location into its normalized municipality and region, e.g.
+    "Leganés, Madrid" or "Leganés (Madrid)" -> ("leganes", "madrid").
+
+    :param location: The location as written by the user
+    :return: The municipality and the region, None if there is no region
+    """
+    parts = [normalize_name(part) for part in re.split(r"[,()]", location)]
+    parts = [part for part in parts if part and part not in COUNTRIES]
+    if not parts:
+        return "", None
+
+    municipality, *regions = parts
+    # Article written after the name: "Rozas de Madrid, Las"
+    if regions and regions[0] in ARTICLES:
+        regions = regions[1:]
+
+    return municipality, regions[0] if regions else None
+
+
+def normalize_location(location: str) -> str:
+    """
+    Return the key of a location in the geocoding cache: its normalized municipality
+    and region. The region of a municipality written without one is taken from the
+    gazetteer when its name is unique, so different spellings of the same
+    municipality and province have the same key: "Leganés", "leganes" and
+    "Leganes, Madrid" are "leganes, madrid". Municipalities of different regions
+    never share a key: "Castejón, Navarra" and "Castejón, Cuenca".
+
+    :param location: The location as written by the user
+    :return: The key, only the municipality if its region is not known
+    """
+    municipality, region = split_location(location)
+    if region is None:
+        entries = find(municipality)
+        if len(entries) == 1:
+            region = entries[0][0]
+
+    return f"{municipality}, {region}" if region else municipality
+
+
+@functools.lru_cache(maxsize=1)
+def load_gazetteer(path: str) -> dict[str, list[tuple[str, float, float]]]:
+    """
+    Load a gazetteer csv with the columns Municipality, Province, Latitude and
+    Longitude, separated by ";".
+
+    :param path: The path of the gazetteer
+    :return: dict normalized municipality -> [(normalized province, latitude,
+        longitude)]
+    """
+    gazetteer = {}
+    with open(path, encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f, delimiter=";"):
+            entry = (
+                normalize_name(row["Province"]),
+                float(row["Latitude"]),
+                float(row["Longitude"]),
+            )
+            # Bilingual names are also found by each of their names:
+            # "Vitoria-Gasteiz", "Donostia/San Sebastián"
+            names = {normalize_name(row["Municipality"])}
+            names.update(
+                normalize_name(name)
+                for name in re.split(r"[/-]", row["Municipality"])
+                if len(name.strip()) > 2
+            )
+            for name in names:
+                gazetteer.setdefault(name, []).append(entry)
+
+    logger.info("Loaded gazetteer %s with %s names", path, len(gazetteer))
+    return gazetteer
+
+
+def find(
+    municipality: str, region: str | None = None
+) -> list[tuple[str, float, float]]:
+    """
+    Find a municipality in the offline gazetteer, configured with GAZETTEER_PATH.
+    An empty GAZETTEER_PATH disables it.
+
+    :param municipality: The normalized municipality
+    :param region: The normalized region, None to find it in every region
+    :return: List of (normalized province, latitude, longitude)
+    """
+    if not GAZETTEER_PATH or not os.path.exists(GAZETTEER_PATH):
+        return []
+
+    entries = load_gazetteer(GAZETTEER_PATH).get(municipality, [])
+    # Municipalities with the same name are told apart by the region
+    if region is not None:
+        entries = [entry for entry in entries if entry[0] == region]
+    return entries
+
+
+def lookup(location: str) -> tuple[float, float] | None:
+    """
+    Find the coordinates of a municipality in the offline gazetteer.
+
+    :param location: The location as written by the user
+    :return: The latitude and longitude, or None if the municipality is not found,
+        is in another region or is ambiguous
+    """
+    entries = find(*split_location(location))
+    if len(entries) != 1:
+        return None
+
+    _, latitude, longitude = entries[0]
+    return latitude, longitude
@@ -0,0 +1,70 @@
+"""
+Check the import time of the api with `python -X importtime`:
+
+    cd apps/backend/app && python -m tools.import_time
+
+Fails if importing the api takes longer than IMPORT_TIME_BUDGET_MS or if it imports
+one of the heavy libraries that must only be imported on the paths that need them.
+"""
+
+import os
+import subprocess
+import sys
+
+MODULE = "API.main"
+
+# Imported lazily by the analyses or by the warm up
+LAZY_MODULES = ["pandas", "numpy", "matplotlib", "requests"]
+
+IMPORT_TIME_BUDGET_MS = float(os.environ.get("IMPORT_TIME_BUDGET_MS", "1000"))
+
+
+def measure(module: str = MODULE) -> dict[str, float]:
+    """
+    Import a module in a new interpreter and return the cumulative import time of
+    every module imported.
+
+    :param module: The module to import
+    :return: dict module -> cumulative import time in ms
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative) / 1000
+
+    return times
+
+
+def main() -> int:
+    times = measure()
+    total = times[MODULE]
+
+    print(f"{MODULE}: {total:.0f} ms (budget {IMPORT_TIME_BUDGET_MS:.0f} ms)")
+    for name, cumulative in sorted(times.items(), key=lambda item: -item[1])[:10]:
+        print(f"  {cumulative:8.1f} ms  {name}")
+
+    failed = False
+    if total > IMPORT_TIME_BUDGET_MS:
+        print(f"Over budget by {total - IMPORT_TIME_BUDGET_MS:.0f} ms")
+        failed = True
+
+    eager = [name for name in LAZY_MODULES if name in times]
+    if eager:
+        print(f"Imported at startup: {', '.join(eager)}")
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
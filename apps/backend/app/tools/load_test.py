@@ -0,0 +1,643 @@
+"""
+Load test the api on one machine without calling PVGIS or positionstack:
+
+    cd apps/backend/app && python -m tools.load_test --duration 60 \
+        --solar-rate 0.5 --energy-rate 0.5 --get-rate 20 \
+        --stub-latency-ms 300 --stub-error-rate 0.05
+
+Starts a stub of PVGIS (PVcalc and seriescalc) and positionstack that answers with
+the files parsed by pvgis_api_wrapper after a configurable latency, failing a
+configurable share of the requests, and an api (uvicorn) using it with a temporary
+output folder. With --url the requests go to a running api instead, started with
+PVGIS_URL and POSITIONSTACK_URL pointing to the stub (see --stub-port).
+
+Uploads and GETs of the uploaded analyses are sent at the configured rates for
+--duration seconds, and the throughput, errors and p50/p95/p99 latency of every
+endpoint are printed. Requests are sent on schedule even when the api falls behind,
+and their latency is measured from the time they were due, so a saturated api shows
+up in the percentiles instead of lowering the rate.
+"""
+
+import argparse
+import datetime
+import functools
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+# Endpoints read after the uploads: (kind of analysis, path, query parameters)
+GET_ENDPOINTS = [
+    ("solar", "/api/solar/monthly_production/{analysisId}", {}),
+    ("solar", "/api/solar/monthly_consumption/{analysisId}", {}),
+    ("solar", "/api/solar/self_percent_ratios/{analysisId}", {}),
+    ("solar", "/api/solar/results_time_slot_solar/{analysisId}", {}),
+    ("solar", "/api/solar/hourly_data/{analysisId}", {}),
+    ("solar", "/api/solar/battery/{analysisId}", {}),
+    ("solar", "/api/solar/profiles/{analysisId}", {"group_by": "month"}),
+    ("solar", "/api/solar/load_shifting/{analysisId}", {"budget": 3, "max_power": 1.5}),
+    ("energy", "/api/energy/time-slots/{analysisId}", {}),
+]
+
+SOLAR_UPLOAD = "POST /api/solar/process-file"
+ENERGY_UPLOAD = "POST /api/energy/time-slots"
+
+
+def percentile(values: list[float], q: float) -> float:
+    """
+    Nearest rank percentile.
+
+    :param values: Sorted values
+    :param q: Percentile, from 0 to 100
+    """
+    if not values:
+        return 0.0
+    return values[max(math.ceil(q / 100 * len(values)) - 1, 0)]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# Stub of the external apis
+
+
+def solar_power(time: datetime.datetime, peakpower: float) -> float:
+    """
+    Power of a pv system in W: a sine during the day, higher in summer.
+    """
+    if not 6 <= time.hour <= 20:
+        return 0.0
+    day = time.timetuple().tm_yday
+    season = 0.65 + 0.35 * math.sin(math.pi * (day - 80) / 365)
+    return max(0.0, math.sin(math.pi * (time.hour - 6) / 14)) * season * peakpower * 800
+
+
+@functools.lru_cache(maxsize=32)
+def pvgis_hourly_csv(start_year: int, end_year: int, peakpower: float) -> str:
+    """
+    Response of seriescalc: 10 lines of header, the columns, one row per hour and
+    11 lines of footer.
+    """
+    lines = [
+        "Latitude (decimal degrees):\t40.328",
+        "Longitude (decimal degrees):\t-3.764",
+        "Elevation (m):\t667",
+        "Radiation database:\tPVGIS-SARAH2",
+        "",
+        "Slope: 20 deg. ",
+        "Azimuth: -15 deg. ",
+        f"Nominal power of the PV system (c-Si) (kWp):\t{peakpower}",
+        "System losses (%):\t18.0",
+        "",
+        "time,P,G(i),H_sun,T2m,WS10m,Int",
+    ]
+    time = datetime.datetime(start_year, 1, 1, 0, 10)
+    while time.year <= end_year:
+        lines.append(
+            f"{time:%Y%m%d:%H%M},{solar_power(time, peakpower):.2f},"
+            "0.0,0.0,10.0,1.0,0.0"
+        )
+        time += datetime.timedelta(hours=1)
+    lines += [
+        "",
+        "P: PV system power (W)",
+        "G(i): Global irradiance on the inclined plane (plane of the array) (W/m2)",
+        "H_sun: Sun height (degree)",
+        "T2m: 2-m air temperature (degree Celsius)",
+        "WS10m: 10-m total wind speed (m/s)",
+        "Int: 1 means solar radiation values are reconstructed",
+        "",
+        "PVGIS (c) European Union, 2001-2024",
+        "Load test stub",
+        "",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+@functools.lru_cache(maxsize=32)
+def pvgis_monthly_csv(peakpower: float) -> str:
+    """
+    Response of PVcalc: 9 lines of header and one row per month, with the columns
+    separated by 2 tabs.
+    """
+    lines = [
+        "Latitude (decimal degrees):\t40.328",
+        "Longitude (decimal degrees):\t-3.764",
+        "Elevation (m):\t667",
+        "Radiation database:\tPVGIS-SARAH2",
+        "",
+        f"Nominal power (kWp):\t{peakpower}",
+        "System losses (%):\t18",
+        "Slope angle (°):\t20",
+        "Azimuth angle (°):\t-15",
+        "Month\t\tE_d\t\tE_m\t\tH(i)_d\t\tH(i)_m\t\tSD_m",
+    ]
+    for month in range(1, 13):
+        season = 0.65 + 0.35 * math.sin(math.pi * (month - 3) / 12)
+        energy_day = 4.5 * peakpower * season
+        lines.append(
+            f"{month}\t\t{energy_day:.2f}\t\t{energy_day * 30:.2f}"
+            "\t\t4.1\t\t120.3\t\t20.1"
+        )
+    lines += ["", "E_d: Average daily energy production from the given system (kWh/d)"]
+    return "\n".join(lines) + "\n"
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int, latency: float, jitter: float, error_rate: float):
+        """
+        :param port: Port to listen on, 0 for any free port
+        :param latency: Mean latency of the responses in seconds
+        :param jitter: Max deviation of the latency in seconds
+        :param error_rate: Share of the requests answered with a 503
+        """
+        super().__init__(("127.0.0.1", port), StubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = Counter()
+        self.errors = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    server: StubServer
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        endpoint = url.path.rsplit("/", 1)[-1]
+
+        time.sleep(
+            max(
+                self.server.latency
+                + random.uniform(-self.server.jitter, self.server.jitter),
+                0,
+            )
+        )
+        failed = random.random() < self.server.error_rate
+        with self.server.lock:
+            self.server.requests[endpoint] += 1
+            self.server.errors[endpoint] += failed
+
+        peakpower = float(params.get("peakpower", 1))
+        if failed:
+            status, content_type, body = 503, "application/json", '{"message": "Stub"}'
+        elif endpoint == "forward":
+            # Coordinates derived from the name, the same for every request
+            seed = random.Random(params.get("query", ""))
+            status, content_type = 200, "application/json"
+            body = json.dumps(
+                {
+                    "data": [
+                        {
+                            "latitude": round(seed.uniform(36, 43), 4),
+                            "longitude": round(seed.uniform(-9, 3), 4),
+                            "label": params.get("query", ""),
+                        }
+                    ]
+                }
+            )
+        elif endpoint == "PVcalc":
+            status, content_type = 200, "text/csv"
+            body = pvgis_monthly_csv(peakpower)
+        elif endpoint == "seriescalc":
+            status, content_type = 200, "text/csv"
+            body = pvgis_hourly_csv(
+                int(params.get("startyear", 2020)),
+                int(params.get("endyear", 2020)),
+                peakpower,
+            )
+        else:
+            status, content_type, body = 404, "application/json", "{}"
+
+        content = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        # Quiet, the counters are reported at the end
+        pass
+
+
+def start_stub(port: int, latency: float, jitter: float, error_rate: float):
+    server = StubServer(port, latency, jitter, error_rate)
+    threading.Thread(target=server.serve_forever, name="stub", daemon=True).start()
+    return server
+
+
+# Load
+
+
+def consumption_file(seed: int) -> bytes:
+    """
+    Consumption file of a year with hourly values, different for every seed so every
+    upload is a new analysis.
+    """
+    rng = random.Random(seed)
+    lines = ["CUPS;Fecha;Hora;Consumo_kWh;Metodo_obtencion"]
+    day = datetime.date(2023, 1, 1)
+    while day.year == 2023:
+        for hour in range(1, 25):
+            energy = (
+                0.2
+                + 0.5 * math.exp(-((hour - 21) ** 2) / 8)
+                + 0.3 * math.exp(-((hour - 9) ** 2) / 4)
+                + rng.random() * 0.1
+            )
+            lines.append(
+                f"ES{seed:020d};{day:%d/%m/%Y};{hour};"
+                + f"{energy:.3f}".replace(".", ",")
+                + ";R"
+            )
+        day += datetime.timedelta(days=1)
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+class LoadTest:
+    def __init__(self, url: str, args: argparse.Namespace):
+        self.url = url.rstrip("/")
+        self.args = args
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.latencies: dict[str, list[float]] = {}
+        self.statuses: dict[str, Counter] = {}
+        self.analyses = {"solar": [], "energy": []}
+        self.uploads = 0
+
+    def session(self) -> requests.Session:
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def record(self, endpoint: str, seconds: float, status: int | str) -> None:
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            self.statuses.setdefault(endpoint, Counter())[status] += 1
+
+    def next_seed(self) -> int:
+        with self.lock:
+            self.uploads += 1
+            return self.uploads + self.args.seed * 1_000_000
+
+    def upload(self, kind: str) -> requests.Response:
+        seed = self.next_seed()
+        files = {"consumption_file": (f"{seed}.csv", consumption_file(seed))}
+        if kind == "energy":
+            return self.session().post(
+                f"{self.url}/api/energy/time-slots", files=files, timeout=600
+            )
+
+        # A few locations and installations, so the production is sometimes new
+        site = random.Random(seed).randrange(self.args.sites)
+        data = {
+            "location": f"Load test {site % self.args.locations}",
+            "peakpower": 3 + site,
+            "mountingplace": "building",
+            "loss": 14,
+            "angle": 30,
+            "aspect": 0,
+        }
+        return self.session().post(
+            f"{self.url}/api/solar/process-file", files=files, data=data, timeout=600
+        )
+
+    def send(self, scenario: str, due: float) -> None:
+        """
+        Send one request of a scenario and record its latency from the time it was
+        due.
+        """
+        if scenario in ("solar", "energy"):
+            endpoint = SOLAR_UPLOAD if scenario == "solar" else ENERGY_UPLOAD
+            send = functools.partial(self.upload, scenario)
+        else:
+            with self.lock:
+                endpoints = [e for e in GET_ENDPOINTS if self.analyses[e[0]]]
+                kind, path, params = random.choice(endpoints)
+                analysisId = random.choice(self.analyses[kind])
+            endpoint = f"GET {path}"
+            send = functools.partial(
+                self.session().get,
+                self.url + path.format(analysisId=analysisId),
+                params=params,
+                timeout=600,
+            )
+
+        try:
+            response = send()
+            status = response.status_code
+        except requests.RequestException as e:
+            response, status = None, type(e).__name__
+        self.record(endpoint, time.perf_counter() - due, status)
+
+        if scenario in ("solar", "energy") and status == 200:
+            with self.lock:
+                self.analyses[scenario].append(response.json()["analysisId"])
+
+    def seed_analyses(self) -> None:
+        """
+        Upload one analysis of each kind before the test, so there is something to
+        read from the start.
+        """
+        for kind in ("solar", "energy"):
+            response = self.upload(kind)
+            if response.status_code != 200:
+                raise RuntimeError(
+                    f"The first {kind} upload failed with "
+                    f"{response.status_code}: {response.text[:200]}"
+                )
+            self.analyses[kind].append(response.json()["analysisId"])
+
+    def run(self) -> float:
+        """
+        Send every scenario at its rate for the duration of the test.
+
+        :return: seconds elapsed until the last response
+        """
+        rates = {
+            "solar": self.args.solar_rate,
+            "energy": self.args.energy_rate,
+            "get": self.args.get_rate,
+        }
+        pool = ThreadPoolExecutor(
+            max_workers=self.args.concurrency, thread_name_prefix="load"
+        )
+        started = time.perf_counter()
+
+        def schedule(scenario: str, rate: float) -> None:
+            # Open loop: the n-th request is due at n / rate whatever the responses
+            n = 0
+            while (due := started + n / rate) < started + self.args.duration:
+                time.sleep(max(due - time.perf_counter(), 0))
+                pool.submit(self.send, scenario, due)
+                n += 1
+
+        schedulers = [
+            threading.Thread(target=schedule, args=(scenario, rate), daemon=True)
+            for scenario, rate in rates.items()
+            if rate > 0
+        ]
+        for scheduler in schedulers:
+            scheduler.start()
+        for scheduler in schedulers:
+            scheduler.join()
+        pool.shutdown(wait=True)
+
+        return time.perf_counter() - started
+
+    def report(self, elapsed: float) -> dict:
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            statuses = self.statuses[endpoint]
+            errors = sum(n for status, n in statuses.items() if status != 200)
+            endpoints[endpoint] = {
+                "requests": len(latencies),
+                "errors": errors,
+                "throughput": len(latencies) / elapsed,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "max_ms": latencies[-1] * 1000,
+                "statuses": {str(status): n for status, n in statuses.items()},
+            }
+
+        return {
+            "elapsed_seconds": elapsed,
+            "requests": sum(e["requests"] for e in endpoints.values()),
+            "errors": sum(e["errors"] for e in endpoints.values()),
+            "endpoints": endpoints,
+        }
+
+
+def print_report(report: dict, stub: StubServer) -> None:
+    elapsed = report["elapsed_seconds"]
+    print(
+        f"\n{report['requests']} requests in {elapsed:.1f}s "
+        f"({report['requests'] / elapsed:.1f}/s), {report['errors']} errors\n"
+    )
+    print(
+        f"  {'endpoint':<56} {'requests':>8} {'errors':>6} {'req/s':>7} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+    )
+    for endpoint, stats in report["endpoints"].items():
+        print(
+            f"  {endpoint:<56} {stats['requests']:>8} {stats['errors']:>6} "
+            f"{stats['throughput']:>7.2f} {stats['p50_ms']:>8.0f} "
+            f"{stats['p95_ms']:>8.0f} {stats['p99_ms']:>8.0f} {stats['max_ms']:>8.0f}"
+        )
+    for endpoint, stats in report["endpoints"].items():
+        if stats["errors"]:
+            print(f"  {endpoint}: {stats['statuses']}")
+
+    print("\n  stub requests (errors): ", end="")
+    print(
+        ", ".join(
+            f"{endpoint} {n} ({stub.errors[endpoint]})"
+            for endpoint, n in sorted(stub.requests.items())
+        )
+        or "none"
+    )
+
+
+def start_api(stub: StubServer, port: int, workers: int, output_path: str):
+    """
+    Start the api with uvicorn, using the stub and a new output folder.
+
+    :return: the process and the path of its log
+    """
+    env = {
+        **os.environ,
+        "OUTPUT_PATH": os.path.join(output_path, "output"),
+        "PVGIS_URL": f"{stub.url}/pvgis",
+        "POSITIONSTACK_URL": f"{stub.url}/positionstack",
+        "POSITIONSTACK_ACCESS_KEY": "load-test",
+    }
+    log_path = os.path.join(output_path, "api.log")
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "API.main:app",
+                "--host",
+                "127.0.0.1",
+                "--port",
+                str(port),
+                "--workers",
+                str(workers),
+                "--no-access-log",
+            ],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            if requests.get(f"{url}/api/health", timeout=1).status_code == 200:
+                return process, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+
+    process.kill()
+    with open(log_path, "r") as f:
+        raise RuntimeError("The api did not start:\n" + f.read()[-2000:])
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Load test the api with a stub of PVGIS and positionstack"
+    )
+    parser.add_argument(
+        "--url", help="Url of a running api, instead of starting one with uvicorn"
+    )
+    parser.add_argument(
+        "--api-workers", type=int, default=1, help="uvicorn workers (default: 1)"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=30, help="Seconds (default: 30)"
+    )
+    parser.add_argument(
+        "--solar-rate",
+        type=float,
+        default=0.5,
+        help="Solar uploads per second (default: 0.5)",
+    )
+    parser.add_argument(
+        "--energy-rate",
+        type=float,
+        default=0.5,
+        help="Energy uploads per second (default: 0.5)",
+    )
+    parser.add_argument(
+        "--get-rate",
+        type=float,
+        default=10,
+        help="GETs of the uploaded analyses per second (default: 10)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=64,
+        help="Max requests in flight (default: 64)",
+    )
+    parser.add_argument(
+        "--sites",
+        type=int,
+        default=4,
+        help="Different installations of the solar uploads (default: 4)",
+    )
+    parser.add_argument(
+        "--locations",
+        type=int,
+        default=2,
+        help="Different locations of the solar uploads (default: 2)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the uploads")
+    parser.add_argument("--output", help="Write the report to this json file")
+
+    stub = parser.add_argument_group("stub of PVGIS and positionstack")
+    stub.add_argument(
+        "--stub-port", type=int, default=0, help="Port (default: any free port)"
+    )
+    stub.add_argument(
+        "--stub-latency-ms", type=float, default=200, help="Latency (default: 200)"
+    )
+    stub.add_argument(
+        "--stub-jitter-ms",
+        type=float,
+        default=50,
+        help="Max deviation of the latency (default: 50)",
+    )
+    stub.add_argument(
+        "--stub-error-rate",
+        type=float,
+        default=0,
+        help="Share of the requests answered with 503 (default: 0)",
+    )
+    args = parser.parse_args(argv)
+
+    if args.sites < 1 or args.locations < 1:
+        parser.error("--sites and --locations must be at least 1")
+
+    stub_server = start_stub(
+        args.stub_port,
+        args.stub_latency_ms / 1000,
+        args.stub_jitter_ms / 1000,
+        args.stub_error_rate,
+    )
+    print(f"Stub listening on {stub_server.url}")
+
+    with tempfile.TemporaryDirectory(prefix="load-test-") as output_path:
+        process = None
+        try:
+            if args.url:
+                url = args.url
+                print(
+                    f"Start the api with PVGIS_URL={stub_server.url}/pvgis and "
+                    f"POSITIONSTACK_URL={stub_server.url}/positionstack"
+                )
+            else:
+                process, url = start_api(
+                    stub_server, free_port(), args.api_workers, output_path
+                )
+                print(f"Api listening on {url}, {args.api_workers} workers")
+
+            load_test = LoadTest(url, args)
+            load_test.seed_analyses()
+            print(f"Sending requests for {args.duration:.0f}s")
+            elapsed = load_test.run()
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=30)
+            stub_server.shutdown()
+
+    report = load_test.report(elapsed)
+    print_report(report, stub_server)
+    if args.output:
+        report["stub"] = {
+            "requests": dict(stub_server.requests),
+            "errors": dict(stub_server.errors),
+        }
+        report["arguments"] = vars(args)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    return 1 if report["errors"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,19 +1,117 @@
+import hashlib
 import json
-import logging
 import os
 
-import requests
-from dotenv import load_dotenv
-
-from .energy_analysis_lib.constants import PATHS
-
-load_dotenv()
-
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+from . import gazetteer, upstream
+from .energy_analysis_lib import single_flight, storage
+from .energy_analysis_lib import utils as lib_utils
+from .energy_analysis_lib.constants import PATHS, PVGIS_SERIES, UPSTREAM_URLS
+from .utils import logger
 
 locations_cache = os.path.join(PATHS["locations"], "locations.json")
 production_monthly_cache = os.path.join(PATHS["production"], "monthly.json")
 production_hourly_cache = os.path.join(PATHS["production"], "hourly.json")
+production_series_cache = os.path.join(PATHS["production"], "series.json")
+# PVGIS request -> analysis with its response, to reuse it when PVGIS is unavailable
+production_requests_cache = os.path.join(PATHS["production"], "requests.json")
+
+
+# Loaded caches by path, with the inode, modification time and size of the file.
+# Caches are written to a new file, so a new inode means a new version
+_loaded_caches: dict[str, tuple[tuple[int, int, int], dict]] = {}
+
+
+def _read_cache(cache_path: str) -> dict:
+    try:
+        with open(cache_path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def load_cache(cache_path: str) -> dict:
+    """
+    Loads a json cache. Caches are replaced atomically, so no lock is needed to read.
+    The cache is only read again when the file changes, so it must not be modified
+
+    :param cache_path: path of the cache
+    :return: content of the cache, empty if it does not exist
+    """
+    try:
+        stat = os.stat(cache_path)
+    except FileNotFoundError:
+        return {}
+
+    version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    loaded = _loaded_caches.get(cache_path)
+    if loaded is None or loaded[0] != version:
+        loaded = (version, _read_cache(cache_path))
+        _loaded_caches[cache_path] = loaded
+
+    return loaded[1]
+
+
+def update_cache(cache_path: str, key: str, value) -> None:
+    """
+    Sets a key of a json cache. The cache is reloaded under a lock shared by all the
+    workers so concurrent updates are not lost
+
+    :param cache_path: path of the cache
+    :param key: key to set
+    :param value: value to set
+    """
+    with lib_utils.file_lock(os.path.basename(cache_path)):
+        cache = _read_cache(cache_path)
+        cache[key] = value
+        with lib_utils.atomic_write(cache_path, "w") as f:
+            json.dump(cache, f)
+
+
+def remove_from_cache(cache_path: str, key: str) -> None:
+    """
+    Removes a key of a json cache if it exists
+
+    :param cache_path: path of the cache
+    :param key: key to remove
+    """
+    with lib_utils.file_lock(os.path.basename(cache_path)):
+        cache = _read_cache(cache_path)
+        if cache.pop(key, None) is None:
+            return
+        with lib_utils.atomic_write(cache_path, "w") as f:
+            json.dump(cache, f)
+
+
+def remove_values_from_cache(cache_path: str, value) -> None:
+    """
+    Removes the keys of a json cache with a value
+
+    :param cache_path: path of the cache
+    :param value: value of the keys to remove
+    """
+    with lib_utils.file_lock(os.path.basename(cache_path)):
+        cache = _read_cache(cache_path)
+        kept = {key: item for key, item in cache.items() if item != value}
+        if len(kept) == len(cache):
+            return
+        with lib_utils.atomic_write(cache_path, "w") as f:
+            json.dump(kept, f)
+
+
+def is_production_saved(cache_path: str, path: str, analysisId: str) -> bool:
+    """
+    Checks if the production of an analysis is already saved, by this or by another
+    worker
+
+    :param cache_path: path of the production cache
+    :param path: folder of the production files
+    :param analysisId: id of the system
+    :return: True if the production is saved
+    """
+    production_path = os.path.join(path, analysisId + ".csv")
+    return analysisId in load_cache(cache_path) or os.path.exists(
+        storage.fetch(production_path)
+    )
 
 
 def get_coordinates(location: str) -> (str, str):
@@ -23,56 +121,215 @@ def get_coordinates(location: str) -> (str, str):
     :param locations: location to get the coordinates
     :return: latitude and longitude of the location
     """
-    # Create the locations folder if it does not exist
-    if not os.path.exists(PATHS["locations"]):
-        os.makedirs(PATHS["locations"])
+    latitude, longitude, _ = locate(location)
+    return latitude, longitude
+
+
+def find_in_cache(location: str) -> tuple[str, str] | None:
+    """
+    Finds the coordinates of a location in the cache, by its normalized municipality
+    and region or by the raw name used by older caches
 
-    # Load the locations saved or create the file
-    try:
-        with open(locations_cache, "r") as f:
-            locations_dict = json.load(f)
-    except FileNotFoundError:
-        locations_dict = {}
-        with open(locations_cache, "w") as f:
-            json.dump(locations_dict, f)
+    :param location: location to get the coordinates
+    :return: latitude and longitude of the location, None if it is not saved
+    """
+    locations_dict = load_cache(locations_cache)
+
+    for key in (gazetteer.normalize_location(location), location):
+        if key in locations_dict:
+            latitude, longitude = locations_dict[key]
+            return latitude, longitude
+    return None
 
+
+def locate(location: str) -> (str, str, str):
+    """
+    Gets the coordinates of a location from the cache, the offline gazetteer or the
+    positionstack API, in this order
+
+    :param location: location to get the coordinates
+    :return: latitude, longitude and source of the coordinates: "cache",
+        "gazetteer" or "api"
+    """
     # Check if the location is already saved
-    if location in locations_dict:
-        latitude, longitude = locations_dict[location]
-        logging.info("Location found in cache")
-        return latitude, longitude
+    coordinates = find_in_cache(location)
+    if coordinates is not None:
+        logger.info("Location found in cache")
+        return *coordinates, "cache"
+
+    coordinates = gazetteer.lookup(location)
+    if coordinates is not None:
+        logger.info("Location found in gazetteer")
+        return *coordinates, "gazetteer"
+
+    # Concurrent requests of the same location share a single api call
+    latitude, longitude = single_flight.do(
+        f"positionstack:{gazetteer.normalize_location(location) or location}",
+        lambda: download_coordinates(location),
+    )
+    return latitude, longitude, "api"
+
+
+def find_fallback_coordinates(location: str) -> tuple[float, float] | None:
+    """
+    Finds the coordinates of a location while positionstack is unavailable, in the
+    gazetteer and the cache entries of the same municipality. A municipality
+    written without a region is taken from any region, and only if all of them are
+    the same place
+
+    :param location: location to get the coordinates
+    :return: latitude and longitude of the location, None if it is not found or is
+        ambiguous
+    """
+    municipality, region = gazetteer.split_location(location)
+    if not municipality:
+        return None
+
+    candidates = [
+        (latitude, longitude)
+        for _, latitude, longitude in gazetteer.find(municipality, region)
+    ]
+    for key, (latitude, longitude) in load_cache(locations_cache).items():
+        key_municipality, key_region = gazetteer.split_location(key)
+        if key_municipality == municipality and region in (None, key_region):
+            candidates.append((float(latitude), float(longitude)))
+
+    # Rounded to about a kilometer, the sources do not give the same decimals
+    if len({(round(lat, 2), round(lon, 2)) for lat, lon in candidates}) != 1:
+        return None
+    return candidates[0]
+
+
+def download_coordinates(location: str) -> (str, str):
+    """
+    Gets the coordinates of a location from the positionstack API and saves them in
+    the cache
+
+    :param location: location to get the coordinates
+    :return: latitude and longitude of the location
+    """
+    # Saved by another request while waiting
+    coordinates = find_in_cache(location)
+    if coordinates is not None:
+        logger.info("Location found in cache")
+        return coordinates
 
     # If the location is not saved, get the coordinates from the API
-    url = "http://api.positionstack.com/v1/forward"
+    url = f"{UPSTREAM_URLS['positionstack']}/forward"
 
     # Get Access Key from .env file
     params = {"access_key": os.getenv("POSITIONSTACK_ACCESS_KEY"), "query": location}
 
-    logging.info("Getting coordinates from API")
+    logger.info("Getting coordinates from API")
 
     # Get the response from the API
-    response = requests.get(url, params=params)
+    response = upstream.positionstack.get(
+        url, params=params, fallback=lambda: find_fallback_coordinates(location)
+    )
+    if isinstance(response, tuple):
+        # Not saved, the fallback may be less precise than the api
+        logger.info("Location found in fallback")
+        return response
     response_json = response.json()
 
     # Check if the response is correct
     if response.status_code != 200:
-        logging.error("Error getting coordinates from API")
-        logging.error(response_json)
-        raise ValueError("Error getting coordinates from API")
+        logger.error("Error getting coordinates from API")
+        logger.error(response_json)
+        raise upstream.UpstreamError(
+            "Error getting coordinates from API", status_code=response.status_code
+        )
+
+    if not response_json.get("data"):
+        raise upstream.UpstreamError(f"Location {location} not found", status_code=404)
 
     # Get the coordinates from the response
     latitude = response_json["data"][0]["latitude"]
     longitude = response_json["data"][0]["longitude"]
 
-    # Save the coordinates in the cache
-    locations_dict[location] = (latitude, longitude)
-    with open(locations_cache, "w") as f:
-        json.dump(locations_dict, f)
+    # Save the coordinates in the cache, by normalized municipality and region so
+    # other spellings of the location are found too
+    update_cache(
+        locations_cache,
+        gazetteer.normalize_location(location) or location,
+        (latitude, longitude),
+    )
 
-    logging.info("Location found in API")
+    logger.info("Location found in API")
     return latitude, longitude
 
 
+def _request_key(url: str, params: dict) -> str:
+    # Same url and parameters, so the same response
+    return hashlib.sha256(
+        json.dumps([url, params], sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def find_saved_response(url: str, params: dict, path: str) -> str | None:
+    """
+    Finds the response of the same PVGIS request saved for another analysis, e.g.
+    the same installation with another spelling of its location, while PVGIS is
+    unavailable
+
+    :param url: url of the request
+    :param params: parameters of the request
+    :param path: folder of the production files of the request
+    :return: content of the response, None if it was not saved
+    """
+    analysisId = load_cache(production_requests_cache).get(_request_key(url, params))
+    if analysisId is None:
+        return None
+
+    try:
+        with open(storage.fetch(os.path.join(path, analysisId + ".csv")), "r") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def download_production(
+    url: str, params: dict, path: str, cache_path: str, analysisId: str
+) -> None:
+    """
+    Gets a production of a pv system from the PVGIS API, or the same response saved
+    for another analysis while PVGIS is unavailable, and saves it
+
+    :param url: url of the request
+    :param params: parameters of the request
+    :param path: folder of the production files
+    :param cache_path: path of the production cache
+    :param analysisId: id of the system
+    :return: None
+    """
+    # Get the response from the API
+    response = upstream.pvgis.get(
+        url, params=params, fallback=lambda: find_saved_response(url, params, path)
+    )
+
+    if isinstance(response, str):
+        logger.info("Production found in fallback")
+        text = response
+    else:
+        # Check if the response is correct
+        if response.status_code != 200:
+            logger.error("Error getting production from API")
+            logger.error(response.text)
+            raise upstream.UpstreamError(
+                "Error getting production from API", status_code=response.status_code
+            )
+        text = response.text
+
+    # Save the production in a file
+    with lib_utils.atomic_write(os.path.join(path, analysisId + ".csv"), "w") as f:
+        f.write(text)
+    logger.info("Written production to file")
+
+    # Set true once the production is saved
+    update_cache(cache_path, analysisId, True)
+    update_cache(production_requests_cache, _request_key(url, params), analysisId)
+
+
 def get_monthly_production(
     location: str,
     peakpower: float,
@@ -94,29 +351,55 @@ def get_monthly_production(
     :param analysisId: id of the system
     :return: None
     """
-    # Get the coordinates of the location
-    latitude, longitude = get_coordinates(location)
+    # Check if the production is already saved, by this or by another worker
+    if is_production_saved(
+        production_monthly_cache, PATHS["production_monthly"], analysisId
+    ):
+        logger.info("Production found in cache")
+        return
 
-    # Create the production folder if it does not exist
-    if not os.path.exists(PATHS["production"]):
-        os.makedirs(PATHS["production"])
+    # Concurrent requests of the same analysis share a single api call
+    single_flight.do(
+        f"pvgis_monthly:{analysisId}",
+        lambda: download_monthly_production(
+            location, peakpower, mountingplace, loss, angle, aspect, analysisId
+        ),
+    )
 
-    # Load the production saved or create the file
-    try:
-        with open(production_monthly_cache, "r") as f:
-            production_dict = json.load(f)
-    except FileNotFoundError:
-        production_dict = {}
-        with open(production_monthly_cache, "w") as f:
-            json.dump(production_dict, f)
 
-    # Check if the production is already saved
-    if analysisId in production_dict:
-        logging.info("Production found in cache")
+def download_monthly_production(
+    location: str,
+    peakpower: float,
+    mountingplace: str,
+    loss: float,
+    angle: float,
+    aspect: float,
+    analysisId: str,
+) -> None:
+    """
+    Gets the monthly production of a pv system from the PVGIS API and saves it
+
+    :param location: location of the pv system
+    :param peakpower: peak power of the pv system
+    :param mountingplace: mounting place of the pv system. "free" or "building"
+    :param loss: loss of the pv system
+    :param angle: angle of the pv system
+    :param aspect: azimuth of the pv system
+    :param analysisId: id of the system
+    :return: None
+    """
+    # Saved by another request while waiting
+    if is_production_saved(
+        production_monthly_cache, PATHS["production_monthly"], analysisId
+    ):
+        logger.info("Production found in cache")
         return
 
+    # Get the coordinates of the location
+    latitude, longitude = get_coordinates(location)
+
     # If the production is not saved, get the production from the API
-    url = "https://re.jrc.ec.europa.eu/api/v5_2/PVcalc"
+    url = f"{UPSTREAM_URLS['pvgis']}/PVcalc"
 
     params = {
         "lat": latitude,
@@ -129,31 +412,17 @@ def get_monthly_production(
         "outputformat": "csv",
     }
 
-    logging.info("Getting monthly production from API")
-
-    # Get the response from the API
-    response = requests.get(url, params=params)
-
-    # Check if the response is correct
-    if response.status_code != 200:
-        logging.error("Error getting production from API")
-        logging.error(response.text)
-        raise ValueError("Error getting production from API")
-
-    # Set true if the production is saved
-    production_dict[analysisId] = True
-    with open(production_monthly_cache, "w") as f:
-        json.dump(production_dict, f)
+    logger.info("Getting monthly production from API")
 
-    # Create directory if it does not exist
-    if not os.path.exists(PATHS["production_monthly"]):
-        os.makedirs(PATHS["production_monthly"])
+    download_production(
+        url,
+        params,
+        PATHS["production_monthly"],
+        production_monthly_cache,
+        analysisId,
+    )
 
-    # Save the production in a file
-    with open(os.path.join(PATHS["production_monthly"], analysisId + ".csv"), "w") as f:
-        f.write(response.text)
-
-    logging.info("Production found in API")
+    logger.info("Production found in API")
     return
 
 
@@ -178,29 +447,55 @@ def get_hourly_production(
     :param analysisId: id of the system
     :return: None
     """
-    # Get the coordinates of the location
-    latitude, longitude = get_coordinates(location)
+    # Check if the production is already saved, by this or by another worker
+    if is_production_saved(
+        production_hourly_cache, PATHS["production_hourly"], analysisId
+    ):
+        logger.info("Production found in cache")
+        return
 
-    # Create the production folder if it does not exist
-    if not os.path.exists(PATHS["production"]):
-        os.makedirs(PATHS["production"])
+    # Concurrent requests of the same analysis share a single api call
+    single_flight.do(
+        f"pvgis_hourly:{analysisId}",
+        lambda: download_hourly_production(
+            location, peakpower, mountingplace, loss, angle, aspect, analysisId
+        ),
+    )
 
-    # Load the production saved or create the file
-    try:
-        with open(production_hourly_cache, "r") as f:
-            production_dict = json.load(f)
-    except FileNotFoundError:
-        production_dict = {}
-        with open(production_hourly_cache, "w") as f:
-            json.dump(production_dict, f)
 
-    # Check if the production is already saved
-    if analysisId in production_dict:
-        logging.info("Production found in cache")
+def download_hourly_production(
+    location: str,
+    peakpower: float,
+    mountingplace: str,
+    loss: float,
+    angle: float,
+    aspect: float,
+    analysisId: str,
+) -> None:
+    """
+    Gets the hourly production of a pv system from the PVGIS API and saves it
+
+    :param location: location of the pv system
+    :param peakpower: peak power of the pv system
+    :param mountingplace: mounting place of the pv system. "free" or "building"
+    :param loss: loss of the pv system
+    :param angle: angle of the pv system
+    :param aspect: azimuth of the pv system
+    :param analysisId: id of the system
+    :return: None
+    """
+    # Saved by another request while waiting
+    if is_production_saved(
+        production_hourly_cache, PATHS["production_hourly"], analysisId
+    ):
+        logger.info("Production found in cache")
         return
 
+    # Get the coordinates of the location
+    latitude, longitude = get_coordinates(location)
+
     # If the production is not saved, get the production from the API
-    url = "https://re.jrc.ec.europa.eu/api/v5_2/seriescalc"
+    url = f"{UPSTREAM_URLS['pvgis']}/seriescalc"
 
     params = {
         "lat": latitude,
@@ -216,30 +511,104 @@ def get_hourly_production(
         "outputformat": "csv",
     }
 
-    logging.info("Getting hourly production from API")
+    logger.info("Getting hourly production from API")
 
-    # Get the response from the API
-    response = requests.get(url, params=params)
+    download_production(
+        url, params, PATHS["production_hourly"], production_hourly_cache, analysisId
+    )
 
-    # Check if the response is correct
-    if response.status_code != 200:
-        logging.error("Error getting production from API")
-        logging.error(response.text)
-        raise ValueError("Error getting production from API")
+    logger.info("Production found in API")
+    return
 
-    # Set true if the production is saved
-    production_dict[analysisId] = True
-    with open(production_hourly_cache, "w") as f:
-        json.dump(production_dict, f)
 
-    # Create directory if it does not exist
-    if not os.path.exists(PATHS["production_hourly"]):
-        os.makedirs(PATHS["production_hourly"])
+def get_hourly_production_series(
+    location: str,
+    peakpower: float,
+    mountingplace: str,
+    loss: float,
+    angle: float,
+    aspect: float,
+    analysisId: str,
+) -> None:
+    """
+    Gets the hourly production of a pv system in a location for every year of
+    PVGIS_SERIES
 
-    # Save the production in a file
-    with open(os.path.join(PATHS["production_hourly"], analysisId + ".csv"), "w") as f:
-        f.write(response.text)
-        logging.info("Written hourly production to file")
+    :param location: location of the pv system
+    :param peakpower: peak power of the pv system
+    :param mountingplace: mounting place of the pv system. "free" or "building"
+    :param loss: loss of the pv system
+    :param angle: angle of the pv system
+    :param aspect: azimuth of the pv system
+    :param analysisId: id of the system
+    :return: None
+    """
+    # Check if the production is already saved, by this or by another worker
+    if is_production_saved(
+        production_series_cache, PATHS["production_series"], analysisId
+    ):
+        logger.info("Production series found in cache")
+        return
 
-    logging.info("Production found in API")
-    return
+    # Concurrent requests of the same analysis share a single api call
+    single_flight.do(
+        f"pvgis_series:{analysisId}",
+        lambda: download_hourly_production_series(
+            location, peakpower, mountingplace, loss, angle, aspect, analysisId
+        ),
+    )
+
+
+def download_hourly_production_series(
+    location: str,
+    peakpower: float,
+    mountingplace: str,
+    loss: float,
+    angle: float,
+    aspect: float,
+    analysisId: str,
+) -> None:
+    """
+    Gets the multi-year hourly production of a pv system from the PVGIS API and
+    saves it
+
+    :param location: location of the pv system
+    :param peakpower: peak power of the pv system
+    :param mountingplace: mounting place of the pv system. "free" or "building"
+    :param loss: loss of the pv system
+    :param angle: angle of the pv system
+    :param aspect: azimuth of the pv system
+    :param analysisId: id of the system
+    :return: None
+    """
+    # Saved by another request while waiting
+    if is_production_saved(
+        production_series_cache, PATHS["production_series"], analysisId
+    ):
+        logger.info("Production series found in cache")
+        return
+
+    # Get the coordinates of the location
+    latitude, longitude = get_coordinates(location)
+
+    url = f"{UPSTREAM_URLS['pvgis']}/seriescalc"
+
+    params = {
+        "lat": latitude,
+        "lon": longitude,
+        "peakpower": peakpower,
+        "loss": loss,
+        "mountingplace": mountingplace,
+        "angle": angle,
+        "aspect": aspect,
+        "startyear": PVGIS_SERIES["start_year"],
+        "endyear": PVGIS_SERIES["end_year"],
+        "pvcalculation": 1,
+        "outputformat": "csv",
+    }
+
+    logger.info("Getting hourly production series from API")
+
+    download_production(
+        url, params, PATHS["production_series"], production_series_cache, analysisId
+    )
@@ -0,0 +1,364 @@
+import os
+import random
+import threading
+import time
+
+from tools.utils import logger
+
+
+class UpstreamError(Exception):
+    """
+    An external api answered with an error or could not be reached.
+    """
+
+    def __init__(self, message: str, status_code: int | None = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+    def __reduce__(self):
+        # Keep the attributes when raised in a worker process
+        return (type(self), (str(self), self.status_code))
+
+
+class UpstreamUnavailableError(UpstreamError):
+    """
+    The circuit breaker of an external api is open, the request was not sent.
+    """
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    def __reduce__(self):
+        return (type(self), (str(self), self.retry_after))
+
+
+class TokenBucket:
+    """
+    Rate limiter: requests take a token and tokens are refilled at a constant rate,
+    allowing bursts up to the size of the bucket.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        """
+        :param rate: Tokens refilled per second. 0 disables the limit
+        :param burst: Size of the bucket
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Take a token, waiting until one is available.
+
+        :return: The seconds waited
+        """
+        if not self.rate:
+            return 0
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            # Reserve the token now and wait outside the lock, so the waiters are
+            # served in order
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class CircuitBreaker:
+    """
+    Opens after consecutive failures so requests fail fast instead of piling up on
+    an unhealthy api. After the reset timeout one trial request is let through: it
+    closes the breaker if it succeeds and opens it again if it fails.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        """
+        :param failure_threshold: Consecutive failures that open the breaker
+        :param reset_timeout: Seconds open before letting a trial request through
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        Check if a request can be sent.
+        """
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if (
+                self.state == "open"
+                and time.monotonic() - self.opened_at >= self.reset_timeout
+            ):
+                self.state = "half_open"
+                return True
+            # Only the trial request is sent while half open
+            return False
+
+    def retry_after(self) -> float:
+        """
+        Seconds until the breaker lets a trial request through.
+        """
+        with self.lock:
+            return max(0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    logger.warning("Circuit breaker opened")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+class Upstream:
+    """
+    Access to an external api shared by every request of the worker: bounded
+    concurrency, rate limit, retries with jittered exponential backoff and a circuit
+    breaker.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int = 4,
+        rate: float = 10,
+        burst: int = 10,
+        retries: int = 3,
+        backoff: float = 0.5,
+        max_backoff: float = 10,
+        timeout: float = 30,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+    ):
+        """
+        :param name: The name of the api, for logs and errors
+        :param max_concurrency: Max requests in flight at the same time
+        :param rate: Max requests per second. 0 disables the limit
+        :param burst: Max requests sent at once before the rate limit applies
+        :param retries: Retries of failed requests
+        :param backoff: Base delay between retries (s), doubled on every attempt
+        :param max_backoff: Max delay between retries (s)
+        :param timeout: Timeout of every request (s)
+        :param failure_threshold: Consecutive failures that open the circuit breaker
+        :param reset_timeout: Seconds the circuit breaker stays open
+        """
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+        self.lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "failures": 0,
+            "retries": 0,
+            "rejected": 0,
+            "fallbacks": 0,
+            "in_flight": 0,
+            "waiting": 0,
+        }
+
+    def _count(self, stat: str, value: int = 1) -> None:
+        with self.lock:
+            self.stats[stat] += value
+
+    def _delay(self, attempt: int, response) -> float:
+        # Respect the delay asked by the api when it throttles
+        if response is not None and response.headers.get("Retry-After", "").isdigit():
+            return min(float(response.headers["Retry-After"]), self.max_backoff)
+        # Full jitter, so retries of concurrent requests do not hit the api together
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def _fallback(self, fallback):
+        if fallback is None:
+            return None
+        result = fallback()
+        if result is not None:
+            self._count("fallbacks")
+            logger.warning("%s is unavailable, using the fallback", self.name)
+        return result
+
+    def get(self, url: str, params: dict | None = None, fallback=None):
+        """
+        Send a GET request. Connection errors, timeouts, 429 and 5xx responses are
+        retried; other responses are returned to the caller.
+
+        :param url: The url of the request
+        :param params: The query parameters
+        :param fallback: Function without arguments called instead of failing when
+            the api is unavailable, e.g. to return cached or local data. If it
+            returns None the request fails as usual
+        :return: The response, or the result of the fallback
+        """
+        import requests
+
+        response = None
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow():
+                self._count("rejected")
+                result = self._fallback(fallback)
+                if result is not None:
+                    return result
+                raise UpstreamUnavailableError(
+                    f"{self.name} is unavailable, try again later",
+                    retry_after=self.breaker.retry_after(),
+                )
+
+            self._count("waiting")
+            try:
+                self.bucket.acquire()
+                self.semaphore.acquire()
+            finally:
+                self._count("waiting", -1)
+
+            self._count("in_flight")
+            self._count("requests")
+            try:
+                response = requests.get(url, params=params, timeout=self.timeout)
+                error = None
+            except requests.RequestException as e:
+                response = None
+                error = e
+            finally:
+                self.semaphore.release()
+                self._count("in_flight", -1)
+
+            # Other errors are caused by the request, not by the health of the api
+            if (
+                response is not None
+                and response.status_code < 500
+                and response.status_code != 429
+            ):
+                self.breaker.record_success()
+                return response
+
+            self.breaker.record_failure()
+            self._count("failures")
+            logger.warning(
+                "%s request failed (attempt %s): %s",
+                self.name,
+                attempt + 1,
+                error if error is not None else response.status_code,
+            )
+
+            if attempt < self.retries:
+                self._count("retries")
+                time.sleep(self._delay(attempt, response))
+
+        result = self._fallback(fallback)
+        if result is not None:
+            return result
+        raise UpstreamError(
+            f"{self.name} request failed after {self.retries + 1} attempts",
+            status_code=response.status_code if response is not None else None,
+        )
+
+    def state(self) -> dict:
+        """
+        Return the state of the circuit breaker, the rate limiter and the counters,
+        for monitoring.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+
+        return {
+            "name": self.name,
+            "breaker": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "retry_after": (
+                round(self.breaker.retry_after(), 3)
+                if self.breaker.state == "open"
+                else 0
+            ),
+            "max_concurrency": self.max_concurrency,
+            "tokens": round(self.bucket.tokens, 3),
+            **stats,
+        }
+
+
+def from_env(name: str, prefix: str, **defaults) -> Upstream:
+    """
+    Create the access to an api configured with environment variables:
+    <PREFIX>_MAX_CONCURRENCY, <PREFIX>_RATE_LIMIT, <PREFIX>_BURST, <PREFIX>_RETRIES,
+    <PREFIX>_TIMEOUT_SECONDS, <PREFIX>_BREAKER_FAILURES and
+    <PREFIX>_BREAKER_RESET_SECONDS.
+
+    :param name: The name of the api
+    :param prefix: The prefix of the environment variables
+    :param defaults: Defaults of the Upstream arguments
+    """
+
+    def env(variable: str, argument: str, cast):
+        value = os.environ.get(f"{prefix}_{variable}")
+        return cast(value) if value is not None else defaults[argument]
+
+    return Upstream(
+        name,
+        max_concurrency=env("MAX_CONCURRENCY", "max_concurrency", int),
+        rate=env("RATE_LIMIT", "rate", float),
+        burst=env("BURST", "burst", int),
+        retries=env("RETRIES", "retries", int),
+        timeout=env("TIMEOUT_SECONDS", "timeout", float),
+        failure_threshold=env("BREAKER_FAILURES", "failure_threshold", int),
+        reset_timeout=env("BREAKER_RESET_SECONDS", "reset_timeout", float),
+    )
+
+
+# PVGIS allows 30 requests per second per ip and positionstack has monthly quotas.
+# The limits are per worker
+pvgis = from_env(
+    "PVGIS",
+    "PVGIS",
+    max_concurrency=4,
+    rate=10,
+    burst=10,
+    retries=3,
+    timeout=60,
+    failure_threshold=5,
+    reset_timeout=30,
+)
+positionstack = from_env(
+    "positionstack",
+    "POSITIONSTACK",
+    max_concurrency=4,
+    rate=5,
+    burst=5,
+    retries=2,
+    timeout=10,
+    failure_threshold=5,
+    reset_timeout=60,
+)
+
+
+def get_state() -> list[dict]:
+    """
+    Return the state of every external api.
+    """
+    return [pvgis.state(), positionstack.state()]
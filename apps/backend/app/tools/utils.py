@@ -1,27 +1,131 @@
+import atexit
+import contextvars
+import copy
+import datetime
+import json
 import logging
 import logging.handlers
+import os
+import queue
+from contextlib import contextmanager
 
+# Correlation ids of the request and of the analysis being processed, added to
+# every log record
+request_id = contextvars.ContextVar("request_id", default=None)
+analysis_id = contextvars.ContextVar("analysis_id", default=None)
 
-def setup_logger():
-    log_format = "[%(asctime)s] {%(pathname)s:%(lineno)d} %(levelname)s \
-        - %(message)s"
-    date_format = "%d-%m %H:%M:%S"
 
-    # Create a formatter with the desired format
-    formatter = logging.Formatter(log_format, date_format)
+@contextmanager
+def log_context(requestId: str | None = None, analysisId: str | None = None):
+    """
+    Add the ids to the log records written inside the block, so a request or an
+    analysis can be followed through all its stages.
+
+    :param requestId: id of the request
+    :param analysisId: id of the analysis
+    """
+    tokens = []
+    if requestId is not None:
+        tokens.append((request_id, request_id.set(requestId)))
+    if analysisId is not None:
+        tokens.append((analysis_id, analysis_id.set(analysisId)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+class CorrelationFilter(logging.Filter):
+    """
+    Copy the correlation ids of the current context to the record. Runs in the
+    thread that logs, before the record is queued.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.requestId = request_id.get()
+        record.analysisId = analysis_id.get()
+        return True
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue the records without formatting them. The message is only merged with its
+    arguments, the rest of the formatting runs in the listener thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
 
-    # Create a logger
-    logger = logging.getLogger()
-    logger.setLevel(logging.INFO)  # Set the logging level you need
+class JsonFormatter(logging.Formatter):
+    """
+    Format the records as one json object per line.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "location": f"{record.pathname}:{record.lineno}",
+            "process": record.process,
+            "requestId": getattr(record, "requestId", None),
+            "analysisId": getattr(record, "analysisId", None),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logger():
+    """
+    Log through a queue, so the requests never wait for the writes. The records are
+    written by a listener thread as json (LOG_FORMAT=json, default) or text
+    (LOG_FORMAT=text), with the level of LOG_LEVEL (default INFO).
+    """
+    root = logging.getLogger()
+    # Only configured once per process
+    if any(isinstance(handler, LogQueueHandler) for handler in root.handlers):
+        return logging.getLogger("electro_cloud")
+
+    if os.environ.get("LOG_FORMAT", "json") == "text":
+        formatter = logging.Formatter(
+            "[%(asctime)s] {%(pathname)s:%(lineno)d} %(levelname)s "
+            "[%(requestId)s %(analysisId)s] - %(message)s",
+            "%d-%m %H:%M:%S",
+        )
+    else:
+        formatter = JsonFormatter()
 
     # Create a console handler and set the formatter
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
 
-    # Add the console handler to the logger
-    logger.addHandler(console_handler)
+    log_queue = queue.SimpleQueue()
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(CorrelationFilter())
+
+    # Every record, of the app and of the libraries, goes through the queue
+    root.addHandler(queue_handler)
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+    listener = logging.handlers.QueueListener(
+        log_queue, console_handler, respect_handler_level=True
+    )
+    listener.start()
+    # Write the queued records before exiting
+    atexit.register(listener.stop)
 
-    return logger
+    return logging.getLogger("electro_cloud")
 
 
 # Initialize the logger when the module is imported
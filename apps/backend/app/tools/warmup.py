@@ -0,0 +1,66 @@
+import threading
+import time
+
+from tools.utils import logger
+
+_warm = threading.Event()
+
+
+def warm_up() -> None:
+    """
+    Import the heavy libraries, build the matplotlib font cache, load the caches and
+    map the shared arrays, so the first analysis does not pay for them.
+    """
+    started = time.perf_counter()
+
+    try:
+        from matplotlib import font_manager
+        from matplotlib import pyplot as plt
+
+        # Loads the font cache, or builds it if this is a new container
+        font_manager.findfont(font_manager.FontProperties())
+        figure = plt.figure()
+        figure.text(0.5, 0.5, "Warm up")
+        figure.canvas.draw()
+        plt.close(figure)
+
+        # Imports pandas and numpy
+        import tools.energy_analysis_lib.battery
+        import tools.energy_analysis_lib.energy
+        import tools.energy_analysis_lib.solar  # noqa: F401
+        import tools.pvgis_api_wrapper as api
+        from tools.energy_analysis_lib import shared_arrays
+
+        for cache in [
+            api.locations_cache,
+            api.production_monthly_cache,
+            api.production_hourly_cache,
+            api.production_series_cache,
+        ]:
+            api.load_cache(cache)
+
+        # Calendar of the time slots and production series of the analyses
+        shared_arrays.preload()
+        logger.info("Warm up done in %.2fs", time.perf_counter() - started)
+    except Exception as e:
+        # The first requests pay for what was not warmed up
+        logger.exception("Warm up failed: %s", e)
+    finally:
+        # The api is usable either way
+        _warm.set()
+
+
+def start_warm_up() -> threading.Thread:
+    """
+    Warm up in a background thread so the api starts answering right away.
+    """
+    thread = threading.Thread(target=warm_up, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def is_warm() -> bool:
+    """
+    Return True once the warm up is done.
+    """
+    return _warm.is_set()
@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# The output folder is read when the library is imported
+os.environ["OUTPUT_PATH"] = tempfile.mkdtemp(prefix="electro-cloud-tests-")
@@ -0,0 +1,62 @@
+"""
+Tests of the dependency graph of the artifacts: an artifact is stale when one of
+the files it is built from changes.
+"""
+
+import os
+import uuid
+
+from tools.energy_analysis_lib import artifacts
+from tools.energy_analysis_lib.constants import PATHS
+
+
+def write(path: str, analysisId: str, content: str) -> None:
+    os.makedirs(PATHS[path], exist_ok=True)
+    with open(os.path.join(PATHS[path], f"{analysisId}.csv"), "w") as f:
+        f.write(content)
+
+
+def solar_analysis() -> str:
+    analysisId = str(uuid.uuid4())
+    for path in [
+        "consumption_parsed_hourly",
+        "consumption_parsed_monthly",
+        "production_hourly",
+        "production_monthly",
+        "production_parsed_hourly",
+        "production_parsed_monthly",
+        "time_slots",
+    ]:
+        write(path, analysisId, f"{path}\n")
+    artifacts.record(analysisId, ["production_parsed", "time_slots"])
+    return analysisId
+
+
+def test_recorded_artifacts_are_not_stale():
+    analysisId = solar_analysis()
+
+    assert artifacts.stale_nodes(analysisId, nodes=["time_slots"]) == []
+    assert not artifacts.is_stale(analysisId, "time_slots")
+
+
+def test_time_slots_are_stale_when_the_production_changes():
+    analysisId = solar_analysis()
+
+    write("production_hourly", analysisId, "other production\n")
+
+    assert "time_slots" in artifacts.stale_nodes(analysisId)
+    assert artifacts.is_stale(analysisId, "time_slots")
+
+
+def test_time_slots_of_energy_analyses_do_not_need_production():
+    analysisId = str(uuid.uuid4())
+    for path in ["consumption_parsed_hourly", "consumption_parsed_monthly"]:
+        write(path, analysisId, f"{path}\n")
+    write("time_slots", analysisId, "time slots\n")
+    artifacts.record(analysisId, ["time_slots"])
+
+    assert not artifacts.is_stale(analysisId, "time_slots")
+
+    write("consumption_parsed_hourly", analysisId, "other consumption\n")
+
+    assert artifacts.is_stale(analysisId, "time_slots")
@@ -0,0 +1,91 @@
+"""
+Tests of the battery simulation: the energy of every hour is balanced, the state of
+charge stays within its limits and the round trip loses the efficiency.
+"""
+
+import numpy as np
+import pytest
+from tools.energy_analysis_lib import battery
+
+CAPACITIES = [0, 2.5, 5, 10, 40]
+
+
+def simulate(seed: int = 0, **kwargs) -> tuple[np.ndarray, np.ndarray, dict]:
+    # Two weeks of hours with random consumption and a daily production curve
+    rng = np.random.default_rng(seed)
+    hours = np.arange(24 * 14)
+    consumption = rng.uniform(0, 3, len(hours))
+    production = np.maximum(np.sin((hours % 24 - 6) / 12 * np.pi), 0) * 5
+    production *= rng.uniform(0.5, 1, len(hours))
+    simulation = battery.simulate_battery(consumption, production, CAPACITIES, **kwargs)
+    return consumption, production, simulation
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"efficiency": 0.8, "min_soc": 0.2},
+        {"charge_power": 1, "discharge_power": 2},
+    ],
+)
+def test_the_energy_of_every_hour_is_balanced(kwargs):
+    consumption, production, simulation = simulate(**kwargs)
+
+    np.testing.assert_allclose(
+        simulation["grid_import"] - simulation["grid_export"],
+        (consumption - production)[:, None]
+        + simulation["charge"]
+        - simulation["discharge"],
+        atol=1e-9,
+    )
+    for flow in ["grid_import", "grid_export", "charge", "discharge"]:
+        assert (simulation[flow] >= -1e-9).all()
+
+
+@pytest.mark.parametrize("min_soc", [0, 0.1, 0.5])
+def test_the_state_of_charge_stays_within_its_limits(min_soc):
+    _, _, simulation = simulate(seed=1, min_soc=min_soc)
+    capacities = np.asarray(CAPACITIES, dtype=float)
+
+    assert (simulation["soc"] >= capacities * min_soc - 1e-9).all()
+    assert (simulation["soc"] <= capacities + 1e-9).all()
+    # The biggest batteries get full and reach their minimum
+    assert simulation["soc"][:, 2].max() == pytest.approx(capacities[2])
+    assert simulation["soc"][:, 2].min() == pytest.approx(capacities[2] * min_soc)
+
+
+@pytest.mark.parametrize("efficiency", [1, 0.9, 0.5])
+def test_the_round_trip_loses_the_efficiency(efficiency):
+    _, _, simulation = simulate(seed=2, efficiency=efficiency, min_soc=0)
+
+    # The energy discharged is the energy charged times the efficiency, less what
+    # is left in the battery at the end
+    left = simulation["soc"][-1] * np.sqrt(efficiency)
+    np.testing.assert_allclose(
+        simulation["discharge"].sum(axis=0),
+        simulation["charge"].sum(axis=0) * efficiency - left,
+        atol=1e-9,
+    )
+
+
+def test_a_charged_battery_discharges_the_efficiency():
+    simulation = battery.simulate_battery(
+        consumption=[0, 10],
+        production=[10, 0],
+        capacities=[10],
+        charge_power=10,
+        discharge_power=10,
+        efficiency=0.81,
+        min_soc=0,
+    )
+
+    assert simulation["charge"][:, 0] == pytest.approx([10, 0])
+    assert simulation["soc"][:, 0] == pytest.approx([9, 0])
+    assert simulation["discharge"][:, 0] == pytest.approx([0, 8.1])
+    assert simulation["grid_import"][:, 0] == pytest.approx([0, 1.9])
+
+
+def test_negative_capacities_are_rejected():
+    with pytest.raises(ValueError, match="non-negative"):
+        battery.simulate_battery([1], [0], [-1])
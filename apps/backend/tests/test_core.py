@@ -0,0 +1,20 @@
+"""
+Tests of the analyses of the core module.
+"""
+
+from io import BytesIO, StringIO
+
+from tools.energy_analysis_lib import core
+
+
+def test_text_and_binary_uploads_share_the_computation(monkeypatch):
+    monkeypatch.setattr(core.single_flight, "do", lambda key, function: key)
+    content = "CUPS;Fecha;Hora;Consumo_kWh;Metodo_obtencion\n" * 1000
+    parameters = ("Madrid", 1.0, "free", 14.0, 35.0, 0.0)
+
+    upload = BytesIO(content.encode("utf-8"))
+    key = core.solar_calculation(upload, *parameters)
+
+    assert key == core.solar_calculation(StringIO(content), *parameters)
+    # The upload is read again from the start by the analysis
+    assert upload.tell() == 0
@@ -0,0 +1,89 @@
+"""
+Tests of the parsing of consumption files: files parsed in chunks, or streamed from
+an upload, must give the same parsed files as reading them whole, up to the last
+digits of the sums.
+"""
+
+import datetime
+import os
+import random
+import uuid
+from io import BytesIO, StringIO, TextIOWrapper
+
+import pandas as pd
+import pytest
+from tools.energy_analysis_lib import energy
+from tools.energy_analysis_lib.constants import PATHS
+
+
+def consumption_file(seed: int = 0) -> str:
+    # One year of hours with values of very different sizes, so the order of the
+    # sums changes their last digits
+    rng = random.Random(seed)
+    rows = ["CUPS;Fecha;Hora;Consumo_kWh;Metodo_obtencion"]
+    day = datetime.date(2023, 1, 1)
+    while day.year == 2023:
+        for hour in range(1, 25):
+            value = f"{rng.random() * 10 ** rng.randint(-3, 4):.3f}".replace(".", ",")
+            rows.append(f"ES0000;{day:%d/%m/%Y};{hour};{value};R")
+        day += datetime.timedelta(days=1)
+    return "\n".join(rows) + "\n"
+
+
+def parse(csv_file, chunk_rows: int | None = None) -> tuple[bytes, pd.DataFrame]:
+    analysisId = str(uuid.uuid4())
+    os.makedirs(PATHS["consumption_parsed_hourly"], exist_ok=True)
+    os.makedirs(PATHS["consumption_parsed_monthly"], exist_ok=True)
+    if chunk_rows is None:
+        energy.parse_consumption_file(csv_file, analysisId, chunk_rows=0)
+    else:
+        energy.parse_consumption_file_chunked(csv_file, analysisId, chunk_rows)
+
+    with open(
+        os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv"), "rb"
+    ) as f:
+        hourly = f.read()
+    monthly = read(os.path.join(PATHS["consumption_parsed_monthly"], analysisId))
+    return hourly, monthly
+
+
+def read(path: str) -> pd.DataFrame:
+    return pd.read_csv(f"{path}.csv", sep=";", decimal=",", index_col=0)
+
+
+def assert_parsed_equal(parsed, expected) -> None:
+    # The monthly sums of the chunks only differ in their last digits
+    assert parsed[0] == expected[0]
+    pd.testing.assert_frame_equal(parsed[1], expected[1], rtol=1e-12)
+
+
+@pytest.mark.parametrize("chunk_rows", [100, 2000, 10000])
+def test_chunked_parsing_writes_the_same_files(chunk_rows):
+    content = consumption_file()
+
+    assert_parsed_equal(parse(StringIO(content), chunk_rows), parse(StringIO(content)))
+
+
+def test_streamed_upload_writes_the_same_files():
+    content = consumption_file(seed=1)
+    upload = TextIOWrapper(BytesIO(content.encode("utf-8")), encoding="UTF-8")
+
+    assert_parsed_equal(parse(upload, 500), parse(StringIO(content)))
+
+
+def test_chunked_parsing_writes_the_same_time_slots():
+    content = consumption_file(seed=2)
+    os.makedirs(PATHS["time_slots"], exist_ok=True)
+
+    analysisId = str(uuid.uuid4())
+    energy.parse_consumption_file_chunked(
+        StringIO(content), analysisId, 1000, time_slots=True
+    )
+    chunked = read(os.path.join(PATHS["time_slots"], analysisId))
+
+    # Time slots of the whole parsed file
+    os.remove(os.path.join(PATHS["time_slots"], f"{analysisId}.csv"))
+    energy.process_results_time_slot_energy(analysisId)
+    expected = read(os.path.join(PATHS["time_slots"], analysisId))
+
+    pd.testing.assert_frame_equal(chunked, expected, check_dtype=False, rtol=1e-12)
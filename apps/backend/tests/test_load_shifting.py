@@ -0,0 +1,103 @@
+"""
+Tests of the load shifting: the consumption moved keeps the energy of every day,
+respects the limits of the flexible load and never raises the cost.
+"""
+
+import numpy as np
+import pytest
+from tools.energy_analysis_lib import load_shifting
+
+
+def random_grid(seed: int, days: int = 30, hours: int = 24) -> dict:
+    rng = np.random.default_rng(seed)
+    shape = (days, hours)
+    # Some hours without consumption or production, like the parsed files
+    return {
+        "consumption": rng.uniform(0, 3, shape) * (rng.random(shape) > 0.1),
+        "production": rng.uniform(0, 4, shape) * (rng.random(shape) > 0.5),
+        "prices": rng.choice([0.08, 0.12, 0.2], shape),
+        "allowed": rng.random(shape) > 0.3,
+    }
+
+
+def cost(consumption, production, prices) -> np.ndarray:
+    return (np.maximum(consumption - production, 0) * prices).sum(axis=1)
+
+
+@pytest.mark.parametrize(
+    "seed, budget, max_power", [(0, 5, 1), (1, 2, 0.5), (2, 50, 3), (3, 0, 1)]
+)
+def test_shifting_keeps_the_energy_and_the_limits(seed, budget, max_power):
+    grid = random_grid(seed)
+    shifting = load_shifting.shift_load(budget=budget, max_power=max_power, **grid)
+    change = shifting["consumption"] - grid["consumption"]
+
+    # The energy of every day is the same
+    np.testing.assert_allclose(change.sum(axis=1), 0, atol=1e-9)
+    np.testing.assert_allclose(np.abs(change).sum(axis=1) / 2, shifting["moved"])
+    assert (shifting["moved"] <= budget + 1e-9).all()
+    assert (np.abs(change) <= max_power + 1e-9).all()
+    # Load is only added in the allowed hours and never below 0
+    assert (change[~grid["allowed"]] <= 1e-9).all()
+    assert (shifting["consumption"] >= 0).all()
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_shifting_never_raises_the_cost(seed):
+    grid = random_grid(seed)
+    shifting = load_shifting.shift_load(budget=4, max_power=1.5, **grid)
+
+    original = cost(grid["consumption"], grid["production"], grid["prices"])
+    shifted = cost(shifting["consumption"], grid["production"], grid["prices"])
+    assert (shifted <= original + 1e-9).all()
+
+
+def test_self_consumption_moves_the_imports_to_the_surpluses():
+    # Same price in every hour: 3 kWh of surplus in hour 1, 2 and 1 kWh imported in
+    # hours 0 and 3
+    shifting = load_shifting.shift_load(
+        consumption=np.array([[2.0, 0, 0, 1]]),
+        production=np.array([[0.0, 3, 0, 0]]),
+        prices=np.ones((1, 4)),
+        budget=10,
+        max_power=5,
+        allowed=np.ones((1, 4), dtype=bool),
+    )
+
+    assert shifting["consumption"][0] == pytest.approx([0, 3, 0, 0])
+    assert shifting["moved"] == pytest.approx([3])
+
+
+def test_cost_moves_the_imports_to_the_cheapest_hours():
+    # Without production, 1 kWh can leave each of the expensive hours 0 and 3 and
+    # go to the cheaper hours 1 and 2. A third kWh would not save anything
+    consumption = np.array([[2.0, 0, 0, 1]])
+    production = np.zeros((1, 4))
+    prices = np.array([[3.0, 1, 2, 3]])
+    shifting = load_shifting.shift_load(
+        consumption=consumption,
+        production=production,
+        prices=prices,
+        budget=10,
+        max_power=1,
+        allowed=np.ones((1, 4), dtype=bool),
+    )
+
+    assert shifting["consumption"][0] == pytest.approx([1, 1, 1, 0])
+    assert shifting["moved"] == pytest.approx([2])
+    assert cost(shifting["consumption"], production, prices) == pytest.approx([6])
+    assert cost(consumption, production, prices) == pytest.approx([9])
+
+
+def test_load_is_only_added_in_the_allowed_hours():
+    shifting = load_shifting.shift_load(
+        consumption=np.array([[2.0, 0, 0, 1]]),
+        production=np.zeros((1, 4)),
+        prices=np.array([[3.0, 1, 2, 3]]),
+        budget=10,
+        max_power=1,
+        allowed=np.array([[False, False, True, False]]),
+    )
+
+    assert shifting["consumption"][0] == pytest.approx([1, 0, 1, 1])
+    assert shifting["moved"] == pytest.approx([1])
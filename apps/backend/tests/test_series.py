@@ -0,0 +1,90 @@
+"""
+Tests of the hourly series: the downsampling picks the same points as the usual
+Largest-Triangle-Three-Buckets and the dates keep the real years of the
+consumption.
+"""
+
+import math
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+import pytest
+from tools.energy_analysis_lib import series
+from tools.energy_analysis_lib.constants import PATHS
+
+
+def reference_lttb(x: list, y: list, threshold: int) -> list[int]:
+    # Point by point version of the algorithm, as first described by Steinarsson
+    n = len(x)
+    every = (n - 2) / (threshold - 2)
+    picked = [0]
+    a = 0
+    for i in range(threshold - 2):
+        avg_start = math.floor((i + 1) * every) + 1
+        avg_end = min(math.floor((i + 2) * every) + 1, n)
+        avg_x = sum(x[avg_start:avg_end]) / (avg_end - avg_start)
+        avg_y = sum(y[avg_start:avg_end]) / (avg_end - avg_start)
+
+        max_area = -1
+        for j in range(math.floor(i * every) + 1, math.floor((i + 1) * every) + 1):
+            area = abs((x[a] - avg_x) * (y[j] - y[a]) - (x[a] - x[j]) * (avg_y - y[a]))
+            if area > max_area:
+                max_area = area
+                next_a = j
+        picked.append(next_a)
+        a = next_a
+    picked.append(n - 1)
+    return picked
+
+
+@pytest.mark.parametrize("n, max_points", [(100, 3), (1000, 10), (8760, 500)])
+def test_lttb_picks_the_points_of_the_reference(n, max_points):
+    rng = np.random.default_rng(n)
+    x = np.arange(n, dtype=float) + 1000
+    y = rng.exponential(1, n) * (rng.random(n) > 0.3)
+
+    picked = series.lttb(x, y, max_points)
+
+    assert picked.tolist() == reference_lttb(x.tolist(), y.tolist(), max_points)
+
+
+def test_lttb_keeps_small_series():
+    assert series.lttb(np.arange(5.0), np.ones(5), 10).tolist() == list(range(5))
+
+
+def test_dates_keep_the_years_of_a_consumption_across_the_new_year():
+    analysisId = str(uuid.uuid4())
+    os.makedirs(PATHS["consumption_parsed_hourly"], exist_ok=True)
+    days = pd.date_range("2024-12-30", "2025-01-02")
+    pd.DataFrame(
+        {
+            "Datetime": days.strftime("%Y-%m-%d"),
+            "Energy": 1.0,
+            "Month": days.month,
+            "Day": days.day,
+            "Hour": 1,
+        }
+    ).to_csv(
+        os.path.join(PATHS["consumption_parsed_hourly"], f"{analysisId}.csv"),
+        sep=";",
+        decimal=",",
+        index=False,
+    )
+    # Days of the production: with consumption, after it, before it and the 29th
+    # of February, which does not exist in 2025
+    df = pd.DataFrame(
+        [(12, 31), (1, 1), (1, 2), (1, 3), (12, 29), (2, 29)], columns=["Month", "Day"]
+    )
+
+    dates = series.load_dates(analysisId, df)
+
+    assert dates.tolist()[:-1] == [
+        pd.Timestamp("2024-12-31"),
+        pd.Timestamp("2025-01-01"),
+        pd.Timestamp("2025-01-02"),
+        pd.Timestamp("2025-01-03"),
+        pd.Timestamp("2025-12-29"),
+    ]
+    assert pd.isna(dates.iloc[-1])
@@ -0,0 +1,168 @@
+"""
+Tests of the s3 storage backend against a local S3 compatible service: the MinIO
+of the dev compose file when S3_ENDPOINT_URL is set, e.g.
+
+    S3_ENDPOINT_URL=http://localhost:9000 AWS_ACCESS_KEY_ID=minioadmin \
+    AWS_SECRET_ACCESS_KEY=minioadmin python -m pytest tests/test_storage.py
+
+or a moto server started by the tests otherwise.
+"""
+
+import os
+import uuid
+
+import pytest
+from tools.energy_analysis_lib import storage
+from tools.energy_analysis_lib.constants import PATHS
+
+
+@pytest.fixture(scope="module")
+def endpoint_url():
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    if os.environ.get("S3_ENDPOINT_URL"):
+        yield os.environ["S3_ENDPOINT_URL"]
+        return
+
+    moto_server = pytest.importorskip("moto.server")
+    server = moto_server.ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    yield f"http://{host}:{port}"
+    server.stop()
+
+
+@pytest.fixture
+def s3(endpoint_url, tmp_path):
+    backend = storage.S3Storage(
+        bucket=f"test-{uuid.uuid4().hex}",
+        endpoint_url=endpoint_url,
+        prefix="electro-cloud",
+        cache_grace_seconds=0,
+        revalidate_seconds=0,
+    )
+    backend.client.create_bucket(Bucket=backend.bucket)
+    # Each test is a host of its own
+    backend.index = storage.CacheIndex(str(tmp_path / "index.sqlite3"))
+    return backend
+
+
+def write_artifact(content: bytes, folder: str = "results") -> str:
+    path = os.path.join(PATHS[folder], f"{uuid.uuid4().hex}.csv")
+    os.makedirs(PATHS[folder], exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+def read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_fetch_downloads_published_files(s3):
+    path = write_artifact(b"Month;Energy\n1;1,5\n")
+    s3.publish([path])
+    os.remove(path)
+
+    assert s3.fetch(path) == path
+    assert read(path) == b"Month;Energy\n1;1,5\n"
+
+
+def test_fetch_missing_file(s3):
+    path = os.path.join(PATHS["results"], f"{uuid.uuid4().hex}.csv")
+
+    assert not os.path.exists(s3.fetch(path))
+
+
+def test_publish_uploads_big_files_in_parts(s3):
+    from boto3.s3.transfer import TransferConfig
+
+    s3.transfer_config = TransferConfig(
+        multipart_threshold=5 * 1024**2, multipart_chunksize=5 * 1024**2
+    )
+    content = os.urandom(11 * 1024**2)
+    path = write_artifact(content)
+    s3.publish([path])
+    os.remove(path)
+
+    head = s3.client.head_object(Bucket=s3.bucket, Key=s3.key(path))
+    # ETags of multipart uploads end with the number of parts
+    assert head["ETag"].strip('"').endswith("-3")
+    assert read(s3.fetch(path)) == content
+
+
+def test_fetch_drops_copies_changed_by_another_host(s3):
+    path = write_artifact(b"old")
+    analysisId = storage.analysis_id(path)
+    s3.publish([path])
+    s3.mark_changed(analysisId)
+    assert read(s3.fetch(path)) == b"old"
+
+    # Another host recomputes the analysis
+    s3.client.put_object(Bucket=s3.bucket, Key=s3.key(path), Body=b"new")
+    s3.client.put_object(
+        Bucket=s3.bucket, Key=s3.version_key(analysisId), Body=b"other host"
+    )
+
+    assert read(s3.fetch(path)) == b"new"
+
+
+def test_fetch_keeps_copies_until_revalidation(s3):
+    s3.revalidate_seconds = 3600
+    path = write_artifact(b"old")
+    analysisId = storage.analysis_id(path)
+    s3.publish([path])
+    s3.mark_changed(analysisId)
+
+    s3.client.put_object(Bucket=s3.bucket, Key=s3.key(path), Body=b"new")
+    s3.client.put_object(
+        Bucket=s3.bucket, Key=s3.version_key(analysisId), Body=b"other host"
+    )
+
+    # Hot reads stay local until the version is checked again
+    assert read(s3.fetch(path)) == b"old"
+
+
+def test_fetch_drops_copies_deleted_by_another_host(s3):
+    path = write_artifact(b"old")
+    analysisId = storage.analysis_id(path)
+    s3.publish([path])
+    s3.mark_changed(analysisId)
+
+    s3.client.delete_object(Bucket=s3.bucket, Key=s3.key(path))
+    s3.client.delete_object(Bucket=s3.bucket, Key=s3.version_key(analysisId))
+
+    assert not os.path.exists(s3.fetch(path))
+
+
+def test_evict_least_recently_used(s3):
+    s3.cache_max_bytes = 2500
+    first = write_artifact(b"1" * 1000)
+    second = write_artifact(b"2" * 1000)
+    s3.publish([first])
+    s3.publish([second])
+    s3.index.touch(first, force=True)
+
+    third = write_artifact(b"3" * 1000)
+    s3.publish([third])
+
+    assert s3.index.total_size() == 2000
+    assert os.path.exists(first)
+    assert not os.path.exists(second)
+    assert os.path.exists(third)
+    # Evicted files are still in the bucket
+    assert read(s3.fetch(second)) == b"2" * 1000
+
+
+def test_delete(s3):
+    path = write_artifact(b"content")
+    s3.publish([path])
+
+    s3.delete([path])
+
+    assert not os.path.exists(path)
+    assert s3.index.total_size() == 0
+    assert not os.path.exists(s3.fetch(path))
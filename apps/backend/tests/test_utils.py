@@ -0,0 +1,19 @@
+"""
+Tests of the helpers of the library shared by the workers.
+"""
+
+import os
+import stat
+
+from tools.energy_analysis_lib import utils as lib_utils
+
+
+def test_atomic_write_uses_the_umask(tmp_path):
+    path = str(tmp_path / "artifact.csv")
+    with lib_utils.atomic_write(path) as f:
+        f.write("content")
+
+    # Not the 0600 of the temporary file, other users of the volume can read it
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o666 & ~lib_utils._UMASK
+    with open(path) as f:
+        assert f.read() == "content"